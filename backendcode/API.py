@@ -1,33 +1,154 @@
 import redis
+import redis.asyncio
 import os
+import hashlib
 import httpx
 import mimetypes
 import asyncio
 import uuid
+import time
+import zipfile
+import random
+import anyio
 from pathlib import Path
+from contextlib import asynccontextmanager, aclosing
 
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, StreamingResponse, Response, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from urllib.parse import urlparse, parse_qs
 from starlette.websockets import WebSocketState
+from starlette.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 
-from backendcode.tasks import extract_info,download_video,delete_thumbnail
 from backendcode.celery_config import celery_app
-from backendcode.utils import extract_video_id
+from backendcode.utils import extract_video_id, extract_playlist_id
+from backendcode.metadata_cache import MetadataCache
+from backendcode.video_store import VideoStore
+from backendcode.progress import ProgressBroker, ProgressSubscriptions, TERMINAL_STATUSES, progress_key
+from backendcode.health import HealthMonitor
+from backendcode.video_info import (load_full_info, estimate_download_size, build_format_index, select_format,
+                                    download_selector, download_variant)
+from backendcode.batch import BatchTracker, batch_progress_key
+from backendcode.streaming import stream_key, reader_key, READER_TTL
+from backendcode.storage import get_storage_manager
+from backendcode.tracing import get_tracer
+from backendcode.watchers import WatcherRegistry
+from backendcode.prefetch import FormatPicks, PrefetchRegistry
+from backendcode.artifacts import ArtifactRegistry, node_queue
+from backendcode.admission import AdmissionController, AdmissionRejected
+from backendcode.metrics import (THUMBNAIL_FETCH, WEBSOCKET_SEND, ACTIVE_WEBSOCKETS, DOWNLOADS_IN_FLIGHT,
+                                 STORAGE_USED, STORAGE_QUOTA, PREFETCH_OUTCOMES, PREFETCH_WASTED_BYTES,
+                                 render_metrics, mark_process_dead)
+from prometheus_client import CONTENT_TYPE_LATEST
 
-from backendcode.data_models import EnvironmentVariablesConfig
+from backendcode.data_models import EnvironmentVariablesConfig, BatchRequest, DownloadRequest
 
 config = EnvironmentVariablesConfig()
 
-# the redis client used to ping the redis server
-redis_ping_client = redis.Redis(host=config.redis_address, port=config.redis_port, db=0, socket_timeout=10)
+# Tasks are referenced by name, so the API never imports the worker code (and yt-dlp along with it)
+extract_info = celery_app.signature("backendcode.tasks.extract_info")
+download_video = celery_app.signature("backendcode.tasks.download_video")
+stream_video = celery_app.signature("backendcode.tasks.stream_video")
+run_batch = celery_app.signature("backendcode.tasks.run_batch")
+replicate_artifact = celery_app.signature("backendcode.tasks.replicate_artifact")
 
 def get_redis_fetch_client():
     config = EnvironmentVariablesConfig()
     return redis.Redis(host=config.redis_address, port=config.redis_port, db=1)
 
-app = FastAPI()
+# Extracted metadata is shared between every request for the same video ID
+metadata_cache = MetadataCache(get_redis_fetch_client(), config.metadata_cache_ttl, config.metadata_cache_max_entries)
+
+# Downloaded videos are shared between every request for the same video and format
+video_store = VideoStore(get_redis_fetch_client())
+
+# Keeps the stored videos and thumbnails within the storage quota
+storage = get_storage_manager(get_redis_fetch_client())
+
+# Tracks the availability of redis and of the celery workers in the background
+health_monitor = HealthMonitor(
+    celery_app, redis.Redis(host=config.redis_address, port=config.redis_port, db=0, socket_timeout=10))
+
+# Extractions still waiting in the queue after this many seconds are dropped by the workers
+EXTRACTION_EXPIRES = 30
+# A download started over HTTP keeps its reference and the slot of its client for this long at most
+HOLD_TIMEOUT = 6 * 3600
+
+# Rejects new work early when the queues, the downloads or a single client already take too much
+admission = AdmissionController(
+    get_redis_fetch_client(), redis.Redis(host=config.redis_address, port=config.redis_port, db=0),
+    max_queued_extractions=config.admission_max_queued_extractions, extraction_expires=EXTRACTION_EXPIRES,
+    max_downloads=config.admission_max_downloads, max_bandwidth=config.admission_max_bandwidth,
+    client_extractions_per_minute=config.admission_client_extractions_per_minute,
+    client_downloads=config.admission_client_downloads)
+
+# Records the stages of every request, from its submission to the file being served, under its task ID
+tracer = get_tracer(get_redis_fetch_client())
+
+# The clients waiting for each download, downloads nobody waits for are cancelled by their worker
+watchers = WatcherRegistry(get_redis_fetch_client())
+
+# The nodes holding each video, when the workers do not share the videos volume with the API
+artifacts = ArtifactRegistry(get_redis_fetch_client())
+
+# The formats users pick, and the downloads started speculatively once a video is extracted
+format_picks = FormatPicks(get_redis_fetch_client())
+prefetches = PrefetchRegistry(get_redis_fetch_client())
+
+# Headers of a node response that are passed on to the client
+PROXIED_HEADERS = ("content-type", "content-length", "content-range", "accept-ranges", "last-modified")
+
+# Shared by every request of the API process, created when the app starts
+async_redis_client = None
+# Shared by every websocket to receive the progress events pushed by the workers
+progress_broker = None
+# Pooled HTTP client used to fetch thumbnails, so connections to the image hosts are reused
+http_client = None
+# Proxies the videos stored on other nodes. A video can take as long to stream as its slowest client takes
+# to read it, so it gets its own connections and no read timeout, and never holds back the thumbnails.
+proxy_client = None
+# The downloads started over HTTP that the process holds a reference to until they end
+held_downloads = set()
+
+async def sweep_storage():
+    """Periodically delete the idle videos and thumbnails, and evict the least used ones when over quota."""
+    while True:
+        await asyncio.sleep(config.storage_sweep_interval)
+        try:
+            await run_in_threadpool(storage.sweep)
+        except Exception as e:
+            print(f"Storage sweep failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global async_redis_client, progress_broker, http_client, proxy_client
+    await run_in_threadpool(health_monitor.start)
+    # The files on disk are the source of truth, the index is rebuilt from them in case Redis lost it
+    try:
+        await run_in_threadpool(storage.rebuild)
+    except redis.RedisError as e:
+        print(f"Failed to rebuild the storage index: {e}")
+    sweeper = asyncio.create_task(sweep_storage())
+    async_redis_client = redis.asyncio.Redis(host=config.redis_address, port=config.redis_port, db=1)
+    progress_broker = ProgressBroker(async_redis_client)
+    await progress_broker.start()
+    http_client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=50, max_keepalive_connections=20))
+    proxy_client = httpx.AsyncClient(timeout=httpx.Timeout(10, read=None, write=None),
+                                     limits=httpx.Limits(max_connections=None, max_keepalive_connections=20))
+    yield
+    sweeper.cancel()
+    for hold in list(held_downloads):
+        hold.cancel()
+    await http_client.aclose()
+    await proxy_client.aclose()
+    await progress_broker.stop()
+    await async_redis_client.aclose()
+    health_monitor.stop()
+    mark_process_dead(os.getpid())
+
+app = FastAPI(lifespan=lifespan)
 # For security, we only allow the origins we specify to interact with the backend. 
 # Thus, any frontend with a different origin is not allowed.
 origins = config.origin_address.split(",")
@@ -49,37 +170,158 @@ os.makedirs(VIDEOS_DIR, exist_ok=True)
 app.mount("/thumbnails", StaticFiles(directory=THUMBNAIL_DIR), name="thumbnails")
 app.mount("/videos", StaticFiles(directory=VIDEOS_DIR), name="videos")
 
-def get_redis_ping_client():
-    """ Create a new Redis client if the current one is disconnected. """
-    global redis_ping_client
+def touch_video(store_key: str):
+    """Record an access to a stored video, postponing its deletion and making its eviction less likely."""
+    video_store.touch(store_key)
+    storage.record_access(f"videos/{store_key}")
+
+@app.middleware("http")
+async def record_video_access(request: Request, call_next):
+    """Record every access to a stored video, so videos that are still being fetched are not deleted."""
+    parts = request.url.path.split("/")
+    if len(parts) > 3 and parts[1] == "videos":
+        try:
+            await run_in_threadpool(touch_video, parts[2])
+        except redis.RedisError:
+            pass
+        # The trace of a stored video ends with it being served (the time until the response starts)
+        started = time.time()
+        if len(parts) == 4 and not os.path.isfile(os.path.join(VIDEOS_DIR, parts[2], os.path.basename(parts[3]))):
+            response = await serve_from_node(request, parts[2])
+        else:
+            response = await call_next(request)
+        await run_in_threadpool(tracer.record, parts[2], "serve", started, time.time() - started,
+                                status=response.status_code, range=request.headers.get("range"))
+        return response
+    return await call_next(request)
+
+def counts_as_hit(request: Request) -> bool:
+    """Tell whether a request for a video is a new viewing of it, rather than a player seeking in it.
+
+    A player requests a video from its start (with or without a range), then requests the ranges it
+    seeks to; only the first response counts towards the traffic of the video.
+    """
+    byte_range = request.headers.get("range")
+    return request.method == "GET" and (byte_range is None or byte_range.replace(" ", "").startswith("bytes=0-"))
+
+def locate_video(store_key: str, hit: bool) -> tuple[dict[str, str], int]:
+    """Return the live nodes holding a video (node name to file server URL), and its hits in the current
+    window after counting this one if `hit` is set (0 otherwise)."""
+    artifact = f"videos/{store_key}"
+    return artifacts.locate(artifact), artifacts.record_hit(artifact) if hit else 0
+
+def replicate_if_hot(store_key: str, path: str, holders: dict[str, str], hits: int):
+    """Copy a video that gets a lot of traffic to one more node, until it has REPLICATION_MAX_COPIES."""
+    if not config.replication_hot_hits or hits < config.replication_hot_hits or len(holders) >= config.replication_max_copies:
+        return
+    candidates = [node for node in artifacts.alive_nodes() if node not in holders]
+    if not candidates:
+        return
+    target = random.choice(candidates)
+    artifact = f"videos/{store_key}"
+    if artifacts.claim_replication(artifact, target):
+        replicate_artifact.apply_async(args=[artifact, path, random.choice(list(holders.values()))],
+                                       queue=node_queue(target))
+        print(f"Copying {artifact} to node {target} ({hits} hits in the last minute)")
+
+async def serve_from_node(request: Request, store_key: str) -> Response:
+    """Serve a video stored on another node, by redirecting the client to it or proxying it."""
+    try:
+        holders, hits = await run_in_threadpool(locate_video, store_key, counts_as_hit(request))
+        await run_in_threadpool(replicate_if_hot, store_key, request.url.path, holders, hits)
+    except redis.RedisError:
+        return JSONResponse(status_code=503, content={"detail": "Task processing service is unavailable."})
+    if not holders:
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+
+    # The copies of a video share its traffic
+    url = f"{random.choice(list(holders.values()))}{request.url.path}"
+    if config.artifact_serving == "redirect":
+        return RedirectResponse(url, status_code=307)
+
+    # The range requested by the client (e.g., a video player seeking) is served by the node
+    headers = {"Range": request.headers["range"]} if "range" in request.headers else {}
     try:
-        if redis_ping_client is None or not redis_ping_client.ping():  # Check if Redis is alive
-            redis_ping_client = redis.Redis(host=config.redis_address, port=config.redis_port, db=0, socket_timeout=10)
-        return redis_ping_client
-    except redis.ConnectionError:
-        return None  # Return None if Redis is unreachable
+        upstream = await proxy_client.send(proxy_client.build_request(request.method, url, headers=headers), stream=True)
+    except httpx.HTTPError as e:
+        print(f"Failed to reach the node holding {store_key}: {e}")
+        return JSONResponse(status_code=502, content={"detail": "The node holding this video is unavailable."})
+    return StreamingResponse(upstream.aiter_raw(), status_code=upstream.status_code,
+                             headers={k: v for k, v in upstream.headers.items() if k.lower() in PROXIED_HEADERS},
+                             background=BackgroundTask(upstream.aclose))
+
+def too_many_requests(rejection: AdmissionRejected) -> HTTPException:
+    """Turn a rejection of the admission controller into a 429 response telling the client when to retry."""
+    return HTTPException(status_code=429, detail=rejection.reason,
+                         headers={"Retry-After": str(rejection.retry_after)})
+
+def client_id_of(connection: Request | WebSocket) -> str:
+    """Identify the client of a request, for the per-client admission limits."""
+    return connection.client.host if connection.client else "unknown"
+
+def task_etag(task_id: str, state: str, variant: str = "") -> str:
+    """Return the ETag of a response about a task. Results never change once a task reached a state."""
+    return f'"{task_id}-{state.lower()}{"-" + variant if variant else ""}"'
 
-def is_celery_available() -> bool:
+def conditional_response(request: Request, etag: str, build) -> Response:
+    """Answer with 304 when the client already has the response with this ETag, otherwise with `build()`.
 
-    """Check if Celery workers are running.
+    Clients have to revalidate (no-cache), so polling clients get the new response as soon as the
+    task changes, and an empty 304 until then, without the response being built and serialized again.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if if_none_match.strip() == "*" or etag in tags:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=build(), headers=headers)
+
+@app.get("/health")
+def get_health():
+    """
+    Report the availability of the task processing services.
 
     Returns:
-        bool: True if Celery workers are running, False otherwise.
+        dict: The cached availability of redis and of the celery workers, along with the load of every worker.
+              The status code is 503 if tasks cannot be processed.
     """
-    inspect = celery_app.control.inspect()
+    snapshot = health_monitor.snapshot()
+    return JSONResponse(status_code=200 if snapshot["available"] else 503, content=snapshot)
+
+@app.get("/metrics")
+def get_metrics():
+    """Expose the metrics of the API in the Prometheus text format (the workers expose theirs on WORKER_METRICS_PORT)."""
+    # The shared state is read when scraped, rather than kept up to date by every process
+    STORAGE_QUOTA.set(config.storage_quota_bytes)
+    try:
+        DOWNLOADS_IN_FLIGHT.set(admission.downloads_in_flight())
+        STORAGE_USED.set(storage.used_bytes())
+    except redis.RedisError:
+        pass
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE_LATEST)
 
-    if inspect and inspect.ping():
-        return True  
-    return False  
+@app.get("/trace/{task_id}")
+def get_trace(task_id: str):
+    """
+    Return the spans recorded for a task, from its submission to the file being served.
 
+    Args:
+        task_id (str): The ID of a metadata task (or of a download task).
 
-def is_redis_available():
-    """ Check if Redis is available and reconnect if needed. """
-    client = get_redis_ping_client()
-    return client.ping() if client else False
+    Returns:
+        dict: The spans in the order they started, each with its name, start time, duration (seconds),
+              the process that recorded it and the trace it belongs to.
+    """
+    try:
+        spans = tracer.load(task_id)
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
+    if not spans:
+        raise HTTPException(status_code=404, detail="No trace was recorded for this task.")
+    return {"task_id": task_id, "spans": spans}
 
 @app.get("/video")
-def submit_video_url(url: str):
+def submit_video_url(url: str, request: Request):
 
     """
     Submit a YouTube video URL to be processed.
@@ -91,8 +333,8 @@ def submit_video_url(url: str):
         dict: A JSON object containing the task ID and status.
     """
     
-    # Check if Redis and Celery are available to execute tasks
-    if not is_redis_available() or not is_celery_available():
+    # Check if Redis and Celery are available to execute tasks, from the snapshot kept by the health monitor
+    if not health_monitor.is_available():
         raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
     
     # Extract the video ID from the URL
@@ -103,19 +345,61 @@ def submit_video_url(url: str):
         raise HTTPException(status_code=400, detail="URL is not formatted properly. Please ensure your using a valid YouTube video URL.")
     actualURL = f"https://www.youtube.com/watch?v={videoID}"
 
-    # Schedule the task for execution by celery and return the task ID to the client
+    def submit(new_task_id):
+        # Only new extractions add load, the cached ones are served whatever the load is
+        admission.admit_extraction(client_id_of(request))
+        extract_info.apply_async(args=[actualURL], expires=EXTRACTION_EXPIRES, task_id=new_task_id)
+
+    # Reuse the extraction of this video if there is one, otherwise schedule it for execution by celery.
+    # Either way, the client gets a task ID that resolves to the video metadata.
     try:
-        task = extract_info.apply_async(args=[actualURL], expires=30)
-        return {"task_id": task.id, "status": "processing"}
+        started = time.time()
+        task_id, cached = metadata_cache.get_or_submit(videoID, submit)
+        tracer.record(task_id, "submit", started, time.time() - started, video_id=videoID, cached=cached)
+        return {"task_id": task_id, "status": "processing"}
+    except AdmissionRejected as rejection:
+        raise too_many_requests(rejection)
     except Exception:
         raise HTTPException(status_code=503, detail="Failed to connect to task scheduling service.")
 
+@app.get("/queue")
+def get_queue_estimate():
+    """
+    Report the load of the task queues and how long new work is expected to wait before it starts.
+
+    Returns:
+        dict: For extractions and downloads, the number of queued tasks, the estimated wait (seconds)
+              and the limits above which new work is rejected with a 429 status code.
+    """
+    try:
+        return admission.estimate()
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
+
+@app.get("/cache/metadata")
+def get_metadata_cache_stats():
+    """Return the hit/miss counters of the metadata cache, used to size it."""
+    try:
+        return metadata_cache.stats()
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
+
+@app.get("/storage")
+def get_storage_stats():
+    """Return the usage of the storage, compared to its quota."""
+    try:
+        return storage.stats()
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
+
 @app.get("/video/{task_id}")
-def get_video_format_data(task_id: str):
+def get_video_format_data(task_id: str, request: Request):
 
     """
     Get the status and the format data result of a video by task ID.
 
+    The response carries an ETag, so repeated polls of a task that did not change get a 304.
+
     Args:
         task_id (str): The ID of the task to retrieve.
 
@@ -124,14 +408,68 @@ def get_video_format_data(task_id: str):
     """
 
     task = celery_app.AsyncResult(task_id)
-    if task.state == "PENDING":
-        return {"task_id": task_id, "status": "pending"}
-    elif task.state == "SUCCESS":
-        return {"task_id": task_id, "status": "completed", "result": strip_required_data(task.result)}
-    elif task.state == "FAILURE" or task.state =="REVOKED" or task.state == "RETRY":
-        return {"task_id": task_id, "status": "retry", "error": str(task.result)}
-    else:
-        return {"task_id": task_id, "status": task.state.lower()}
+    state = task.state
+
+    def build():
+        if state == "PENDING":
+            return {"task_id": task_id, "status": "pending"}
+        elif state == "SUCCESS":
+            # The worker already stores only the fields this endpoint needs
+            return {"task_id": task_id, "status": "completed", "result": task.result}
+        elif state == "FAILURE" or state =="REVOKED" or state == "RETRY":
+            return {"task_id": task_id, "status": "retry", "error": str(task.result)}
+        else:
+            return {"task_id": task_id, "status": state.lower()}
+
+    return conditional_response(request, task_etag(task_id, state), build)
+
+@app.get("/video/format/{task_id}")
+def select_video_format(task_id: str, request: Request, max_height: int | None = None, min_height: int | None = None,
+                        ext: str | None = None, vcodec: str | None = None, max_size: int | None = None,
+                        min_fps: float | None = None):
+    """
+    Choose the best format of a video that satisfies some constraints, e.g., "the best mp4 up to 1080p under 200 MB"
+    is ?ext=mp4&max_height=1080&max_size=200000000.
+
+    Args:
+        task_id (str): The ID of the metadata task of the video.
+        max_height, min_height (int): The range of the resolution (in lines).
+        ext (str): The container of the video stream (e.g., "mp4").
+        vcodec (str): The video codec, as a family ("h264", "vp9", "av1"...) or a codec string ("avc1.64001F").
+        max_size (int): The maximum estimated size of the download (bytes), audio included.
+        min_fps (float): The minimum frame rate.
+
+    Returns:
+        dict: A JSON object containing the task ID, the status and, once the metadata is extracted, the
+            format to download (the "format" of the download WebSocket), the yt-dlp selector download_video
+            uses for it, and the index entry of the format. 404 if no format satisfies the constraints.
+    """
+
+    task = celery_app.AsyncResult(task_id)
+    state = task.state
+
+    def build():
+        if state == "PENDING":
+            return {"task_id": task_id, "status": "pending"}
+        elif state == "FAILURE" or state =="REVOKED" or state == "RETRY":
+            return {"task_id": task_id, "status": "retry", "error": str(task.result)}
+        elif state != "SUCCESS":
+            return {"task_id": task_id, "status": state.lower()}
+
+        # Results extracted before the index was part of them are indexed on the fly
+        index = task.result.get("format_index")
+        if index is None:
+            index = build_format_index(task.result.get("formats", []))
+        entry = select_format(index, max_height=max_height, min_height=min_height, ext=ext, vcodec=vcodec,
+                              max_size=max_size, min_fps=min_fps)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="No format of this video satisfies the constraints.")
+        return {"task_id": task_id, "status": "completed", "format": entry["format_id"],
+                "selector": download_selector(entry["format_id"]), "match": entry}
+
+    # The answer depends on the constraints too
+    constraints = hashlib.sha1(str(sorted(request.query_params.multi_items())).encode("utf-8")).hexdigest()[:12]
+    return conditional_response(request, task_etag(task_id, state, constraints), build)
 
 @app.get("/video/thumbnail/{task_id}")
 async def get_thumbnail(task_id: str):
@@ -149,36 +487,85 @@ async def get_thumbnail(task_id: str):
             - "error": (only if the task has failed, been revoked, or is in a retry state) The error message.
     """
 
-    task = celery_app.AsyncResult(task_id)
-    if task.state == "PENDING":
+    # Reading the task from the result backend is blocking, so it is kept off the event loop
+    state, result = await run_in_threadpool(get_task_state_and_result, task_id)
+    if state == "PENDING":
         return {"task_id": task_id, "status": "processing"}
-    elif task.state == "SUCCESS":
+    elif state == "SUCCESS":
 
-        thumnailURL = (task.result).get('thumbnail',None)
-        path = await download_image(thumnailURL, f"{task_id}")
-        image_url = f"/thumbnails/{Path(path).name}"
-        delete_thumbnail.apply_async(args=[task_id], countdown=config.thumbnail_persistence_duration)
+        # Thumbnails are shared by every task of the same video
+        thumnailURL = result.get('thumbnail',None)
+        started = time.time()
+        file_name = await get_video_thumbnail(result.get('id', task_id), thumnailURL)
+        await run_in_threadpool(tracer.record, task_id, "thumbnail", started, time.time() - started)
+        image_url = f"/thumbnails/{file_name}"
 
         return {"task_id": task_id, "status": "success", "image_url": image_url}
     
-    elif task.state == "FAILURE" or task.state =="REVOKED" or task.state == "RETRY":
-        return {"task_id": task_id, "status": "retry", "error": str(task.result)}
+    elif state == "FAILURE" or state =="REVOKED" or state == "RETRY":
+        return {"task_id": task_id, "status": "retry", "error": str(result)}
     else:
-        return {"task_id": task_id, "status": task.state}
+        return {"task_id": task_id, "status": state}
+
+def get_task_state_and_result(task_id: str):
+    """Return the state and the result of a celery task."""
+    task = celery_app.AsyncResult(task_id)
+    return task.state, task.result
+
+# The thumbnails being fetched by this process, so concurrent requests of a video share one download
+thumbnail_fetches: dict[str, asyncio.Task] = {}
+
+async def get_video_thumbnail(video_id: str, url: str) -> str:
+    """Return the file name of the thumbnail of a video, downloading it if it is not stored yet."""
+    file_name = await async_redis_client.get(f"thumbnail:{video_id}")
+    if file_name is not None:
+        file_name = file_name.decode("utf-8")
+        if await anyio.Path(THUMBNAIL_DIR, file_name).exists():
+            await run_in_threadpool(storage.record_access, f"thumbnails/{file_name}")
+            return file_name
+
+    fetch = thumbnail_fetches.get(video_id)
+    if fetch is None:
+        fetch = asyncio.create_task(fetch_video_thumbnail(video_id, url))
+        thumbnail_fetches[video_id] = fetch
+        fetch.add_done_callback(lambda _: thumbnail_fetches.pop(video_id, None))
+    # A client going away must not cancel the download other requests are waiting for
+    return await asyncio.shield(fetch)
+
+async def fetch_video_thumbnail(video_id: str, url: str) -> str:
+    """Download the thumbnail of a video and record it in the storage, which deletes it once unused."""
+    started = time.monotonic()
+    path = await download_image(url, video_id)
+    THUMBNAIL_FETCH.observe(time.monotonic() - started)
+    file_name = Path(path).name
+
+    await run_in_threadpool(storage.add, f"thumbnails/{file_name}", (await anyio.Path(path).stat()).st_size)
+    await async_redis_client.set(f"thumbnail:{video_id}", file_name, ex=config.thumbnail_persistence_duration)
+    return file_name
 
 async def download_image(url: str, filename: str) -> str:
-    """Asynchronously download an image and save it with the correct extension."""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
+    """Asynchronously download an image and save it with the correct extension.
+
+    The image is streamed to a temporary file which is renamed once complete, so a partially
+    written image is never served.
+    """
+    async with http_client.stream("GET", url) as response:
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail="Failed to download image")
 
         extension = await get_image_extension(url, response.headers)
         full_filename = f"{filename}{extension}"
         file_path = os.path.join(THUMBNAIL_DIR,full_filename)
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
 
-        with open(file_path, "wb") as f:
-            f.write(response.content)
+        try:
+            async with await anyio.open_file(temp_path, "wb") as f:
+                async for chunk in response.aiter_bytes():
+                    await f.write(chunk)
+            await anyio.Path(temp_path).replace(file_path)
+        except BaseException:
+            await anyio.Path(temp_path).unlink(missing_ok=True)
+            raise
 
     return str(file_path)
 
@@ -213,83 +600,500 @@ def full_details(task_id: str):
         return {"task_id": task_id, "status": task.state}
 
 
+def requested_section(start: float | None, end: float | None, duration: float | None) -> list | None:
+    """Validate the time range of a clip, returning it as [start, end] (end None for the end of the video),
+    or None for the whole video."""
+    if start is None and end is None:
+        return None
+    start = float(start or 0)
+    end = float(end) if end is not None else None
+    if start < 0:
+        raise Exception("Invalid time range, the start cannot be negative.")
+    if end is not None and end <= start:
+        raise Exception("Invalid time range, the end must come after the start.")
+    if duration:
+        if start >= duration:
+            raise Exception("Invalid time range, the start is past the end of the video.")
+        if end is not None and end >= duration:
+            end = None
+    if start == 0 and end is None:
+        return None
+    return [start, end]
+
+
+def start_download(task_id: str, video_format: str | None, watcher_id: str = None, start: float = None,
+                   end: float = None, audio_only: bool = False) -> str:
+    """Attach to the stored video of a metadata task in the given format, downloading it if needed.
+
+    A clip of the video (between `start` and `end`, in seconds) or its audio only can be requested
+    instead of the whole video, each is stored on its own.
+
+    The caller holds a reference to the stored video, which it must release once it is done with it.
+    If a watcher ID is given, the caller is registered as waiting for the video before a download can
+    start, so the download cannot be cancelled before the caller had a chance to follow it.
+
+    Returns:
+        str: The store key of the video, which its progress events are published under.
+    """
+
+    # Check if the task ID is valid
+    result = celery_app.AsyncResult(task_id).result
+    if(result is None):
+        raise Exception("Invalid task ID/Too soon to make a request.")
+    if not video_format and not audio_only:
+        raise Exception("No format was selected.")
+    section = requested_section(start, end, result.get("duration"))
+
+    # Get the result URL of the video and the address of this video/format in the shared store
+    url = result.get("original_url", None)
+    video_id = result.get("id", url)
+    variant = download_variant(video_format, section, audio_only)
+    store_key = VideoStore.key_for(video_id, variant)
+    if watcher_id is not None:
+        watchers.watch([store_key], watcher_id)
+
+    # Learn what users pick, and settle the format downloaded speculatively after the extraction: a hit
+    # attaches to it below, a miss stops it (a clip or the audio of the video is a miss)
+    picked = next((entry for entry in result.get("format_index", []) if entry["format_id"] == video_format), None)
+    if picked is not None and not audio_only:
+        format_picks.record(result.get("duration"), picked)
+    prefetch = prefetches.decide(video_id, variant)
+    if prefetch is not None:
+        PREFETCH_OUTCOMES.labels(prefetch[0]).inc()
+        prefetched = video_store.get(prefetch[1])
+        if prefetch[0] == "miss" and prefetched.get("status") == "completed":
+            PREFETCH_WASTED_BYTES.inc(int(prefetched.get("size", 0)))
+
+    # Attach to the stored video, or to the download producing it. Only schedule a new
+    # download when nobody has the video yet. This is to be run in the background by celery.
+    download_id = str(uuid.uuid4())
+    state, value = video_store.acquire(store_key, download_id)
+    if state == "claimed":
+        try:
+            # Refuse new downloads while the server is overloaded, or the storage is full. Nothing is evicted
+            # while the user waits, the periodic sweep keeps some of the quota free for new downloads.
+            admission.admit_download()
+            expected_size = estimate_download_size(result.get("formats", []), video_format, audio_only, section,
+                                                   result.get("duration"))
+            if not storage.has_capacity(expected_size, evict=False):
+                raise Exception("The storage is full, please try again later.")
+            admission.register_download(download_id)
+            download_video.apply_async(args=[store_key, url, video_format, video_id], task_id=download_id,
+                                       kwargs={"section": section, "audio_only": audio_only})
+        except Exception:
+            video_store.fail(store_key)
+            video_store.release(store_key)
+            raise
+
+    # The trace of the task continues with the download producing the video, or with the stored video
+    prefetch_outcome = prefetch[0] if prefetch is not None else None
+    if state == "completed":
+        tracer.link(task_id, store_key, "download", format=variant, state=state, prefetch=prefetch_outcome)
+    else:
+        tracer.link(task_id, value, "download", format=variant, state=state, prefetch=prefetch_outcome)
+    return store_key
+
+
+def completed_event(entry: dict) -> dict:
+    """Return the final progress event of a stored video, for a client that comes after its download ended."""
+    event = {"status": "completed", "message": "Video download finished!", "URL": entry["path"]}
+    if "bytes_saved" in entry:
+        event["bytes_saved"] = int(entry["bytes_saved"])
+    return event
+
+
+async def send_progress(websocket: WebSocket, message: dict):
+    """Send a progress message to a client, measuring how long after its publication it was sent."""
+    await websocket.send_json(message)
+    if message.get("time"):
+        WEBSOCKET_SEND.observe(max(0.0, time.time() - float(message["time"])))
+
+async def follow_download(store_key: str):
+    """Yield the progress events of a download, ending with its final "completed" or "error" event.
+
+    Requests attached to an ongoing download start from its latest progress.
+    """
+
+    # Subscribe before reading the current state, so the completion event cannot be missed
+    final_event = None
+    async with progress_broker.watch(store_key) as events:
+        entry = await run_in_threadpool(video_store.get, store_key)
+
+        if entry.get("status") == "downloading":
+            progress = await progress_broker.snapshot(store_key)
+            if progress.get("status") in ("downloading", "finished"):
+                yield {"status": progress["status"], "progress": progress["progress"], "time": float(progress.get("time", 0))}
+
+        while entry.get("status") == "downloading":
+            try:
+                event = await asyncio.wait_for(events.get(), timeout=30)
+            except asyncio.TimeoutError:
+                # No news for a while, make sure the download did not end (or die) without us hearing about it
+                entry = await run_in_threadpool(video_store.get, store_key)
+                if VideoStore.is_stale(entry):
+                    break
+                continue
+
+            if event["status"] in TERMINAL_STATUSES:
+                final_event = event
+                break
+            yield {"status": event["status"], "progress": event["progress"], "time": event["time"]}
+
+    # The video was already stored (or the download ended while we were checking)
+    if final_event is None:
+        entry = await run_in_threadpool(video_store.get, store_key)
+        if entry.get("status") == "completed":
+            final_event = completed_event(entry)
+    if final_event is None or final_event["status"] != "completed":
+        final_event = {"status": "error", "message": "Video download failed, please try again."}
+    yield final_event
+
+@asynccontextmanager
+async def watching(store_key: str, watcher_id: str):
+    """Count a client as waiting for a download for the duration of the context."""
+
+    async def renew():
+        while True:
+            try:
+                await run_in_threadpool(watchers.watch, [store_key], watcher_id)
+            except redis.RedisError as e:
+                print(f"Failed to renew the watch of {store_key}: {e}")
+            await asyncio.sleep(WatcherRegistry.WATCH_TTL / 3)
+
+    renewer = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renewer.cancel()
+        try:
+            await run_in_threadpool(watchers.leave, [store_key], watcher_id)
+        except redis.RedisError as e:
+            print(f"Failed to leave the download {store_key}: {e}")
+
 @app.websocket("/video/download")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    ACTIVE_WEBSOCKETS.inc()
+    started = time.time()
+    store_key = None
+    task_id = None
+    status = "disconnected"
+    client_id = client_id_of(websocket)
+    session_id = str(uuid.uuid4())
+    admitted = False
 
     try:
         data = await websocket.receive_json()
 
-        video_format = data["format"]
+        video_format = data.get("format")
         task_id = data["task_id"]
-        
-        # Check if the task ID is valid
-        if(celery_app.AsyncResult(task_id).result is None):
-            raise Exception("Invalid task ID/Too soon to make a request.")
-        
-        # Get the result URL of the video 
-        url = celery_app.AsyncResult(task_id).result.get("original_url", None)
-
-        # Schedule the download task. This is to be run in the background by celery.
-        task = download_video.apply_async(args=[task_id, url, video_format])
-
-        # Create a new redis client for each websocket request to avoid collision issues
-        redis_client = get_redis_fetch_client() 
-        while not task.ready():
-
-            # We look if there are any updates for our task id
-            if redis_client.scan_iter(f"{task_id}:*"):
-                
-                # If there are updates, we send them to the client
-                value = redis_client.get(f"{task_id}:progress")
-                downloadStatus = redis_client.get(f"{task_id}:status")
-                if value is not None:
-                    value = value.decode()
-                    downloadStatus = downloadStatus.decode('utf-8')
-
-                    await websocket.send_json({"status": downloadStatus,"progress": value})
-            # Sleep for 2 seconds
-            await asyncio.sleep(2)
-
-        # Finally, when the task is completed, we update the status.
-        await websocket.send_json({"status": "completed", 
-                                   "message": "Video download finished!",
-                                   "URL":redis_client.get(task_id+":path").decode('utf-8')})
+
+        # Talking to celery and redis is blocking, so it is kept off the event loop
+        await run_in_threadpool(admission.admit_client_download, client_id, session_id)
+        admitted = True
+        # Optionally, only a clip of the video ("start" and "end" in seconds) or its audio ("audio_only")
+        store_key = await run_in_threadpool(start_download, task_id, video_format, session_id, data.get("start"),
+                                            data.get("end"), bool(data.get("audio_only", False)))
+
+        # The download is cancelled if the client leaves, and does not come back within the grace period
+        async with watching(store_key, session_id), aclosing(follow_download(store_key)) as events:
+            async for event in events:
+                # Finally, when the download is completed, we update the status.
+                if event["status"] == "error":
+                    raise Exception(event["message"])
+                await send_progress(websocket, event)
+        status = "completed"
     except WebSocketDisconnect:
         print("Client disconnected.")
+    except AdmissionRejected as rejection:
+        status = "rejected"
+        await websocket.send_json({"status": "error", "message": rejection.reason, "retry_after": rejection.retry_after})
+        # 1013: Try Again Later
+        await websocket.close(code=1013)
     except Exception as e:
         print(e)
+        status = "error"
         await websocket.send_json({"status": "error", "message": str(e)})   
     finally:
-        if websocket.client_state == WebSocketState.CONNECTED:
+        ACTIVE_WEBSOCKETS.dec()
+        # The video is kept until it was not accessed for a while, now that nobody follows it anymore
+        if store_key is not None:
+            await run_in_threadpool(video_store.release, store_key)
+        if admitted:
+            await run_in_threadpool(admission.release_client_download, client_id, session_id)
+        if task_id is not None:
+            await run_in_threadpool(tracer.record, task_id, "websocket", started, time.time() - started, status=status)
+        # Unless the client left, or the socket was already closed (e.g., with 1013 on a rejection)
+        if websocket.client_state == WebSocketState.CONNECTED and websocket.application_state == WebSocketState.CONNECTED:
             await websocket.close(code=1000)
             print("WebSocket closed.")
         else:
-            print(f"WebSocket state: {websocket.client_state}")
-
-
-def strip_required_data(info):
-    """Fetch video formats and metadata, return it as a dictionary."""
-    formats = info.get('formats', [])
-    return {
-        "name": info.get('title', 'Unknown'),
-        "duration_string": info.get('duration_string', 'N/A'),
-        "formats": [
-            {
-                'format_id': fmt.get('format_id', 'N/A'),
-                'ext': fmt.get('ext', 'N/A'),
-                'vcodec': fmt.get('vcodec', 'N/A'),
-                'resolution': fmt.get('resolution', 'N/A'),
-                "fps": fmt.get('fps', 'N/A'),
-                "filesize": fmt.get('filesize', 'N/A')
-            }
-            for fmt in formats
-        ]
-    }
+            print(f"WebSocket state: {websocket.client_state} (application: {websocket.application_state})")
+
+
+def download_state(store_key: str) -> dict:
+    """Return the current state of a download as a progress event, for a client that starts following it."""
+    entry = video_store.get(store_key)
+    if entry.get("status") == "completed":
+        return completed_event(entry)
+    if entry.get("status") == "downloading":
+        progress = {k.decode("utf-8"): v.decode("utf-8")
+                    for k, v in video_store.redis_client.hgetall(progress_key(store_key)).items()}
+        if progress.get("status") in ("downloading", "finished"):
+            return {"status": progress["status"], "progress": progress["progress"], "time": float(progress.get("time", 0))}
+        return {"status": "queued"}
+    if entry.get("status") == "failed":
+        return {"status": "error", "message": "Video download failed, please try again."}
+    return {"status": "error", "message": "Unknown download."}
+
+async def hold_download(store_key: str, client_id: str, session_id: str):
+    """Keep the reference to a download started over HTTP, and the slot of its client, until it ends.
+
+    A download that died is given up once its heartbeat is stale, and any download after HOLD_TIMEOUT.
+    """
+    try:
+        async with asyncio.timeout(HOLD_TIMEOUT), aclosing(follow_download(store_key)) as events:
+            async for _ in events:
+                pass
+    except TimeoutError:
+        print(f"Stopped following the download {store_key}: it did not end within {HOLD_TIMEOUT} seconds")
+    except Exception as e:
+        print(f"Stopped following the download {store_key}: {e}")
+    finally:
+        await run_in_threadpool(video_store.release, store_key)
+        await run_in_threadpool(admission.release_client_download, client_id, session_id)
+
+@app.post("/video/download", status_code=202)
+async def start_download_endpoint(request: DownloadRequest, http_request: Request):
+
+    """
+    Start the download of a video in a format (or attach to the one in progress), without following it.
+
+    Its progress is followed on the /progress WebSocket, under the returned store key, along with
+    any number of other downloads. Only a clip of the video ("start" and "end", in seconds) or its
+    audio ("audio_only") can be requested, each stored under its own key.
+
+    Returns:
+        dict: A JSON object containing the store key of the download, its status ("downloading" or
+            "completed"), the URL of the video once it is completed and, for a clip or the audio,
+            the bytes saved over downloading the whole format.
+    """
+
+    client_id = client_id_of(http_request)
+    session_id = str(uuid.uuid4())
+    try:
+        await run_in_threadpool(admission.admit_client_download, client_id, session_id)
+    except AdmissionRejected as rejection:
+        raise too_many_requests(rejection)
+
+    try:
+        # The client has WATCH_TTL seconds to follow the download on /progress, before it counts as abandoned
+        store_key = await run_in_threadpool(start_download, request.task_id, request.format, f"http:{session_id}",
+                                            request.start, request.end, request.audio_only)
+        entry = await run_in_threadpool(video_store.get, store_key)
+    except Exception as e:
+        await run_in_threadpool(admission.release_client_download, client_id, session_id)
+        if isinstance(e, AdmissionRejected):
+            raise too_many_requests(e)
+        if isinstance(e, redis.RedisError):
+            raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if entry.get("status") == "completed":
+        await run_in_threadpool(video_store.release, store_key)
+        await run_in_threadpool(admission.release_client_download, client_id, session_id)
+        content = {"store_key": store_key, "status": "completed", "URL": entry["path"]}
+        if "bytes_saved" in entry:
+            content["bytes_saved"] = int(entry["bytes_saved"])
+        return JSONResponse(status_code=200, content=content)
+
+    # The download is followed in the background, nobody has to keep a connection open for it
+    hold = asyncio.create_task(hold_download(store_key, client_id, session_id))
+    held_downloads.add(hold)
+    hold.add_done_callback(held_downloads.discard)
+    return {"store_key": store_key, "status": "downloading"}
+
+@app.websocket("/progress")
+async def progress_stream_endpoint(websocket: WebSocket):
+
+    """
+    Push the progress of any number of downloads over a single websocket.
+
+    The client subscribes to, and unsubscribes from, downloads by their store key at any time, with
+    {"action": "subscribe" | "unsubscribe", "ids": [...]}. Every PROGRESS_FLUSH_INTERVAL, the server
+    sends {"type": "progress", "updates": {store_key: event}} with the latest event of every download
+    that changed. A download is unsubscribed after its final ("completed" or "error") event.
+    """
+
+    await websocket.accept()
+    ACTIVE_WEBSOCKETS.inc()
+    # A client can follow as many downloads as a batch holds
+    subscriptions = ProgressSubscriptions(progress_broker, download_state, config.batch_max_size,
+                                          watchers=watchers, watcher_id=str(uuid.uuid4()))
+    send_lock = asyncio.Lock()
+
+    async def send(message: dict):
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def flush():
+        while True:
+            try:
+                await asyncio.wait_for(subscriptions.changed.wait(), timeout=WatcherRegistry.WATCH_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+            await subscriptions.refresh()
+            updates = await subscriptions.take()
+            if updates:
+                await send({"type": "progress", "updates": updates})
+                now = time.time()
+                for event in updates.values():
+                    if event.get("time"):
+                        WEBSOCKET_SEND.observe(max(0.0, now - float(event["time"])))
+            # Whatever is published until the next flush is coalesced
+            await asyncio.sleep(config.progress_flush_interval)
+
+    flusher = asyncio.create_task(flush())
+    try:
+        while True:
+            message = await websocket.receive_json()
+            ids = message.get("ids") if isinstance(message, dict) else None
+            if not isinstance(ids, list) or not all(isinstance(store_key, str) for store_key in ids):
+                await send({"type": "error", "message": "Expected a list of store keys in \"ids\"."})
+                continue
+
+            if message.get("action") == "subscribe":
+                try:
+                    await subscriptions.subscribe(ids)
+                except ValueError as e:
+                    await send({"type": "error", "message": str(e)})
+            elif message.get("action") == "unsubscribe":
+                await subscriptions.unsubscribe(ids)
+            else:
+                await send({"type": "error", "message": "Unknown action, expected \"subscribe\" or \"unsubscribe\"."})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Progress stream failed: {e}")
+    finally:
+        flusher.cancel()
+        await subscriptions.close()
+        ACTIVE_WEBSOCKETS.dec()
+        if websocket.client_state == WebSocketState.CONNECTED and websocket.application_state == WebSocketState.CONNECTED:
+            await websocket.close(code=1000)
+
+@app.get("/video/stream/{task_id}")
+async def stream_video_endpoint(task_id: str, format: str, request: Request):
+
+    """
+    Stream a video to the client while it is being downloaded, instead of storing it first.
+
+    The video and audio are remuxed into a fragmented MP4 by a worker and relayed to the response
+    as they arrive, so the download starts within seconds and the video never touches the disk.
+    The trade-off is that the video is not shared with other requests and cannot be resumed.
+
+    Args:
+        task_id (str): The ID of the metadata task of the video.
+        format (str): The ID of the video format to stream.
+
+    Returns:
+        StreamingResponse: The video, as a fragmented MP4.
+    """
+
+    state, result = await run_in_threadpool(get_task_state_and_result, task_id)
+    if state != "SUCCESS":
+        raise HTTPException(status_code=409, detail="Invalid task ID/Too soon to make a request.")
+
+    stream_id = str(uuid.uuid4())
+    key = stream_key(stream_id)
+    client_id = client_id_of(request)
+
+    # A stream takes a download slot (counted in flight under its ID) for as long as the client reads it
+    try:
+        await run_in_threadpool(admission.admit_download)
+        await run_in_threadpool(admission.admit_client_download, client_id, stream_id)
+    except AdmissionRejected as rejection:
+        raise too_many_requests(rejection)
+    await run_in_threadpool(admission.register_download, stream_id)
+
+    async def release():
+        """Free the slots of the stream, and tell the worker to stop if it is still running."""
+        await async_redis_client.delete(reader_key(stream_id), key)
+        await run_in_threadpool(admission.finish_download, stream_id)
+        await run_in_threadpool(admission.release_client_download, client_id, stream_id)
+
+    # The reader key tells the worker someone is still reading, it must exist before the worker starts
+    await async_redis_client.set(reader_key(stream_id), 1, ex=READER_TTL)
+    try:
+        await run_in_threadpool(stream_video.apply_async,
+                                args=[stream_id, result.get("original_url"), format, result.get("id")])
+    except Exception:
+        await release()
+        raise HTTPException(status_code=503, detail="Failed to connect to task scheduling service.")
+
+    async def read_chunks(last_id: str):
+        """Read the next chunks of the stream, returning them with the ID of the last one."""
+        await async_redis_client.set(reader_key(stream_id), 1, ex=READER_TTL)
+        response = await async_redis_client.xread({key: last_id}, count=16, block=(READER_TTL // 2) * 1000)
+        entries = response[0][1] if response else []
+        if entries:
+            # Chunks are deleted once read, which lets the worker write more (backpressure)
+            await async_redis_client.xdel(key, *[entry_id for entry_id, _ in entries])
+        return entries
+
+    # Wait for the first chunk, so a failure to start the stream can still be reported with an error status
+    entries = []
+    last_id = "0-0"
+    waited = 0
+    while not entries:
+        entries = await read_chunks(last_id)
+        waited += READER_TTL // 2
+        if not entries and waited >= 120:
+            await release()
+            raise HTTPException(status_code=504, detail="The video stream did not start in time.")
+    if b"eof" in entries[0][1] and entries[0][1][b"error"]:
+        await release()
+        raise HTTPException(status_code=502, detail=entries[0][1][b"error"].decode("utf-8"))
+
+    async def relay():
+        nonlocal entries, last_id
+        stalled_since = None
+        registered_at = time.monotonic()
+        try:
+            while True:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    if b"eof" in fields:
+                        if fields[b"error"]:
+                            print(f"Stream {stream_id} failed: {fields[b'error'].decode('utf-8')}")
+                        return
+                    yield fields[b"data"]
+                entries = await read_chunks(last_id)
+
+                # Keep the stream counted in flight, the downloads without a heartbeat are dropped after a while
+                if time.monotonic() - registered_at > AdmissionController.STALE_AFTER / 2:
+                    await run_in_threadpool(admission.register_download, stream_id)
+                    registered_at = time.monotonic()
+
+                # Give up on a worker that stopped sending anything (e.g., it died)
+                if entries:
+                    stalled_since = None
+                elif stalled_since is None:
+                    stalled_since = time.monotonic()
+                elif time.monotonic() - stalled_since > 120:
+                    print(f"Stream {stream_id} stalled.")
+                    return
+        finally:
+            # Also reached when the client disconnects, which makes the worker stop
+            await release()
+
+    file_name = "".join(c for c in result.get("name", "video") if c.isalnum() or c in " -_").strip() or "video"
+    return StreamingResponse(relay(), media_type="video/mp4",
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}.mp4"'})
 
 
 @app.get("/video/details/{task_id}")
-def get_detailed_video_format_data(task_id: str):
+def get_detailed_video_format_data(task_id: str, request: Request):
 
     """
     Retrieve detailed information about a video processing task.
@@ -300,17 +1104,226 @@ def get_detailed_video_format_data(task_id: str):
     Returns:
         dict: A JSON object containing the task ID, status, and result (if available).
               - If the task is pending, returns the status as "pending".
-              - If the task is completed successfully, returns the status as "completed" with the result.
+              - If the task is completed successfully, returns the status as "completed" with the full yt-dlp metadata.
               - If the task has failed, been revoked, or is in a retry state, returns the status as "retry" with the error message.
               - Otherwise, returns the current task status in lowercase.
     """
 
     task = celery_app.AsyncResult(task_id)
-    if task.state == "PENDING":
-        return {"task_id": task_id, "status": "pending"}
-    elif task.state == "SUCCESS":
-        return {"task_id": task_id, "status": "completed", "result": (task.result)}
-    elif task.state == "FAILURE" or task.state =="REVOKED" or task.state == "RETRY":
-        return {"task_id": task_id, "status": "retry", "error": str(task.result)}
+    state = task.state
+
+    def build():
+        if state == "PENDING":
+            return {"task_id": task_id, "status": "pending"}
+        elif state == "SUCCESS":
+            # The full metadata is not part of the task result, it is stored on the side for a limited time
+            info = load_full_info(get_redis_fetch_client(), task.result.get("id"))
+            if info is None:
+                raise HTTPException(status_code=404, detail="The detailed metadata of this video has expired.")
+            return {"task_id": task_id, "status": "completed", "result": info}
+        elif state == "FAILURE" or state =="REVOKED" or state == "RETRY":
+            return {"task_id": task_id, "status": "retry", "error": str(task.result)}
+        else:
+            return {"task_id": task_id, "status": state.lower()}
+
+    # Unpacking the full metadata is expensive, a client that already has it gets a 304
+    return conditional_response(request, task_etag(task_id, state), build)
+
+
+@app.post("/batch")
+def submit_batch(request: BatchRequest, http_request: Request):
+
+    """
+    Submit a list of YouTube video URLs, or a YouTube playlist URL, to be downloaded as a batch.
+
+    The downloads are spread across the workers, with at most `concurrency` of them running at once.
+
+    Args:
+        request (BatchRequest): The URLs (or playlist URL), the format selector and the concurrency of the batch.
+
+    Returns:
+        dict: A JSON object containing the batch ID, its status and its number of videos (unknown for playlists).
+    """
+
+    if not health_monitor.is_available():
+        raise HTTPException(status_code=503, detail="Task processing service is unavailable.")
+
+    if bool(request.urls) == bool(request.playlist):
+        raise HTTPException(status_code=400, detail="Provide either a list of video URLs or a playlist URL.")
+
+    video_ids = None
+    playlist_url = None
+    if request.urls:
+        if len(request.urls) > config.batch_max_size:
+            raise HTTPException(status_code=400, detail=f"A batch cannot contain more than {config.batch_max_size} videos.")
+        # Duplicated videos are only downloaded once
+        video_ids = list(dict.fromkeys(extract_video_id(url) for url in request.urls))
     else:
-        return {"task_id": task_id, "status": task.state.lower()}
\ No newline at end of file
+        playlist_url = f"https://www.youtube.com/playlist?list={extract_playlist_id(request.playlist)}"
+
+    # A batch counts as one submission of its client, and is only started while downloads can be accepted
+    try:
+        admission.admit_download()
+        admission.admit_submission(client_id_of(http_request))
+    except AdmissionRejected as rejection:
+        raise too_many_requests(rejection)
+
+    concurrency = max(1, min(request.concurrency or config.batch_max_concurrency, config.batch_max_concurrency))
+    batch_id = str(uuid.uuid4())
+
+    try:
+        BatchTracker(get_redis_fetch_client(), batch_id, config.video_persistence_duration).create(request.format, video_ids)
+        run_batch.apply_async(args=[batch_id, video_ids, playlist_url, request.format, concurrency], task_id=batch_id)
+    except Exception:
+        raise HTTPException(status_code=503, detail="Failed to connect to task scheduling service.")
+
+    return {"batch_id": batch_id, "status": "processing", "total": len(video_ids) if video_ids is not None else None}
+
+
+@app.get("/batch/{batch_id}")
+def get_batch(batch_id: str):
+
+    """
+    Get the status of a batch, the state of each of its videos, and its overall progress.
+
+    Args:
+        batch_id (str): The ID of the batch.
+
+    Returns:
+        dict: A JSON object containing the batch ID, its status, counters, overall progress and videos.
+    """
+
+    snapshot = BatchTracker(get_redis_fetch_client(), batch_id, config.video_persistence_duration).snapshot()
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Unknown or expired batch.")
+    return {"batch_id": batch_id, **snapshot}
+
+
+@app.websocket("/batch/{batch_id}/progress")
+async def batch_progress_endpoint(websocket: WebSocket, batch_id: str):
+
+    """Push the progress of every video of a batch over a single websocket, until the batch is finished."""
+
+    await websocket.accept()
+    tracker = BatchTracker(get_redis_fetch_client(), batch_id, config.video_persistence_duration)
+
+    try:
+        # Subscribe before reading the current state, so the final event cannot be missed
+        async with progress_broker.watch(batch_progress_key(batch_id)) as events:
+            snapshot = await run_in_threadpool(tracker.snapshot)
+            if not snapshot:
+                raise Exception("Unknown or expired batch.")
+            await websocket.send_json({"type": "batch", "batch_id": batch_id, **snapshot})
+
+            if snapshot["status"] in ("expanding", "downloading"):
+                while True:
+                    event = await events.get()
+                    await websocket.send_json(event)
+                    if event.get("type") == "batch":
+                        break
+    except WebSocketDisconnect:
+        print("Client disconnected.")
+    except Exception as e:
+        print(e)
+        await websocket.send_json({"status": "error", "message": str(e)})
+    finally:
+        if websocket.client_state == WebSocketState.CONNECTED and websocket.application_state == WebSocketState.CONNECTED:
+            await websocket.close(code=1000)
+
+
+class ArchiveBuffer:
+    """A write-only, unseekable file that hands over what was written to it, to stream a zip file while it is built."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def read_video(store_key: str, file_name: str):
+    """Yield the contents of a stored video, from the local disk or from a node holding it."""
+    path = os.path.join(VIDEOS_DIR, store_key, file_name)
+    if os.path.isfile(path):
+        with open(path, "rb") as source:
+            yield from iter(lambda: source.read(1024 * 1024), b"")
+        return
+
+    holders = artifacts.locate(f"videos/{store_key}")
+    if not holders:
+        raise FileNotFoundError(f"No node holds the video {store_key}.")
+    with httpx.stream("GET", f"{random.choice(list(holders.values()))}/videos/{store_key}/{file_name}", timeout=30) as response:
+        response.raise_for_status()
+        yield from response.iter_bytes(1024 * 1024)
+
+def stream_batch_archive(batch_id: str):
+    """Build a zip archive of the videos of a batch, yielding it as it is written.
+
+    Videos are added in the order of the batch as soon as they are downloaded, so the archive
+    starts streaming before the whole batch is finished. Failed videos are skipped.
+    """
+    tracker = BatchTracker(get_redis_fetch_client(), batch_id, config.video_persistence_duration)
+    buffer = ArchiveBuffer()
+
+    # Videos are already compressed, so they are stored as is
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        index = 0
+        while True:
+            snapshot = tracker.snapshot()
+            if not snapshot:
+                break
+            items = snapshot["items"]
+
+            if index >= len(items):
+                if snapshot["status"] not in ("expanding", "downloading"):
+                    break
+                time.sleep(2)
+                continue
+
+            item = items[index]
+            if item["status"] == "failed":
+                index += 1
+                continue
+            if item["status"] != "completed":
+                time.sleep(2)
+                continue
+
+            # The URL of a stored video is /videos/<store_key>/<file name>
+            _, _, store_key, file_name = item["URL"].split("/", 3)
+            touch_video(store_key)
+            with archive.open(f"{index + 1:03d}-{item['video_id']}{Path(file_name).suffix}", "w", force_zip64=True) as target:
+                for chunk in read_video(store_key, file_name):
+                    target.write(chunk)
+                    yield buffer.take()
+            index += 1
+
+    yield buffer.take()
+
+
+@app.get("/batch/{batch_id}/archive")
+def get_batch_archive(batch_id: str):
+
+    """
+    Download the videos of a batch as a single zip archive, streamed while it is being built.
+
+    Args:
+        batch_id (str): The ID of the batch.
+
+    Returns:
+        StreamingResponse: The zip archive.
+    """
+
+    if not BatchTracker(get_redis_fetch_client(), batch_id, config.video_persistence_duration).snapshot():
+        raise HTTPException(status_code=404, detail="Unknown or expired batch.")
+    return StreamingResponse(stream_batch_archive(batch_id), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="batch-{batch_id}.zip"'})
+
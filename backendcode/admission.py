@@ -0,0 +1,263 @@
+import math
+import time
+import uuid
+
+import redis
+
+from backendcode.celery_config import celery_app
+
+
+class AdmissionRejected(Exception):
+    """Raised when new work cannot be accepted right now.
+
+    Attributes:
+        reason (str): Why the work was rejected, meant to be shown to the user.
+        retry_after (int): The number of seconds after which the work is likely to be accepted.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, min(AdmissionController.MAX_RETRY_AFTER, math.ceil(retry_after)))
+
+
+class AdmissionController:
+    """Accept or reject new work early, from the load of the queues and of the downloads in flight.
+
+    The controller keeps, in Redis, what every API process and worker needs to share:
+        - the downloads in flight (queued or running) with their last heartbeat, and their current speed,
+        - the completion times of recent extractions and downloads, from which the rate at which each
+          queue drains (and so how long new work will wait) is estimated,
+        - a moving average of how long extractions and downloads take, used while no rate is known yet,
+        - per client, the extractions submitted in the last minute and the downloads being followed,
+          so a single client cannot take the whole capacity,
+        - per queue, how many tasks the workers consuming it run at once, which they announce periodically.
+    The depth of the queues is read from the Celery broker.
+    """
+
+    DOWNLOADS_KEY = "admission:downloads"
+    BANDWIDTH_KEY = "admission:bandwidth"
+    COMPLETED_PREFIX = "admission:completed"
+    DURATIONS_KEY = "admission:durations"
+    CLIENT_PREFIX = "admission:client"
+    CAPACITY_PREFIX = "admission:capacity"
+
+    # Downloads without a heartbeat (or still queued) for this long are not counted anymore
+    STALE_AFTER = 3600
+    # Seconds of completions the drain rates are measured over
+    RATE_WINDOW = 300
+    # Weight of the latest duration in the moving averages
+    SMOOTHING = 0.2
+    # Duration assumed for a task of a kind that never completed yet
+    DEFAULT_DURATIONS = {"metadata": 5.0, "downloads": 60.0}
+    # The longest a client is told to wait
+    MAX_RETRY_AFTER = 300
+    # How often the workers announce their concurrency, and how long an announcement counts
+    CAPACITY_INTERVAL = 30
+    CAPACITY_TTL = 90
+
+    def __init__(self, redis_client: redis.Redis, broker_client: redis.Redis = None, max_queued_extractions: int = 0,
+                 extraction_expires: int = 0, max_downloads: int = 0, max_bandwidth: int = 0,
+                 client_extractions_per_minute: int = 0, client_downloads: int = 0):
+        self.redis_client = redis_client
+        # Only the API, which admits the work, needs to read the queues
+        self.broker_client = broker_client
+        self.max_queued_extractions = max_queued_extractions
+        self.extraction_expires = extraction_expires
+        self.max_downloads = max_downloads
+        self.max_bandwidth = max_bandwidth
+        self.client_extractions_per_minute = client_extractions_per_minute
+        self.client_downloads = client_downloads
+
+    # Admission, called by the API
+
+    def admit_extraction(self, client_id: str):
+        """Accept a new extraction, or raise AdmissionRejected."""
+        queued = self.queue_depth("metadata")
+        if queued >= self.max_queued_extractions:
+            raise AdmissionRejected("The server is busy, please try again shortly.",
+                                    self.drain_time("metadata", queued - self.max_queued_extractions + 1))
+        # An extraction that waits longer than its expiry would be dropped by the worker anyway
+        wait = self.drain_time("metadata", queued)
+        if wait >= self.extraction_expires:
+            raise AdmissionRejected("The server is busy, please try again shortly.", wait - self.extraction_expires + 1)
+        self.admit_submission(client_id)
+
+    def admit_submission(self, client_id: str):
+        """Count a submission (an extraction or a batch) against the per-minute limit of a client, or raise AdmissionRejected."""
+        window_key = f"{self.CLIENT_PREFIX}:{client_id}:submissions"
+        now = time.time()
+        pipe = self.redis_client.pipeline()
+        pipe.zremrangebyscore(window_key, "-inf", now - 60)
+        pipe.zrange(window_key, 0, 0, withscores=True)
+        pipe.zcard(window_key)
+        _, oldest, submitted = pipe.execute()
+        if submitted >= self.client_extractions_per_minute:
+            raise AdmissionRejected("Too many videos submitted, please slow down.", oldest[0][1] + 60 - now)
+
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(window_key, {str(uuid.uuid4()): now})
+        pipe.expire(window_key, 60)
+        pipe.execute()
+
+    def admit_download(self):
+        """Accept a new download (one that is not already stored or being made), or raise AdmissionRejected."""
+        in_flight = self.downloads_in_flight()
+        if in_flight >= self.max_downloads:
+            raise AdmissionRejected("Too many downloads are in progress, please try again shortly.",
+                                    self.drain_time("downloads", in_flight - self.max_downloads + 1))
+        if self.max_bandwidth and self.bandwidth() >= self.max_bandwidth:
+            raise AdmissionRejected("The server is out of bandwidth, please try again shortly.",
+                                    self.drain_time("downloads", 1))
+
+    def admit_client_download(self, client_id: str, session_id: str):
+        """Accept a client following one more download, or raise AdmissionRejected.
+
+        The session must be released with release_client_download once it ends.
+        """
+        key = f"{self.CLIENT_PREFIX}:{client_id}:downloads"
+        now = time.time()
+        pipe = self.redis_client.pipeline()
+        pipe.zremrangebyscore(key, "-inf", now - self.STALE_AFTER)
+        pipe.zcard(key)
+        if pipe.execute()[-1] >= self.client_downloads:
+            raise AdmissionRejected("You have too many downloads in progress, wait for one of them to finish.",
+                                    self.drain_time("downloads", 1))
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(key, {session_id: now})
+        pipe.expire(key, self.STALE_AFTER)
+        pipe.execute()
+
+    def release_client_download(self, client_id: str, session_id: str):
+        """Record that a client stopped following a download."""
+        self.redis_client.zrem(f"{self.CLIENT_PREFIX}:{client_id}:downloads", session_id)
+
+    def register_download(self, download_id: str):
+        """Count a newly scheduled download as in flight, until its worker finishes it."""
+        self.redis_client.zadd(self.DOWNLOADS_KEY, {download_id: time.time()})
+
+    # Accounting, called by the workers
+
+    def heartbeat(self, download_id: str, speed: float, pipe=None):
+        """Record that a download is still running at the given speed (bytes/s), optionally as part of a pipeline."""
+        client = pipe if pipe is not None else self.redis_client.pipeline(transaction=False)
+        client.zadd(self.DOWNLOADS_KEY, {download_id: time.time()})
+        client.hset(self.BANDWIDTH_KEY, download_id, speed or 0)
+        if pipe is None:
+            client.execute()
+
+    def finish_download(self, download_id: str, duration: float = None):
+        """Record that a download finished (successfully or not), freeing its slot."""
+        pipe = self.redis_client.pipeline()
+        pipe.zrem(self.DOWNLOADS_KEY, download_id)
+        pipe.hdel(self.BANDWIDTH_KEY, download_id)
+        pipe.execute()
+        if duration is not None:
+            self.record_completion("downloads", duration)
+
+    def record_completion(self, kind: str, duration: float):
+        """Record that a task of the given kind ("metadata" or "downloads") completed after `duration` seconds."""
+        now = time.time()
+        completed_key = f"{self.COMPLETED_PREFIX}:{kind}"
+        average = self.redis_client.hget(self.DURATIONS_KEY, kind)
+        average = duration if average is None else (1 - self.SMOOTHING) * float(average) + self.SMOOTHING * duration
+
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(completed_key, {str(uuid.uuid4()): now})
+        pipe.zremrangebyscore(completed_key, "-inf", now - self.RATE_WINDOW)
+        pipe.hset(self.DURATIONS_KEY, kind, average)
+        pipe.execute()
+
+    def announce_capacity(self, hostname: str, queues: list[str], concurrency: int):
+        """Record that a worker runs `concurrency` tasks at once from the given queues, for CAPACITY_TTL seconds."""
+        now = time.time()
+        pipe = self.redis_client.pipeline()
+        for queue in queues:
+            key = f"{self.CAPACITY_PREFIX}:{queue}"
+            pipe.zadd(key, {hostname: now})
+            pipe.hset(f"{key}:concurrency", hostname, concurrency)
+        pipe.execute()
+
+    # Load
+
+    def capacity(self, queue: str) -> int:
+        """Return how many tasks of a queue the live workers run at once (0 if none announced itself)."""
+        key = f"{self.CAPACITY_PREFIX}:{queue}"
+        pipe = self.redis_client.pipeline()
+        pipe.zremrangebyscore(key, "-inf", time.time() - self.CAPACITY_TTL)
+        pipe.zrange(key, 0, -1)
+        pipe.hgetall(f"{key}:concurrency")
+        _, live, concurrency = pipe.execute()
+        return sum(int(concurrency.get(hostname, 0)) for hostname in live)
+
+    def queue_depth(self, queue: str) -> int:
+        """Return the number of messages waiting in a Celery queue, across all of its priority lists."""
+        options = celery_app.conf.broker_transport_options
+        sep = options.get("sep", ":")
+        pipe = self.broker_client.pipeline(transaction=False)
+        for priority in options.get("priority_steps", [0]):
+            pipe.llen(f"{queue}{sep}{priority}" if priority else queue)
+        return sum(pipe.execute())
+
+    def downloads_in_flight(self) -> int:
+        """Return the number of downloads that are queued or running."""
+        pipe = self.redis_client.pipeline()
+        pipe.zremrangebyscore(self.DOWNLOADS_KEY, "-inf", time.time() - self.STALE_AFTER)
+        pipe.zcard(self.DOWNLOADS_KEY)
+        return pipe.execute()[-1]
+
+    def bandwidth(self) -> float:
+        """Return the combined speed (bytes/s) of the running downloads."""
+        live = {member for member in self.redis_client.zrangebyscore(
+            self.DOWNLOADS_KEY, time.time() - self.STALE_AFTER, "+inf")}
+        speeds = self.redis_client.hgetall(self.BANDWIDTH_KEY)
+        stale = [download_id for download_id in speeds if download_id not in live]
+        if stale:
+            self.redis_client.hdel(self.BANDWIDTH_KEY, *stale)
+        return sum(float(speed) for download_id, speed in speeds.items() if download_id in live)
+
+    def drain_time(self, kind: str, count: int) -> float:
+        """Estimate how many seconds it takes for `count` tasks of the given kind to complete.
+
+        Running them in waves of as many tasks as the workers of the queue run at once (at the average
+        duration of a task) is the upper bound. The rate at which tasks completed recently tells how
+        much faster the workers actually go, but it only measures capacity while the queue is busy, so
+        it can only lower the estimate.
+        """
+        if count <= 0:
+            return 0.0
+        now = time.time()
+        completed_key = f"{self.COMPLETED_PREFIX}:{kind}"
+        pipe = self.redis_client.pipeline()
+        pipe.zremrangebyscore(completed_key, "-inf", now - self.RATE_WINDOW)
+        pipe.zrange(completed_key, 0, 0, withscores=True)
+        pipe.zcard(completed_key)
+        pipe.hget(self.DURATIONS_KEY, kind)
+        _, oldest, completed, average = pipe.execute()
+
+        average = float(average or self.DEFAULT_DURATIONS[kind])
+        serial = math.ceil(count / max(1, self.capacity(kind))) * average
+        if completed >= 2:
+            # A burst of completions says little about the rate, so the span is at least one task long
+            return min(serial, count * max(now - oldest[0][1], average) / completed)
+        return serial
+
+    def estimate(self) -> dict:
+        """Return the current load and the estimated time new work waits before it starts."""
+        queued_extractions = self.queue_depth("metadata")
+        queued_downloads = self.queue_depth("downloads")
+        return {
+            "metadata": {
+                "queued": queued_extractions,
+                "estimated_wait": round(self.drain_time("metadata", queued_extractions), 1),
+                "limit": self.max_queued_extractions,
+            },
+            "downloads": {
+                "queued": queued_downloads,
+                "in_flight": self.downloads_in_flight(),
+                "bandwidth": round(self.bandwidth()),
+                "estimated_wait": round(self.drain_time("downloads", queued_downloads), 1),
+                "limit": self.max_downloads,
+                "bandwidth_limit": self.max_bandwidth,
+            },
+        }
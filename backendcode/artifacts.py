@@ -0,0 +1,91 @@
+import time
+
+import redis
+
+
+def node_queue(node: str) -> str:
+    """Return the Celery queue only the workers of a node consume (copies and deletions of its files)."""
+    return f"node.{node}"
+
+
+class ArtifactRegistry:
+    """Record which nodes hold each stored file, when the nodes do not share their disks.
+
+    Every node runs a file server and announces it with a heartbeat, which keeps it in the set of
+    live nodes. A node registers every video it stores (by artifact name, "videos/<store_key>"),
+    so the API knows where to send the requests for it. The hits of an artifact are counted per
+    minute, to find the ones worth copying to more nodes.
+    """
+
+    NODES_KEY = "nodes"
+    ALIVE_KEY = "nodes:alive"
+    LOCATION_PREFIX = "artifact:nodes"
+    HITS_PREFIX = "artifact:hits"
+    REPLICATING_PREFIX = "artifact:replicating"
+
+    # A node that did not announce itself for this long is considered down
+    NODE_TTL = 90
+    # How often a node announces itself
+    HEARTBEAT_INTERVAL = 30
+    # The window the hits of an artifact are counted over, in seconds
+    HIT_WINDOW = 60
+    # How long a copy of an artifact to a node is given before another one can be started
+    REPLICATION_TIMEOUT = 600
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+
+    def _location_key(self, artifact: str) -> str:
+        return f"{self.LOCATION_PREFIX}:{artifact}"
+
+    def heartbeat(self, node: str, url: str):
+        """Announce that a node is up, and the URL of its file server."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hset(self.NODES_KEY, node, url)
+        pipe.zadd(self.ALIVE_KEY, {node: time.time()})
+        pipe.execute()
+
+    def alive_nodes(self) -> dict[str, str]:
+        """Return the URL of the file server of every live node, by node name."""
+        nodes = self.redis_client.zrangebyscore(self.ALIVE_KEY, time.time() - self.NODE_TTL, "+inf")
+        if not nodes:
+            return {}
+        urls = self.redis_client.hmget(self.NODES_KEY, nodes)
+        return {node.decode("utf-8"): url.decode("utf-8") for node, url in zip(nodes, urls) if url is not None}
+
+    def add(self, artifact: str, node: str):
+        """Record that a node holds an artifact."""
+        self.redis_client.sadd(self._location_key(artifact), node)
+
+    def remove(self, artifact: str, node: str):
+        """Record that a node no longer holds an artifact."""
+        self.redis_client.srem(self._location_key(artifact), node)
+
+    def holders(self, artifact: str) -> set[str]:
+        """Return every node recorded as holding an artifact, live or not."""
+        return {node.decode("utf-8") for node in self.redis_client.smembers(self._location_key(artifact))}
+
+    def locate(self, artifact: str) -> dict[str, str]:
+        """Return the live nodes holding an artifact, with the URLs of their file servers."""
+        holders = self.holders(artifact)
+        return {node: url for node, url in self.alive_nodes().items() if node in holders}
+
+    def forget(self, artifact: str) -> set[str]:
+        """Drop the locations of a deleted artifact, returning the nodes that held it."""
+        pipe = self.redis_client.pipeline()
+        pipe.smembers(self._location_key(artifact))
+        pipe.delete(self._location_key(artifact), f"{self.HITS_PREFIX}:{artifact}")
+        return {node.decode("utf-8") for node in pipe.execute()[0]}
+
+    def record_hit(self, artifact: str) -> int:
+        """Count a request for an artifact, returning its hits in the current window."""
+        key = f"{self.HITS_PREFIX}:{artifact}"
+        pipe = self.redis_client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.HIT_WINDOW, nx=True)
+        return pipe.execute()[0]
+
+    def claim_replication(self, artifact: str, node: str) -> bool:
+        """Take the right to copy an artifact to a node, so concurrent requests start a single copy."""
+        return bool(self.redis_client.set(f"{self.REPLICATING_PREFIX}:{artifact}:{node}", 1,
+                                          nx=True, ex=self.REPLICATION_TIMEOUT))
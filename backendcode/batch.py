@@ -0,0 +1,111 @@
+import json
+
+import redis
+
+from backendcode.progress import progress_channel
+
+BATCH_PREFIX = "batch"
+
+
+def batch_progress_key(batch_id: str) -> str:
+    """Return the key the progress events of a whole batch are published under."""
+    return f"{BATCH_PREFIX}:{batch_id}"
+
+
+class BatchTracker:
+    """Record the state of a batch of downloads and publish it on a single progress channel.
+
+    A batch is stored as two hashes that expire together:
+        - batch:<id> holds the batch itself (status, format, total, completed and failed counts),
+        - batch:<id>:items maps the index of every video to its JSON-encoded state.
+    Every update of an item is also published on the progress channel of the batch, so one
+    subscription is enough to follow all of its videos. Events about a single video have the
+    type "item", the final event of the whole batch has the type "batch".
+    """
+
+    def __init__(self, redis_client: redis.Redis, batch_id: str, ttl: int):
+        self.redis_client = redis_client
+        self.batch_id = batch_id
+        self.ttl = ttl
+        self.key = batch_progress_key(batch_id)
+        self.items_key = f"{self.key}:items"
+        self.channel = progress_channel(self.key)
+
+    def create(self, video_format: str, video_ids: list[str] | None):
+        """Record a new batch. Without video IDs (playlists), the videos are set once expanded."""
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self.key, mapping={"status": "expanding", "format": video_format,
+                                     "total": 0, "completed": 0, "failed": 0})
+        pipe.expire(self.key, self.ttl)
+        pipe.execute()
+        if video_ids is not None:
+            self.set_videos(video_ids)
+
+    def set_videos(self, video_ids: list[str]):
+        """Record the videos of the batch, all of them waiting to be downloaded."""
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self.key, mapping={"status": "downloading", "total": len(video_ids)})
+        if video_ids:
+            pipe.hset(self.items_key, mapping={
+                index: json.dumps({"video_id": video_id, "status": "queued", "progress": "0%"})
+                for index, video_id in enumerate(video_ids)
+            })
+        pipe.expire(self.items_key, self.ttl)
+        pipe.execute()
+
+    def update_item(self, index: int, item: dict, pipe=None):
+        """Record the state of a video of the batch, optionally as part of a pipeline."""
+        client = pipe if pipe is not None else self.redis_client.pipeline(transaction=False)
+        client.hset(self.items_key, index, json.dumps(item))
+        client.publish(self.channel, json.dumps({"type": "item", "index": index, **item}))
+        if pipe is None:
+            client.execute()
+
+    def finish_item(self, index: int, item: dict):
+        """Record that a video of the batch was downloaded (or failed) and publish the batch counters."""
+        counter = "completed" if item["status"] == "completed" else "failed"
+
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self.items_key, index, json.dumps(item))
+        pipe.hincrby(self.key, counter, 1)
+        pipe.hmget(self.key, "total", "completed", "failed")
+        total, completed, failed = (int(value or 0) for value in pipe.execute()[-1])
+        self.redis_client.publish(self.channel, json.dumps({"type": "item", "index": index, **item, "total": total,
+                                                            "completed": completed, "failed": failed}))
+
+    def finish(self, status: str = "completed", message: str = None):
+        """Record the end of the batch and publish it as its terminal event."""
+        self.redis_client.hset(self.key, "status", status)
+        event = {"type": "batch", "status": status if status == "completed" else "error", **self.snapshot()["counts"]}
+        if message:
+            event["message"] = message
+        self.redis_client.publish(self.channel, json.dumps(event))
+
+    def snapshot(self) -> dict:
+        """Return the batch with every video and its overall progress, or an empty dictionary if unknown."""
+        batch = {k.decode("utf-8"): v.decode("utf-8") for k, v in self.redis_client.hgetall(self.key).items()}
+        if not batch:
+            return {}
+        items = {int(index): json.loads(item) for index, item in self.redis_client.hgetall(self.items_key).items()}
+        items = [items[index] for index in sorted(items)]
+
+        total = int(batch["total"])
+        counts = {"total": total, "completed": int(batch["completed"]), "failed": int(batch["failed"])}
+        # Finished videos count as a whole, the others by their own progress
+        done = sum(100.0 if item["status"] in ("completed", "failed") else _percentage(item.get("progress"))
+                   for item in items)
+        return {
+            "status": batch["status"],
+            "format": batch["format"],
+            "counts": counts,
+            "progress": f"{done / total:.1f}%" if total else "0%",
+            "items": items,
+        }
+
+
+def _percentage(value) -> float:
+    """Parse a yt-dlp percentage string such as ' 42.0%'."""
+    try:
+        return float(str(value).strip().rstrip("%"))
+    except ValueError:
+        return 0.0
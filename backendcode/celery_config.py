@@ -1,4 +1,7 @@
+import time
+
 from celery import Celery
+from celery.signals import before_task_publish
 from dotenv import load_dotenv
 from backendcode.data_models import EnvironmentVariablesConfig
 
@@ -18,6 +21,47 @@ celery_app = Celery(
 
 celery_app.conf.update(
     task_serializer="json",
-    accept_content=["json"],
+    # Results (video metadata in particular) are stored as compressed msgpack to keep them small in Redis
+    result_serializer="msgpack",
+    result_compression="zlib",
+    accept_content=["json", "msgpack"],
+    result_accept_content=["msgpack"],
     result_expires=3600,  # Task results expire after 1 hour
+
+    # Every kind of work gets its own queue, consumed by workers whose pool suits it (see docker-compose.yml):
+    #   - metadata: short, latency-sensitive extractions the user is waiting for
+    #   - downloads: long downloads and streams, which would otherwise hold back the extractions
+    #   - maintenance: batch bookkeeping (playlist expansion, batch completion)
+    #   - node.<node name>: copies and deletions of the files of a node, when the nodes do not share their disks
+    #     (replicate_artifact and delete_artifact are always sent to the queue of a node explicitly)
+    task_routes={
+        "backendcode.tasks.extract_info": {"queue": "metadata", "priority": 0},
+        # Streams and single downloads have someone waiting on them, batches can wait a little longer
+        "backendcode.tasks.stream_video": {"queue": "downloads", "priority": 1},
+        "backendcode.tasks.download_video": {"queue": "downloads", "priority": 3},
+        "backendcode.tasks.batch_item": {"queue": "downloads", "priority": 6},
+        "backendcode.tasks.run_batch": {"queue": "maintenance"},
+        "backendcode.tasks.finish_batch": {"queue": "maintenance"},
+    },
+    task_default_queue="maintenance",
+    task_default_priority=5,
+    broker_transport_options={
+        # With Redis, priority 0 is the highest. Every priority gets its own list instead of 4 buckets.
+        "priority_steps": list(range(10)),
+        "sep": ":",
+        # A worker consuming several queues drains them in the order they are given (metadata first)
+        "queue_order_strategy": "priority",
+        # Downloads can take hours, a message must not be redelivered while it is still being processed
+        "visibility_timeout": 6 * 3600,
+    },
+    # Workers only reserve the tasks they can start right away, so a long download never holds back
+    # the tasks queued behind it. The metadata workers raise it on their command line, since their tasks are short.
+    worker_prefetch_multiplier=1,
 )
+
+
+# Connected here rather than in tasks.py, since the API publishes its tasks by name and never imports them
+@before_task_publish.connect
+def stamp_publish_time(headers=None, **kwargs):
+    # Lets the worker measure how long the task waited in its queue
+    headers["published_at"] = time.time()
@@ -0,0 +1,181 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+
+# Take the lease of a download, or keep it if this execution already holds it
+TAKE_LEASE = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return holder
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return ARGV[1]
+"""
+
+# Extend, or drop, the lease only if this execution still holds it
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# The files yt-dlp leaves behind while a download is incomplete: the partial file of a direct download,
+# the fragments of a fragmented one, and the state file it resumes the fragments (or the ranges) from
+PARTIAL_SUFFIXES = (".part", ".ytdl")
+
+
+def is_partial_file(name: str) -> bool:
+    """Check whether a file is part of an incomplete download."""
+    return name.endswith(PARTIAL_SUFFIXES) or ".part-Frag" in name
+
+
+class DownloadCheckpoint:
+    """The durable state of a download, so it can resume where it stopped after its worker died.
+
+    The files are the true checkpoint: every download of a video goes to the same directory on the
+    shared volume, where yt-dlp continues the partial files (and the fragments) it finds. Alongside,
+    a Redis hash records what the download selects (so the files are only continued by the same
+    selection), how far every file got (bytes and fragments) and how many times it was attempted, and
+    a lease tells which execution of the task is writing the files. With acks_late, a task can be
+    delivered again while its first execution is still running; the lease keeps the second one from
+    writing the same files, until the first one stops renewing it.
+    """
+
+    KEY_PREFIX = "checkpoint"
+
+    # Seconds a lease lasts without being renewed, it is renewed every third of it
+    LEASE_TTL = 60
+    # How long the checkpoint of a download that stopped is kept
+    TTL = 7 * 24 * 3600
+
+    def __init__(self, redis_client: redis.Redis, store_key: str):
+        self.redis_client = redis_client
+        self.store_key = store_key
+        # Identifies this execution, a redelivered task runs under the same task ID
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._take_lease = redis_client.register_script(TAKE_LEASE)
+        self._renew_lease = redis_client.register_script(RENEW_LEASE)
+        self._release_lease = redis_client.register_script(RELEASE_LEASE)
+        # The latest progress of every file, written along with the progress of the download
+        self._files = {}
+
+    @classmethod
+    def key(cls, store_key: str) -> str:
+        return f"{cls.KEY_PREFIX}:{store_key}"
+
+    @classmethod
+    def lease_key(cls, store_key: str) -> str:
+        return f"{cls.KEY_PREFIX}:{store_key}:lease"
+
+    def take_lease(self) -> str | None:
+        """Take the lease of the download. Returns None on success, otherwise the execution holding it."""
+        holder = self._take_lease(keys=[self.lease_key(self.store_key)], args=[self.holder, self.LEASE_TTL])
+        holder = holder.decode("utf-8")
+        return None if holder == self.holder else holder
+
+    def release_lease(self):
+        self._release_lease(keys=[self.lease_key(self.store_key)], args=[self.holder])
+
+    @contextmanager
+    def keep_alive(self, heartbeat=None):
+        """Renew the lease in the background while the block runs, calling `heartbeat` along with it.
+
+        Progress hooks stop firing while ffmpeg merges the streams, which can take minutes for a large
+        video, so the lease cannot rely on them.
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.LEASE_TTL / 3):
+                try:
+                    self._renew_lease(keys=[self.lease_key(self.store_key)], args=[self.holder, self.LEASE_TTL])
+                    if heartbeat is not None:
+                        heartbeat()
+                except redis.RedisError as e:
+                    print(f"Failed to renew the lease of {self.store_key}: {e}")
+
+        thread = threading.Thread(target=renew, name=f"lease-{self.store_key}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def start_attempt(self, resumed_bytes: int, selection: str) -> int:
+        """Record a new attempt at the download, what it selects and the bytes it resumes from. Returns the attempt number."""
+        pipe = self.redis_client.pipeline()
+        pipe.hincrby(self.key(self.store_key), "attempts", 1)
+        pipe.hset(self.key(self.store_key), mapping={
+            "holder": self.holder, "selection": selection, "resumed_bytes": resumed_bytes, "updated": time.time(),
+        })
+        pipe.expire(self.key(self.store_key), self.TTL)
+        return pipe.execute()[0]
+
+    def hook(self, d):
+        """A yt-dlp progress hook keeping the offsets of every file, for the next write."""
+        if d['status'] not in ('downloading', 'finished'):
+            return
+        self._files[os.path.basename(d.get('filename') or '')] = {
+            "status": d['status'],
+            "downloaded_bytes": d.get('downloaded_bytes') or 0,
+            "total_bytes": d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+            "fragment_index": d.get('fragment_index'),
+            "fragment_count": d.get('fragment_count'),
+        }
+
+    def write(self, pipe):
+        """Write the offsets of every file as part of a pipeline (the one of the progress writes)."""
+        if not self._files:
+            return
+        mapping = {f"file:{name}": json.dumps(state) for name, state in self._files.items()}
+        pipe.hset(self.key(self.store_key), mapping={**mapping, "updated": time.time()})
+        pipe.expire(self.key(self.store_key), self.TTL)
+
+    def load(self) -> dict:
+        """Return the checkpoint of the download: its attempts, and the offsets of its files by file name."""
+        raw = self.redis_client.hgetall(self.key(self.store_key))
+        checkpoint = {"files": {}}
+        for field, value in raw.items():
+            field, value = field.decode("utf-8"), value.decode("utf-8")
+            if field.startswith("file:"):
+                checkpoint["files"][field[len("file:"):]] = json.loads(value)
+            else:
+                checkpoint[field] = value
+        return checkpoint
+
+    def clear(self):
+        """Forget the checkpoint of a download that completed."""
+        self.redis_client.delete(self.key(self.store_key))
+
+
+def existing_bytes(directory: str) -> int:
+    """Return the bytes a previous attempt left in the directory of a download (partial files and finished streams)."""
+    try:
+        sizes = {entry.name: entry.stat().st_size for entry in os.scandir(directory) if entry.is_file()}
+    except FileNotFoundError:
+        return 0
+    for name in [name for name in sizes if name.endswith(".ytdl")]:
+        # The partial file of a parallel download is preallocated, its state tells the ranges still missing
+        partial = name[:-len(".ytdl")] + ".part"
+        try:
+            with open(os.path.join(directory, name)) as state_file:
+                state = json.load(state_file).get("parallel")
+            if state and partial in sizes:
+                sizes[partial] = state["total"] - sum(end - start for start, end in state["missing"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            continue
+    return sum(sizes.values())
@@ -1,6 +1,8 @@
 import os
+import socket
 from dotenv import load_dotenv
 from pathlib import Path
+from pydantic import BaseModel
 
 load_dotenv()
 
@@ -26,6 +28,56 @@ class EnvironmentVariablesConfig:
     thumbnail_persistence_duration: int
     video_persistence_duration: int
 
+    # How long extracted metadata is reused for the same video ID, and how many videos are kept
+    metadata_cache_ttl: int
+    metadata_cache_max_entries: int
+
+    # Minimum number of seconds between two progress writes of a download
+    progress_update_interval: float
+    # How often the progress stream sends the updates it coalesced
+    progress_flush_interval: float
+
+    # The maximum number of videos in a batch, and of downloads a batch can run at once
+    batch_max_size: int
+    batch_max_concurrency: int
+
+    # The maximum number of bytes the videos and thumbnails can take on disk, and how often the storage is swept
+    storage_quota_bytes: int
+    storage_sweep_interval: int
+
+    # The load above which new work is rejected: extractions waiting in the queue, downloads in flight,
+    # combined download speed (bytes/s, 0 for no limit), and what a single client can submit or follow
+    admission_max_queued_extractions: int
+    admission_max_downloads: int
+    admission_max_bandwidth: int
+    admission_client_extractions_per_minute: int
+    admission_client_downloads: int
+
+    # The port the Celery workers expose their Prometheus metrics on (0 to disable), and how long traces are kept
+    worker_metrics_port: int
+    trace_ttl: int
+
+    # Seconds a download keeps running once nobody waits for it anymore, before it is cancelled (0 to disable)
+    download_cancel_grace: int
+    # The connections a download fetches a file (or the fragments of a stream) over at once
+    download_connections: int
+
+    # The picks a duration bucket needs before its likeliest format is prefetched (0 to disable the prefetch),
+    # and the share of those picks the format must have
+    prefetch_min_picks: int
+    prefetch_min_share: float
+
+    # The name of this node, the port its file server listens on (0 when the videos are on a shared volume)
+    # and the URL the other nodes reach it at
+    node_name: str
+    file_server_port: int
+    node_url: str
+    # How the API serves the videos stored on another node: "proxy" or "redirect"
+    artifact_serving: str
+    # Hits per minute above which a video is copied to another node, and the most copies a video gets
+    replication_hot_hits: int
+    replication_max_copies: int
+
     def __new__(cls) -> "EnvironmentVariablesConfig":
         if cls._instance is None:
             cls._instance = object.__new__(cls)
@@ -52,6 +104,124 @@ class EnvironmentVariablesConfig:
         except ValueError:
             raise ValueError("Environment variable VIDEO_PERSISTANCE_DURATION must be an integer.")
 
+        try:
+            self.progress_update_interval = float(os.getenv("PROGRESS_UPDATE_INTERVAL", 1.0))
+        except ValueError:
+            raise ValueError("Environment variable PROGRESS_UPDATE_INTERVAL must be a number.")
+
+        try:
+            self.progress_flush_interval = float(os.getenv("PROGRESS_FLUSH_INTERVAL", 0.5))
+        except ValueError:
+            raise ValueError("Environment variable PROGRESS_FLUSH_INTERVAL must be a number.")
+
+        try:
+            self.batch_max_size = int(os.getenv("BATCH_MAX_SIZE", 100))
+        except ValueError:
+            raise ValueError("Environment variable BATCH_MAX_SIZE must be an integer.")
+
+        try:
+            self.batch_max_concurrency = int(os.getenv("BATCH_MAX_CONCURRENCY", 4))
+        except ValueError:
+            raise ValueError("Environment variable BATCH_MAX_CONCURRENCY must be an integer.")
+
+        try:
+            self.metadata_cache_ttl = int(os.getenv("METADATA_CACHE_TTL", 600))
+        except ValueError:
+            raise ValueError("Environment variable METADATA_CACHE_TTL must be an integer.")
+
+        try:
+            self.metadata_cache_max_entries = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", 1000))
+        except ValueError:
+            raise ValueError("Environment variable METADATA_CACHE_MAX_ENTRIES must be an integer.")
+
+        try:
+            self.storage_quota_bytes = int(os.getenv("STORAGE_QUOTA_BYTES", 10 * 1024 ** 3))
+        except ValueError:
+            raise ValueError("Environment variable STORAGE_QUOTA_BYTES must be an integer.")
+
+        try:
+            self.storage_sweep_interval = int(os.getenv("STORAGE_SWEEP_INTERVAL", 60))
+        except ValueError:
+            raise ValueError("Environment variable STORAGE_SWEEP_INTERVAL must be an integer.")
+
+        try:
+            self.admission_max_queued_extractions = int(os.getenv("ADMISSION_MAX_QUEUED_EXTRACTIONS", 50))
+        except ValueError:
+            raise ValueError("Environment variable ADMISSION_MAX_QUEUED_EXTRACTIONS must be an integer.")
+
+        try:
+            self.admission_max_downloads = int(os.getenv("ADMISSION_MAX_DOWNLOADS", 20))
+        except ValueError:
+            raise ValueError("Environment variable ADMISSION_MAX_DOWNLOADS must be an integer.")
+
+        try:
+            self.admission_max_bandwidth = int(os.getenv("ADMISSION_MAX_BANDWIDTH", 0))
+        except ValueError:
+            raise ValueError("Environment variable ADMISSION_MAX_BANDWIDTH must be an integer.")
+
+        try:
+            self.admission_client_extractions_per_minute = int(os.getenv("ADMISSION_CLIENT_EXTRACTIONS_PER_MINUTE", 30))
+        except ValueError:
+            raise ValueError("Environment variable ADMISSION_CLIENT_EXTRACTIONS_PER_MINUTE must be an integer.")
+
+        try:
+            self.admission_client_downloads = int(os.getenv("ADMISSION_CLIENT_DOWNLOADS", 3))
+        except ValueError:
+            raise ValueError("Environment variable ADMISSION_CLIENT_DOWNLOADS must be an integer.")
+
+        try:
+            self.worker_metrics_port = int(os.getenv("WORKER_METRICS_PORT", 9808))
+        except ValueError:
+            raise ValueError("Environment variable WORKER_METRICS_PORT must be an integer.")
+
+        try:
+            self.trace_ttl = int(os.getenv("TRACE_TTL", 3600))
+        except ValueError:
+            raise ValueError("Environment variable TRACE_TTL must be an integer.")
+
+        try:
+            self.download_cancel_grace = int(os.getenv("DOWNLOAD_CANCEL_GRACE", 60))
+        except ValueError:
+            raise ValueError("Environment variable DOWNLOAD_CANCEL_GRACE must be an integer.")
+
+        try:
+            self.download_connections = int(os.getenv("DOWNLOAD_CONNECTIONS", 4))
+        except ValueError:
+            raise ValueError("Environment variable DOWNLOAD_CONNECTIONS must be an integer.")
+
+        try:
+            self.prefetch_min_picks = int(os.getenv("PREFETCH_MIN_PICKS", 20))
+        except ValueError:
+            raise ValueError("Environment variable PREFETCH_MIN_PICKS must be an integer.")
+
+        try:
+            self.prefetch_min_share = float(os.getenv("PREFETCH_MIN_SHARE", 0.5))
+        except ValueError:
+            raise ValueError("Environment variable PREFETCH_MIN_SHARE must be a number.")
+
+        self.node_name = os.getenv("NODE_NAME") or socket.gethostname()
+
+        try:
+            self.file_server_port = int(os.getenv("FILE_SERVER_PORT", 0))
+        except ValueError:
+            raise ValueError("Environment variable FILE_SERVER_PORT must be an integer.")
+
+        self.node_url = os.getenv("NODE_URL") or f"http://{self.node_name}:{self.file_server_port}"
+
+        self.artifact_serving = os.getenv("ARTIFACT_SERVING", "proxy")
+        if self.artifact_serving not in ("proxy", "redirect"):
+            raise ValueError("Environment variable ARTIFACT_SERVING must be \"proxy\" or \"redirect\".")
+
+        try:
+            self.replication_hot_hits = int(os.getenv("REPLICATION_HOT_HITS", 30))
+        except ValueError:
+            raise ValueError("Environment variable REPLICATION_HOT_HITS must be an integer.")
+
+        try:
+            self.replication_max_copies = int(os.getenv("REPLICATION_MAX_COPIES", 2))
+        except ValueError:
+            raise ValueError("Environment variable REPLICATION_MAX_COPIES must be an integer.")
+
         # Resolve to full absolute paths if relative
         self.fullpath_thumbnails = (
             str(Path(self.thumbnail_path).resolve()) if not os.path.isabs(self.thumbnail_path) else self.thumbnail_path
@@ -78,4 +248,46 @@ class EnvironmentVariablesConfig:
                 f"redis_address={self.redis_address}, redis_port={self.redis_port}, "
                 f"fullpath_thumbnails={self.fullpath_thumbnails}, fullpath_videos={self.fullpath_videos}, "
                 f"thumbnail_persistence_duration={self.thumbnail_persistence_duration}, "
-                f"video_persistence_duration={self.video_persistence_duration})")
+                f"video_persistence_duration={self.video_persistence_duration}, "
+                f"metadata_cache_ttl={self.metadata_cache_ttl}, "
+                f"metadata_cache_max_entries={self.metadata_cache_max_entries}, "
+                f"progress_update_interval={self.progress_update_interval}, "
+                f"progress_flush_interval={self.progress_flush_interval}, "
+                f"batch_max_size={self.batch_max_size}, batch_max_concurrency={self.batch_max_concurrency}, "
+                f"storage_quota_bytes={self.storage_quota_bytes}, storage_sweep_interval={self.storage_sweep_interval}, "
+                f"admission_max_queued_extractions={self.admission_max_queued_extractions}, "
+                f"admission_max_downloads={self.admission_max_downloads}, "
+                f"admission_max_bandwidth={self.admission_max_bandwidth}, "
+                f"admission_client_extractions_per_minute={self.admission_client_extractions_per_minute}, "
+                f"admission_client_downloads={self.admission_client_downloads}, "
+                f"worker_metrics_port={self.worker_metrics_port}, trace_ttl={self.trace_ttl}, "
+                f"download_cancel_grace={self.download_cancel_grace}, "
+                f"download_connections={self.download_connections}, prefetch_min_picks={self.prefetch_min_picks}, "
+                f"prefetch_min_share={self.prefetch_min_share}, node_name={self.node_name}, "
+                f"file_server_port={self.file_server_port}, node_url={self.node_url}, "
+                f"artifact_serving={self.artifact_serving}, replication_hot_hits={self.replication_hot_hits}, "
+                f"replication_max_copies={self.replication_max_copies})")
+
+
+
+# The body of a batch submission: either a list of video URLs or a playlist URL
+class BatchRequest(BaseModel):
+    urls: list[str] = []
+    playlist: str | None = None
+    # yt-dlp selector of the video stream, the best audio is always added to it
+    format: str = "bv*[ext=mp4]"
+    # How many downloads of the batch can run at once, capped by BATCH_MAX_CONCURRENCY
+    concurrency: int | None = None
+
+
+# The body of a download started over HTTP
+class DownloadRequest(BaseModel):
+    # The ID of the metadata task of the video
+    task_id: str
+    # The ID of the video format, the best audio is always added to it (optional for the audio only)
+    format: str | None = None
+    # A clip of the video: the start and end (seconds) of the range to keep, either can be left out
+    start: float | None = None
+    end: float | None = None
+    # Only the audio stream
+    audio_only: bool = False
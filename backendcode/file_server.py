@@ -0,0 +1,102 @@
+import mimetypes
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The file server of a node: it serves the videos stored on the local disk of the node to the API
+# (which proxies them) or to the clients (which the API redirects), and to the other nodes copying
+# them. The bodies are sent with sendfile, so the file contents never go through user space.
+
+# /videos/<store_key>/<file name>
+VIDEO_PATH = re.compile(r"/videos/([0-9A-Za-z_-]+)/([0-9A-Za-z_.-]+)")
+RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """Return the first and last byte of a single "bytes=" range, or None if the whole file is requested.
+
+    Raises ValueError if the range cannot be satisfied.
+    """
+    match = RANGE.fullmatch(header.strip()) if header else None
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # A suffix range: the last N bytes
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError(f"Range not satisfiable: {header}")
+    return first, last
+
+
+def make_handler(videos_dir: str):
+    """Build the request handler serving the files of a videos directory."""
+
+    class FileHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET(body=False)
+
+        def do_GET(self, body=True):
+            match = VIDEO_PATH.fullmatch(self.path.split("?", 1)[0])
+            path = os.path.join(videos_dir, *match.groups()) if match else None
+            if path is None or not os.path.isfile(path):
+                return self._send_empty(404)
+
+            with open(path, "rb") as file:
+                size = os.fstat(file.fileno()).st_size
+                try:
+                    byte_range = parse_range(self.headers.get("Range"), size)
+                except ValueError:
+                    return self._send_empty(416, {"Content-Range": f"bytes */{size}"})
+
+                first, last = byte_range or (0, size - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+                self.send_header("Content-Length", str(last - first + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Last-Modified", self.date_time_string(os.fstat(file.fileno()).st_mtime))
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+                self.end_headers()
+                if body:
+                    self.wfile.flush()
+                    self._sendfile(file, first, last - first + 1)
+
+        def _sendfile(self, file, offset: int, count: int):
+            """Copy a part of a file to the socket in the kernel."""
+            while count > 0:
+                sent = os.sendfile(self.connection.fileno(), file.fileno(), offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+
+        def _send_empty(self, status: int, headers: dict = None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return FileHandler
+
+
+def serve_files(videos_dir: str, port: int) -> ThreadingHTTPServer | None:
+    """Serve the videos of a node in the background, returning the server (None if it could not start)."""
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), make_handler(videos_dir))
+    except OSError as e:
+        print(f"Failed to serve files on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="file-server", daemon=True).start()
+    print(f"Serving the videos of {videos_dir} on port {port}")
+    return server
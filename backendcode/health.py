@@ -0,0 +1,114 @@
+import threading
+import time
+
+import redis
+from celery import Celery
+from celery.events.state import State
+
+from backendcode.metrics import REDIS_LATENCY
+
+
+class HealthMonitor:
+    """Keep a cached snapshot of the availability of Redis and of the Celery workers.
+
+    Instead of pinging Redis and broadcasting an inspect().ping() to every worker on each
+    request, two background threads keep the snapshot up to date:
+        - one pings Redis every few seconds,
+        - one listens to the worker heartbeat events (sent every 2 seconds by each worker),
+          so a worker is considered alive as long as its heartbeats keep arriving.
+    """
+
+    # Seconds between two Redis pings, and before reconnecting to the event stream after a failure
+    CHECK_INTERVAL = 5
+
+    def __init__(self, celery_app: Celery, redis_client: redis.Redis):
+        self.celery_app = celery_app
+        self.redis_client = redis_client
+
+        self._state = State()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._receiver = None
+
+        self._redis_available = False
+        self._redis_checked_at = None
+
+    def start(self):
+        """Check the services once, then keep watching them in the background."""
+        self._check_redis()
+        self._seed_workers()
+        threading.Thread(target=self._watch_redis, name="health-redis", daemon=True).start()
+        threading.Thread(target=self._watch_workers, name="health-workers", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._receiver is not None:
+            self._receiver.should_stop = True
+
+    def is_available(self) -> bool:
+        """Check whether tasks can be scheduled and processed, from the cached snapshot."""
+        if not self._redis_available:
+            return False
+        with self._lock:
+            return any(worker.alive for worker in self._state.workers.values())
+
+    def snapshot(self) -> dict:
+        """Return the cached availability of the services, along with the load of every worker."""
+        with self._lock:
+            workers = {
+                hostname: {
+                    "alive": worker.alive,
+                    "active": worker.active,
+                    "processed": worker.processed,
+                    "loadavg": worker.loadavg,
+                    "last_heartbeat": worker.heartbeats[-1] if worker.heartbeats else None,
+                }
+                for hostname, worker in self._state.workers.items()
+            }
+        return {
+            "available": self._redis_available and any(worker["alive"] for worker in workers.values()),
+            "redis": {"available": self._redis_available, "checked_at": self._redis_checked_at},
+            "celery": {"available": any(worker["alive"] for worker in workers.values()), "workers": workers},
+        }
+
+    def _check_redis(self):
+        try:
+            started = time.monotonic()
+            self._redis_available = bool(self.redis_client.ping())
+            REDIS_LATENCY.observe(time.monotonic() - started)
+        except redis.RedisError:
+            self._redis_available = False
+        self._redis_checked_at = time.time()
+
+    def _watch_redis(self):
+        while not self._stop.wait(self.CHECK_INTERVAL):
+            self._check_redis()
+
+    def _seed_workers(self):
+        """Find the workers that are already running, since their next heartbeat may take a while."""
+        try:
+            replies = self.celery_app.control.ping(timeout=1.0)
+        except Exception as e:
+            print(f"Failed to ping the celery workers: {e}")
+            return
+        now = time.time()
+        for reply in replies:
+            for hostname in reply:
+                self._on_event({"type": "worker-online", "hostname": hostname, "timestamp": now,
+                                "local_received": now, "freq": 2.0})
+
+    def _on_event(self, event: dict):
+        with self._lock:
+            self._state.event(event)
+
+    def _watch_workers(self):
+        while not self._stop.is_set():
+            try:
+                with self.celery_app.connection_for_read() as connection:
+                    self._receiver = self.celery_app.events.Receiver(
+                        connection, handlers={"*": self._on_event}, routing_key="worker.#")
+                    # Waking the workers up makes them send a heartbeat right away
+                    self._receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception as e:
+                print(f"Lost the celery event stream: {e}")
+                self._stop.wait(self.CHECK_INTERVAL)
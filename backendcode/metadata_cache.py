@@ -0,0 +1,116 @@
+import time
+import uuid
+
+import redis
+
+from backendcode.celery_config import celery_app
+
+# Task states that mean the extraction will never produce metadata, so the entry must be replaced
+FAILED_STATES = ("FAILURE", "REVOKED")
+
+# Delete a key only if it still holds the value we expect (i.e., no one replaced it meanwhile)
+COMPARE_AND_DELETE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class MetadataCache:
+    """Map YouTube video IDs to the extract_info task that holds their metadata.
+
+    The metadata itself lives in the Celery result backend, so the cache only stores the
+    ID of the task that extracted (or is extracting) a video. Submitting a video that is
+    already cached returns the same task ID, which makes concurrent submissions collapse
+    onto a single extraction and lets late callers read the result right away.
+
+    Entries expire after a TTL (bounded by the result backend expiry, since the entry is
+    useless once the result is gone) and the least recently requested videos are evicted
+    once the cache holds more than max_entries videos.
+    """
+
+    KEY_PREFIX = "metadata"
+    INDEX_KEY = "metadata:index"
+    STATS_KEY = "metadata:stats"
+
+    def __init__(self, redis_client: redis.Redis, ttl: int, max_entries: int):
+        self.redis_client = redis_client
+        self.ttl = min(ttl, celery_app.conf.result_expires)
+        self.max_entries = max_entries
+        self._compare_and_delete = redis_client.register_script(COMPARE_AND_DELETE)
+
+    def _key(self, video_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{video_id}"
+
+    def get_or_submit(self, video_id: str, submit) -> tuple[str, bool]:
+        """Return the task ID holding the metadata of a video, submitting an extraction if needed.
+
+        Args:
+            video_id (str): The YouTube video ID.
+            submit (callable): Called with a new task ID to schedule the extraction on a miss.
+
+        Returns:
+            tuple[str, bool]: The task ID and whether it was served from the cache.
+        """
+        key = self._key(video_id)
+
+        while True:
+            task_id = str(uuid.uuid4())
+
+            # Only one caller can create the entry, everyone else attaches to its task
+            if self.redis_client.set(key, task_id, nx=True, ex=self.ttl):
+                try:
+                    submit(task_id)
+                except Exception:
+                    self._compare_and_delete(keys=[key], args=[task_id])
+                    raise
+                self.redis_client.hincrby(self.STATS_KEY, "misses", 1)
+                self._record_access(video_id)
+                return task_id, False
+
+            cached_task_id = self.redis_client.get(key)
+            if cached_task_id is None:
+                # The entry expired between the two calls, try to create it again
+                continue
+            cached_task_id = cached_task_id.decode("utf-8")
+
+            # A failed or expired extraction must not be served, drop it and extract again
+            if celery_app.AsyncResult(cached_task_id).state in FAILED_STATES:
+                self._compare_and_delete(keys=[key], args=[cached_task_id])
+                continue
+
+            self.redis_client.hincrby(self.STATS_KEY, "hits", 1)
+            self._record_access(video_id)
+            return cached_task_id, True
+
+    def _record_access(self, video_id: str):
+        """Update the recency of a video and evict the least recently requested ones if over capacity."""
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(self.INDEX_KEY, {video_id: time.time()})
+        # Entries whose TTL ran out are no longer in the cache, so they should not count against it
+        pipe.zremrangebyscore(self.INDEX_KEY, "-inf", time.time() - self.ttl)
+        pipe.zcard(self.INDEX_KEY)
+        size = pipe.execute()[-1]
+
+        if size > self.max_entries:
+            evicted = self.redis_client.zpopmin(self.INDEX_KEY, size - self.max_entries)
+            if evicted:
+                self.redis_client.delete(*[self._key(member.decode("utf-8")) for member, _ in evicted])
+                self.redis_client.hincrby(self.STATS_KEY, "evictions", len(evicted))
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters and the current size of the cache."""
+        counters = {k.decode("utf-8"): int(v) for k, v in self.redis_client.hgetall(self.STATS_KEY).items()}
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": self.redis_client.zcard(self.INDEX_KEY),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
@@ -0,0 +1,80 @@
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess, start_http_server
+
+# Prometheus metrics of the API and of the workers, one histogram per stage a video goes through.
+#
+# When several processes serve the same metrics (uvicorn --workers, or the prefork pool of Celery), the
+# PROMETHEUS_MULTIPROC_DIR environment variable must point to an empty directory shared by them: every
+# process then writes its values there, and the exposition aggregates them.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# From 64 KiB/s to 256 MiB/s
+SPEED_BUCKETS = tuple(64 * 1024 * 2 ** i for i in range(13))
+
+QUEUE_WAIT = Histogram("videodl_queue_wait_seconds", "Time a task waited in its queue before a worker started it",
+                       ["task"], buckets=LATENCY_BUCKETS)
+EXTRACT_DURATION = Histogram("videodl_extract_duration_seconds", "Duration of the yt-dlp metadata extractions",
+                             buckets=LATENCY_BUCKETS)
+DOWNLOAD_DURATION = Histogram("videodl_download_duration_seconds", "Duration of the downloads, merge included",
+                              ["status"], buckets=LATENCY_BUCKETS)
+DOWNLOAD_SPEED = Histogram("videodl_download_speed_bytes", "Average network speed of the downloads, in bytes/s",
+                           buckets=SPEED_BUCKETS)
+MERGE_DURATION = Histogram("videodl_merge_duration_seconds", "Duration of the ffmpeg merges of video and audio",
+                           buckets=LATENCY_BUCKETS)
+THUMBNAIL_FETCH = Histogram("videodl_thumbnail_fetch_seconds", "Duration of the thumbnail downloads",
+                            buckets=LATENCY_BUCKETS)
+WEBSOCKET_SEND = Histogram("videodl_websocket_send_seconds",
+                           "Time between a worker publishing a progress event and the API sending it to a client",
+                           buckets=LATENCY_BUCKETS)
+REDIS_LATENCY = Histogram("videodl_redis_ping_seconds", "Round trip of the periodic Redis pings",
+                          buckets=LATENCY_BUCKETS)
+
+DOWNLOADS_CANCELLED = Counter("videodl_downloads_cancelled_total", "Downloads cancelled before they completed",
+                              ["reason"])
+CANCELLED_BYTES = Counter("videodl_cancelled_bytes_total", "Bytes downloaded by the downloads that were cancelled",
+                          ["reason"])
+# The hit rate of the speculative downloads is hits / (hits + misses + expired)
+PREFETCHES_STARTED = Counter("videodl_prefetches_started_total", "Speculative downloads started after an extraction")
+PREFETCH_OUTCOMES = Counter("videodl_prefetch_outcomes_total", "Speculative downloads settled by the pick of a user",
+                            ["outcome"])
+PREFETCH_WASTED_BYTES = Counter("videodl_prefetch_wasted_bytes_total",
+                                "Bytes downloaded by the speculative downloads of a format nobody picked")
+
+ACTIVE_WEBSOCKETS = Gauge("videodl_active_websockets", "WebSockets following a download",
+                          multiprocess_mode="livesum")
+# Read from Redis when the metrics are scraped, so every API process reports the same value
+DOWNLOADS_IN_FLIGHT = Gauge("videodl_downloads_in_flight", "Downloads queued or running",
+                            multiprocess_mode="mostrecent")
+STORAGE_USED = Gauge("videodl_storage_used_bytes", "Bytes taken by the stored videos and thumbnails",
+                     multiprocess_mode="mostrecent")
+STORAGE_QUOTA = Gauge("videodl_storage_quota_bytes", "The storage quota", multiprocess_mode="mostrecent")
+
+
+def get_registry():
+    """Return the registry to expose, aggregating every process in multiprocess mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> bytes:
+    """Return the metrics in the Prometheus text format."""
+    return generate_latest(get_registry())
+
+
+def serve_metrics(port: int):
+    """Expose the metrics on their own HTTP server, for the processes that do not serve HTTP (the workers)."""
+    try:
+        start_http_server(port, registry=get_registry())
+        print(f"Serving metrics on port {port}")
+    except OSError as e:
+        print(f"Failed to serve metrics on port {port}: {e}")
+
+
+def mark_process_dead(pid: int):
+    """Drop the live gauges of a process that exited, in multiprocess mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
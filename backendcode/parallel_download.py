@@ -0,0 +1,350 @@
+import json
+import os
+import threading
+import time
+
+from yt_dlp.downloader import external
+from yt_dlp.downloader.common import FileDownloader
+from yt_dlp.downloader.http import HttpFD
+from yt_dlp.networking import Request
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from yt_dlp.utils import ContentTooShortError, RetryManager, parse_http_range
+from yt_dlp.utils.networking import HTTPHeaderDict
+
+# The name the downloader is registered under, for the "external_downloader" option of yt-dlp
+PARALLEL_DOWNLOADER = "parallel_http"
+
+# Chunks never get smaller than this (except the last one), nor larger than this
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# A chunk is sized so that a connection takes about this long (seconds) to fetch it at its last speed
+CHUNK_DURATION = 4
+# What is read from a response at a time, and written to the file with one pwrite
+BLOCK_SIZE = 256 * 1024
+# How often (in seconds) the progress hooks are called, and the ranges left are saved for the next attempt
+PROGRESS_INTERVAL = 0.5
+STATE_INTERVAL = 2
+# How many times a range is retried, unless the options set "fragment_retries" (a range is a fragment of the file)
+RANGE_RETRIES = 10
+
+
+class RangeDownloadError(Exception):
+    """A range request that was not answered with the requested bytes."""
+
+
+class ParallelHttpFD(FileDownloader):
+    """Download a single (non-fragmented) file over several connections at once.
+
+    Origins throttle every connection, so a single connection caps a large file at a fraction of the
+    link. The file is preallocated, then split into byte ranges that the connections claim one chunk
+    at a time and write at their offset (pwrite), so the connections never wait for each other. Every
+    connection sizes its next chunk after its own speed: a fast one takes larger chunks, fewer
+    requests, and the chunks shrink at the end so every connection finishes at about the same time.
+    A chunk that fails is retried from the last byte written, on its own.
+
+    The ranges still missing are saved next to the partial file (in its .ytdl file), so a download
+    that stopped continues with them. The requests go through the networking stack of the YoutubeDL
+    instance, whose sessions keep the connections open from one chunk to the next. Files whose size
+    is unknown, or whose origin ignores ranges, are downloaded by the native downloader instead.
+    """
+
+    # Looked up by get_external_downloader when the option names another downloader
+    EXE_NAME = PARALLEL_DOWNLOADER
+
+    @classmethod
+    def can_download(cls, info_dict, path=None):
+        # One file at a time, the formats to merge are downloaded one after the other
+        return (info_dict.get('protocol') in ('http', 'https') and not info_dict.get('is_live')
+                and info_dict.get('request_data') is None and not info_dict.get('requested_formats'))
+
+    @classmethod
+    def available(cls, path=None):
+        return True
+
+    def real_download(self, filename, info_dict):
+        connections = self.params.get('concurrent_fragment_downloads') or 1
+        if filename == '-' or connections < 2 or self.params.get('test') or self.params.get('nopart'):
+            return self._native_download(filename, info_dict)
+
+        headers = HTTPHeaderDict({'Accept-Encoding': 'identity'}, info_dict.get('http_headers'))
+        total = self._probe_size(info_dict['url'], headers)
+        tmpfilename = self.temp_name(filename)
+        if total is None or total < 2 * MIN_CHUNK_SIZE:
+            # The ranges left by a previous attempt cannot be continued by the native downloader
+            if os.path.isfile(self.ytdl_filename(filename)):
+                self.try_remove(tmpfilename)
+                self.try_remove(self.ytdl_filename(filename))
+            return self._native_download(filename, info_dict)
+
+        # Largest chunk the origin serves at full speed (YouTube throttles larger ranges)
+        max_chunk = min(MAX_CHUNK_SIZE, info_dict.get('downloader_options', {}).get('http_chunk_size') or MAX_CHUNK_SIZE)
+        download = _RangeDownload(self, info_dict['url'], headers, total, connections, max_chunk)
+        download.missing = self._load_missing(filename, tmpfilename, total)
+        resumed = total - sum(end - start for start, end in download.missing)
+        if resumed:
+            self.report_resuming_byte(resumed)
+        self.report_destination(filename)
+
+        # Saved before the file is preallocated, a preallocated file without its state would look complete
+        self._save_missing(filename, total, download.missing)
+        fd = os.open(tmpfilename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._preallocate(fd, total)
+            download.fd = fd
+            download.start()
+            self._monitor(download, filename, tmpfilename, info_dict, resumed)
+        finally:
+            download.stop()
+            os.close(fd)
+            if download.missing:
+                self._save_missing(filename, total, download.missing)
+
+        # A range whose retries ran out without raising (e.g., with ignoreerrors) left a hole in the file.
+        # Its state is kept, so the next attempt fetches only what is missing.
+        if download.missing:
+            raise ContentTooShortError(total - sum(end - start for start, end in download.missing), total)
+
+        self.try_remove(self.ytdl_filename(filename))
+        self.try_rename(tmpfilename, filename)
+        self._hook_progress({
+            'downloaded_bytes': total,
+            'total_bytes': total,
+            'filename': filename,
+            'status': 'finished',
+            'elapsed': time.time() - download.started,
+            'ctx_id': info_dict.get('ctx_id'),
+        }, info_dict)
+        return True
+
+    def _native_download(self, filename, info_dict):
+        fd = HttpFD(self.ydl, self.params)
+        # The hooks of this downloader (and report_progress, which HttpFD adds itself)
+        for ph in self._progress_hooks[1:]:
+            fd.add_progress_hook(ph)
+        return fd.real_download(filename, info_dict)
+
+    def _probe_size(self, url, headers) -> int | None:
+        """Return the size of the file, or None if the origin does not serve ranges of it."""
+        for retry in RetryManager(self.params.get('retries'), self.report_retry):
+            try:
+                with self.ydl.urlopen(Request(url, headers={**headers, 'Range': 'bytes=0-0'})) as response:
+                    if response.status != 206:
+                        return None
+                    _, _, total = parse_http_range(response.headers.get('Content-Range'))
+                    return total
+            except (TransportError, HTTPError) as e:
+                if isinstance(e, HTTPError) and e.status < 500 and e.status not in (408, 429):
+                    raise
+                retry.error = e
+        return None
+
+    def _load_missing(self, filename, tmpfilename, total) -> list[list[int]]:
+        """Return the ranges a previous attempt did not download, from its state or its partial file."""
+        missing = [[0, total]]
+        if not self.params.get('continuedl', True) or not os.path.isfile(tmpfilename):
+            return missing
+        try:
+            with open(self.ytdl_filename(filename)) as state_file:
+                state = json.load(state_file).get('parallel') or {}
+            if state.get('total') == total:
+                return [list(byte_range) for byte_range in state['missing']]
+        except FileNotFoundError:
+            # Left by the native downloader, which writes the file from its start
+            size = os.path.getsize(tmpfilename)
+            if size <= total:
+                return [[size, total]] if size < total else []
+        except (ValueError, KeyError, TypeError):
+            pass
+        return missing
+
+    def _save_missing(self, filename, total, missing):
+        with open(self.ytdl_filename(filename), 'w') as state_file:
+            json.dump({'parallel': {'total': total, 'missing': missing}}, state_file)
+
+    @staticmethod
+    def _preallocate(fd, total):
+        """Reserve the blocks of the whole file at once, rather than as the ranges arrive out of order."""
+        if os.fstat(fd).st_size > total:
+            os.ftruncate(fd, total)
+        try:
+            os.posix_fallocate(fd, 0, total)
+        except (AttributeError, OSError) as e:
+            if getattr(e, 'errno', None) == 28:  # ENOSPC
+                raise
+            # The file system (or the platform) does not preallocate, a sparse file does the same otherwise
+            os.ftruncate(fd, total)
+
+    def _monitor(self, download, filename, tmpfilename, info_dict, resumed):
+        """Report the progress while the connections run, raising what stopped them (or a hook)."""
+        last_saved = time.monotonic()
+        while not download.wait(PROGRESS_INTERVAL):
+            downloaded = download.downloaded
+            now = time.time()
+            speed = self.calc_speed(download.started, now, downloaded)
+            self._hook_progress({
+                'status': 'downloading',
+                'downloaded_bytes': resumed + downloaded,
+                'total_bytes': download.total,
+                'tmpfilename': tmpfilename,
+                'filename': filename,
+                'eta': self.calc_eta(speed, download.total - resumed - downloaded),
+                'speed': speed,
+                'elapsed': now - download.started,
+                'ctx_id': info_dict.get('ctx_id'),
+            }, info_dict)
+            if time.monotonic() - last_saved >= STATE_INTERVAL:
+                self._save_missing(filename, download.total, download.snapshot())
+                last_saved = time.monotonic()
+        if download.error is not None:
+            raise download.error
+
+
+class _RangeDownload:
+    """The connections of one parallel download, and the ranges they share."""
+
+    def __init__(self, downloader: ParallelHttpFD, url, headers, total, connections, max_chunk):
+        self.downloader = downloader
+        self.url = url
+        self.headers = headers
+        self.total = total
+        self.connections = connections
+        self.max_chunk = max_chunk
+        self.fd = None
+        # The ranges nobody claimed yet, and the ones being fetched, by connection (start and end, end excluded)
+        self.missing = []
+        self._unclaimed = []
+        self._claimed = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self.downloaded = 0
+        self.error = None
+        self.started = time.time()
+
+    def start(self):
+        # The ranges still missing, as they are claimed from the start
+        self._unclaimed = [list(byte_range) for byte_range in self.missing]
+        for index in range(self.connections):
+            thread = threading.Thread(target=self._run, args=(index,), name=f"range-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wait(self, timeout) -> bool:
+        """Wait for the connections up to `timeout` seconds, returning True once they all stopped."""
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def stop(self):
+        if not self._threads:
+            return
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self.missing = self.snapshot()
+
+    def snapshot(self) -> list[list[int]]:
+        """Return the ranges not written yet (unclaimed, or left of the claimed ones), in order."""
+        with self._lock:
+            ranges = [list(byte_range) for byte_range in self._unclaimed]
+            ranges += [list(byte_range) for byte_range in self._claimed.values()]
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and merged[-1][1] == start:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        return merged
+
+    def _claim(self, index, chunk_size) -> list[int] | None:
+        """Take the next chunk of the missing ranges for a connection."""
+        with self._lock:
+            if not self._unclaimed:
+                return None
+            left = sum(end - start for start, end in self._unclaimed)
+            # Near the end, split what is left so the connections finish together
+            chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, -(-left // self.connections)))
+            start, end = self._unclaimed[0]
+            if end - start <= chunk_size:
+                self._unclaimed.pop(0)
+            else:
+                end = start + chunk_size
+                self._unclaimed[0][0] = end
+            self._claimed[index] = [start, end]
+            return self._claimed[index]
+
+    def _run(self, index):
+        chunk_size = min(self.max_chunk, max(MIN_CHUNK_SIZE, self.total // (self.connections * 8)))
+        try:
+            while not self._stopped.is_set():
+                byte_range = self._claim(index, chunk_size)
+                if byte_range is None:
+                    return
+                started, length = time.monotonic(), byte_range[1] - byte_range[0]
+                self._fetch(index, byte_range)
+                if byte_range[0] < byte_range[1]:
+                    # Stopped halfway, the rest of the range stays missing
+                    return
+                with self._lock:
+                    del self._claimed[index]
+                speed = length / max(time.monotonic() - started, 0.001)
+                chunk_size = int(min(self.max_chunk, max(MIN_CHUNK_SIZE, speed * CHUNK_DURATION)))
+        except BaseException as e:
+            with self._lock:
+                if self.error is None and not self._stopped.is_set():
+                    self.error = e
+            self._stopped.set()
+
+    def _fetch(self, index, byte_range):
+        """Write a range to the file, retrying it from the last byte written when its request fails."""
+        retries = self.downloader.params.get('fragment_retries', RANGE_RETRIES)
+        for retry in RetryManager(retries, self.downloader.report_retry):
+            try:
+                self._fetch_once(byte_range)
+                return
+            except (TransportError, RangeDownloadError, ContentTooShortError) as e:
+                retry.error = e
+            except HTTPError as e:
+                if e.status < 500 and e.status not in (408, 429):
+                    raise
+                retry.error = e
+            if self._stopped.is_set():
+                return
+
+    def _fetch_once(self, byte_range):
+        start, end = byte_range
+        request = Request(self.url, headers={**self.headers, 'Range': f'bytes={start}-{end - 1}'})
+        with self.downloader.ydl.urlopen(request) as response:
+            first, _, _ = parse_http_range(response.headers.get('Content-Range'))
+            if response.status != 206 or first != start:
+                raise RangeDownloadError(f'Requested bytes {start}-{end - 1}, got status {response.status} '
+                                         f'({response.headers.get("Content-Range")})')
+            while start < end and not self._stopped.is_set():
+                block = response.read(min(BLOCK_SIZE, end - start))
+                if not block:
+                    raise ContentTooShortError(start, end)
+                view = memoryview(block)
+                while view:
+                    written = os.pwrite(self.fd, view, start)
+                    view = view[written:]
+                    start += written
+                with self._lock:
+                    # Keep the claimed range at what is still missing, for the retries and the saved state
+                    byte_range[0] = start
+                    self.downloaded += len(block)
+
+
+def register_parallel_downloader() -> str:
+    """Let the "external_downloader" option of yt-dlp name the parallel downloader, and return its name.
+
+    yt-dlp has no public way to add a downloader, it goes into the registry get_external_downloader
+    reads (the version of yt-dlp is pinned in requirements.txt). The name is checked to resolve to it,
+    so a version that looks the downloaders up elsewhere fails when the workers start, instead of
+    downloading with another one.
+    """
+    external._BY_NAME[PARALLEL_DOWNLOADER] = ParallelHttpFD
+    if external.get_external_downloader(PARALLEL_DOWNLOADER) is not ParallelHttpFD:
+        raise RuntimeError(f"yt-dlp does not resolve the downloader {PARALLEL_DOWNLOADER!r} to ParallelHttpFD")
+    return PARALLEL_DOWNLOADER
@@ -0,0 +1,131 @@
+import time
+
+import redis
+
+# Upper bounds (seconds) of the duration buckets the picks are counted in, longer videos share the last one
+DURATION_BUCKETS = (60, 300, 900, 1800, 3600)
+
+# Settle a pending speculative download with the format a user picked: a "hit" if it is the prefetched
+# one, a "miss" otherwise (unless misses are left pending). Returns the outcome and the store key of the
+# prefetch, or nothing if no prefetch was settled.
+DECIDE = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'pending' then
+    return false
+end
+local outcome = 'miss'
+if redis.call('HGET', KEYS[1], 'format') == ARGV[1] then
+    outcome = 'hit'
+elseif ARGV[4] == '0' then
+    return false
+end
+redis.call('HSET', KEYS[1], 'status', outcome, 'decided', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return {outcome, redis.call('HGET', KEYS[1], 'store_key')}
+"""
+
+
+def duration_bucket(duration: float | None) -> str:
+    """Return the bucket the picks of a video of this duration are counted in."""
+    if not isinstance(duration, (int, float)):
+        return "unknown"
+    for bound in DURATION_BUCKETS:
+        if duration <= bound:
+            return f"le{bound}"
+    return f"gt{DURATION_BUCKETS[-1]}"
+
+
+class FormatPicks:
+    """Count the formats users pick, to guess the one the next user will pick.
+
+    A pick is counted by the resolution and the codec family of the format, in the bucket of the
+    duration of the video (people pick lower resolutions for longer videos). The likeliest format
+    of a new video is the available one with the most picks in its bucket.
+    """
+
+    KEY_PREFIX = "prefetch:picks"
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+
+    def _key(self, duration: float | None) -> str:
+        return f"{self.KEY_PREFIX}:{duration_bucket(duration)}"
+
+    @staticmethod
+    def _field(entry: dict) -> str:
+        return f"{entry['height']}:{entry['vcodec']}"
+
+    def record(self, duration: float | None, entry: dict):
+        """Count a pick of a format, given by its entry in the format index of the video."""
+        self.redis_client.hincrby(self._key(duration), self._field(entry), 1)
+
+    def likeliest(self, duration: float | None, index: list[dict], min_picks: int, min_share: float) -> dict | None:
+        """Return the entry of the format index most likely to be picked, or None if no guess is good enough.
+
+        The bucket needs `min_picks` picks before it is trusted, and the format must have been picked
+        at least `min_share` of the time.
+        """
+        counts = {field.decode("utf-8"): int(count)
+                  for field, count in self.redis_client.hgetall(self._key(duration)).items()}
+        total = sum(counts.values())
+        if not total or total < min_picks:
+            return None
+        for field, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+            if count / total < min_share:
+                return None
+            # The index is ordered best first, so this is the best format of the picked kind
+            entry = next((entry for entry in index if self._field(entry) == field), None)
+            if entry is not None:
+                return entry
+        return None
+
+
+class PrefetchRegistry:
+    """Record the speculative downloads, until the user of the video picks a format.
+
+    Once a video is extracted, its likeliest format starts downloading while the user is still
+    choosing. The prefetch stays pending until a format of the video is picked: the pick settles it
+    as a hit (the download goes on as a regular one) or a miss (the download stops). A prefetch that
+    nobody settles in CLAIM_TIMEOUT seconds expires, and its download stops too.
+    """
+
+    KEY_PREFIX = "prefetch"
+
+    # How long a prefetch waits for a pick, and how long its outcome is kept once settled
+    CLAIM_TIMEOUT = 300
+    OUTCOME_TTL = 3600
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self._decide = redis_client.register_script(DECIDE)
+
+    @classmethod
+    def key(cls, video_id: str) -> str:
+        return f"{cls.KEY_PREFIX}:{video_id}"
+
+    def start(self, video_id: str, store_key: str, video_format: str, download_id: str):
+        """Record a speculative download of a video, pending until a format of the video is picked."""
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self.key(video_id), mapping={
+            "status": "pending", "store_key": store_key, "format": video_format, "download_id": download_id,
+            "started": time.time(),
+        })
+        pipe.expire(self.key(video_id), self.CLAIM_TIMEOUT)
+        pipe.execute()
+
+    def decide(self, video_id: str, video_format: str, settle_miss: bool = True) -> tuple[str, str] | None:
+        """Settle the pending prefetch of a video with the format picked, returning the outcome ("hit" or
+        "miss") and the store key of the prefetched format, or None if no prefetch was settled.
+
+        With `settle_miss` False, only a pick of the prefetched format settles it (e.g., for a batch,
+        whose format says nothing about what the user of the video will pick).
+        """
+        result = self._decide(keys=[self.key(video_id)],
+                              args=[video_format, time.time(), self.OUTCOME_TTL, int(settle_miss)])
+        if not result:
+            return None
+        return result[0].decode("utf-8"), result[1].decode("utf-8")
+
+    def status(self, video_id: str) -> str | None:
+        """Return "pending", "hit" or "miss", or None if the prefetch expired unsettled."""
+        status = self.redis_client.hget(self.key(video_id), "status")
+        return status.decode("utf-8") if status is not None else None
@@ -0,0 +1,324 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+
+import redis
+import redis.asyncio
+
+CHANNEL_PREFIX = "progress"
+
+# Events after which nothing else is published for a download
+TERMINAL_STATUSES = ("completed", "error")
+
+
+def progress_channel(store_key: str) -> str:
+    """Return the pub/sub channel carrying the progress events of a stored video."""
+    return f"{CHANNEL_PREFIX}:{store_key}"
+
+
+def progress_key(store_key: str) -> str:
+    """Return the key of the hash holding the latest progress of a stored video."""
+    return f"{store_key}:progress"
+
+
+def publish_progress(redis_client: redis.Redis, store_key: str, event: dict):
+    """Publish a progress event of a download to every API process watching it."""
+    redis_client.publish(progress_channel(store_key), json.dumps(event))
+
+
+class ProgressReporter:
+    """Record and publish the progress of a download from the yt-dlp progress hook.
+
+    The hook can fire many times a second, so updates are written at most once per interval
+    (status changes are always written). Each write is a single pipelined round trip that
+    updates the progress hash of the download, refreshes its TTL and publishes the event.
+    """
+
+    def __init__(self, redis_client: redis.Redis, store_key: str, interval: float, ttl: int, on_write=None):
+        self.redis_client = redis_client
+        self.store_key = store_key
+        self.interval = interval
+        self.ttl = ttl
+        # Called with the pipeline and the event of every write, to piggyback other updates on the same round trip
+        self.on_write = on_write
+
+        self.started = time.monotonic()
+        self._last_write = 0.0
+        self._last_status = None
+        # Bytes of every file of the download (video and audio are downloaded separately)
+        self._file_bytes = {}
+        # The latest speed reported by yt-dlp, in bytes/s
+        self.speed = 0
+        # When the last file finished downloading, before any post-processing
+        self.finished_at = None
+        # Bytes a previous attempt already downloaded, which this one resumes from
+        self.resumed_bytes = 0
+
+    def hook(self, d):
+        """The yt-dlp progress hook."""
+        filename = d.get('filename')
+        if d['status'] == 'downloading':
+            self._file_bytes[filename] = d.get('downloaded_bytes') or 0
+            self.speed = d.get('speed') or 0
+            self._write({"status": "downloading", "progress": d.get('_percent_str', ''),
+                         "eta": d.get('_eta_str', ''), "speed": d.get('_speed_str', '')})
+        elif d['status'] == 'finished':
+            self._file_bytes[filename] = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            self.finished_at = time.monotonic()
+            self._write({"status": "finished", "progress": "100%"})
+
+    def complete(self, event: dict) -> dict:
+        """Record the final summary of a successful download and publish it along with the event.
+
+        Returns:
+            dict: The summary, with the total bytes, the bytes resumed from a previous attempt, the
+                average speed (bytes/s) of this attempt and its elapsed time (s).
+        """
+        elapsed = time.monotonic() - self.started
+        transferred = self.transferred_bytes()
+        summary = {
+            "total_bytes": sum(self._file_bytes.values()),
+            "resumed_bytes": self.resumed_bytes,
+            "average_speed": round(transferred / elapsed) if elapsed > 0 else 0,
+            "elapsed": round(elapsed, 2),
+        }
+        self._write({**event, **summary}, force=True)
+        return summary
+
+    def transferred_bytes(self) -> int:
+        """Return the bytes this attempt downloaded, leaving out the ones resumed from a previous attempt."""
+        return max(0, sum(self._file_bytes.values()) - self.resumed_bytes)
+
+    def network_speed(self) -> float:
+        """Return the average speed (bytes/s) of the transfers, leaving out the post-processing."""
+        elapsed = (self.finished_at or time.monotonic()) - self.started
+        return self.transferred_bytes() / elapsed if elapsed > 0 else 0.0
+
+    def fail(self, event: dict):
+        """Record and publish the failure of a download."""
+        self._write(event, force=True)
+
+    def _write(self, event: dict, force: bool = False):
+        now = time.monotonic()
+        if not force and event["status"] == self._last_status and now - self._last_write < self.interval:
+            return
+        self._last_write = now
+        self._last_status = event["status"]
+        # When the event was published, to measure how late it reaches the clients
+        event = {**event, "time": round(time.time(), 3)}
+
+        key = progress_key(self.store_key)
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hset(key, mapping=event)
+        pipe.expire(key, self.ttl)
+        pipe.publish(progress_channel(self.store_key), json.dumps(event))
+        if self.on_write is not None:
+            self.on_write(pipe, event)
+        pipe.execute()
+
+
+class ProgressBroker:
+    """Fan out the progress events published by the workers to every local watcher.
+
+    A single asyncio Redis connection is shared by the whole API process. A channel is
+    subscribed when its first watcher arrives and unsubscribed when its last one leaves,
+    so the process only receives events for the downloads it is currently watching.
+    """
+
+    # Events kept per watcher, the oldest ones are dropped if a socket falls behind
+    QUEUE_SIZE = 32
+
+    def __init__(self, redis_client: redis.asyncio.Redis):
+        self.redis_client = redis_client
+        self._pubsub = redis_client.pubsub()
+        # The callbacks every received event of a download is passed to
+        self._watchers: dict[str, set] = {}
+        self._lock = asyncio.Lock()
+        self._subscribed = asyncio.Event()
+        self._reader = None
+
+    async def start(self):
+        """Start reading the subscribed channels in the background."""
+        self._reader = asyncio.create_task(self._read())
+
+    async def stop(self):
+        """Stop reading and close the pub/sub connection."""
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+        await self._pubsub.aclose()
+
+    async def snapshot(self, store_key: str) -> dict:
+        """Return the latest recorded progress of a download."""
+        progress = await self.redis_client.hgetall(progress_key(store_key))
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in progress.items()}
+
+    async def add_watcher(self, store_key: str, callback):
+        """Pass every progress event of a download to `callback`, until remove_watcher is called."""
+        async with self._lock:
+            watchers = self._watchers.setdefault(store_key, set())
+            if not watchers:
+                await self._pubsub.subscribe(progress_channel(store_key))
+                self._subscribed.set()
+            watchers.add(callback)
+
+    async def remove_watcher(self, store_key: str, callback):
+        async with self._lock:
+            watchers = self._watchers.get(store_key, set())
+            watchers.discard(callback)
+            if not watchers:
+                self._watchers.pop(store_key, None)
+                try:
+                    await self._pubsub.unsubscribe(progress_channel(store_key))
+                except redis.RedisError as e:
+                    print(f"Failed to unsubscribe from {store_key}: {e}")
+
+    @asynccontextmanager
+    async def watch(self, store_key: str):
+        """Receive the progress events of a download for the duration of the context.
+
+        Yields:
+            asyncio.Queue: The queue the events of the download are put in, as dictionaries.
+        """
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+
+        def put(event):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+        await self.add_watcher(store_key, put)
+        try:
+            yield queue
+        finally:
+            await self.remove_watcher(store_key, put)
+
+    async def _read(self):
+        """Dispatch every received event to the watchers of its download."""
+        while True:
+            await self._subscribed.wait()
+            if not self._watchers:
+                self._subscribed.clear()
+                continue
+
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except redis.RedisError as e:
+                # The connection is re-established (and the channels re-subscribed) on the next read
+                print(f"Progress subscription failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+
+            store_key = message["channel"].decode("utf-8").split(":", 1)[1]
+            event = json.loads(message["data"])
+            for callback in list(self._watchers.get(store_key, ())):
+                callback(event)
+
+
+class ProgressSubscriptions:
+    """The downloads a client follows over a single connection, and their updates since the last flush.
+
+    Downloads are subscribed and unsubscribed while the connection is open. Only the latest event
+    of every download is kept between two flushes, so a client receives at most one update per
+    download per flush, however often the workers publish. A download is unsubscribed once its
+    final event was taken.
+
+    With a watcher registry, the client counts as waiting for every download it follows, as long
+    as refresh is called regularly.
+    """
+
+    # Seconds without an event after which the state of a download is read again, in case it ended unheard
+    REFRESH_AFTER = 30
+
+    def __init__(self, broker: ProgressBroker, lookup, max_subscriptions: int, watchers=None, watcher_id: str = None):
+        self.broker = broker
+        # Returns the current state of a download as an event, blocking (it reads Redis)
+        self.lookup = lookup
+        self.max_subscriptions = max_subscriptions
+        self.watchers = watchers
+        self.watcher_id = watcher_id
+        self._last_watch = 0.0
+        self._callbacks = {}
+        self._pending = {}
+        self._last_event = {}
+        # Set whenever there is something to flush
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self._callbacks)
+
+    def _on_event(self, store_key: str, event: dict):
+        self._pending[store_key] = event
+        self._last_event[store_key] = time.monotonic()
+        self.changed.set()
+
+    async def subscribe(self, store_keys: list[str]):
+        """Follow more downloads, starting with their current state. Raises ValueError past max_subscriptions."""
+        new = [store_key for store_key in dict.fromkeys(store_keys) if store_key not in self._callbacks]
+        if len(self._callbacks) + len(new) > self.max_subscriptions:
+            raise ValueError(f"A connection can follow at most {self.max_subscriptions} downloads.")
+
+        # Subscribe before reading the current state, so the final event cannot be missed
+        for store_key in new:
+            self._callbacks[store_key] = lambda event, store_key=store_key: self._on_event(store_key, event)
+            self._last_event[store_key] = time.monotonic()
+            await self.broker.add_watcher(store_key, self._callbacks[store_key])
+        if self.watchers is not None and new:
+            await asyncio.to_thread(self.watchers.watch, new, self.watcher_id)
+        states = await asyncio.to_thread(lambda: {store_key: self.lookup(store_key) for store_key in new})
+        for store_key, state in states.items():
+            # An event received in the meantime is more recent than the state
+            self._pending.setdefault(store_key, state)
+        self.changed.set()
+
+    async def unsubscribe(self, store_keys: list[str]):
+        removed = []
+        for store_key in store_keys:
+            callback = self._callbacks.pop(store_key, None)
+            if callback is not None:
+                await self.broker.remove_watcher(store_key, callback)
+                removed.append(store_key)
+            self._pending.pop(store_key, None)
+            self._last_event.pop(store_key, None)
+        if self.watchers is not None and removed:
+            try:
+                await asyncio.to_thread(self.watchers.leave, removed, self.watcher_id)
+            except redis.RedisError as e:
+                print(f"Failed to leave {len(removed)} downloads: {e}")
+
+    async def refresh(self):
+        """Renew the watch of the followed downloads, and read the state of the ones that were quiet for a
+        while, to catch the ones that ended unheard."""
+        now = time.monotonic()
+        if self.watchers is not None and self._callbacks and now - self._last_watch > self.watchers.WATCH_TTL / 3:
+            self._last_watch = now
+            try:
+                await asyncio.to_thread(self.watchers.watch, list(self._callbacks), self.watcher_id)
+            except redis.RedisError as e:
+                print(f"Failed to renew the watch of {len(self._callbacks)} downloads: {e}")
+
+        quiet = [store_key for store_key, last in self._last_event.items() if now - last > self.REFRESH_AFTER]
+        if not quiet:
+            return
+        states = await asyncio.to_thread(lambda: {store_key: self.lookup(store_key) for store_key in quiet})
+        for store_key, state in states.items():
+            self._last_event[store_key] = now
+            if state["status"] in TERMINAL_STATUSES and store_key in self._callbacks:
+                self._on_event(store_key, state)
+
+    async def take(self) -> dict:
+        """Return the latest event of every download that changed since the last call, by store key."""
+        updates, self._pending = self._pending, {}
+        self.changed.clear()
+        await self.unsubscribe([store_key for store_key, event in updates.items()
+                                if event["status"] in TERMINAL_STATUSES])
+        return updates
+
+    async def close(self):
+        await self.unsubscribe(list(self._callbacks))
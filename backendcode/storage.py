@@ -0,0 +1,302 @@
+import math
+import os
+import shutil
+import time
+
+import redis
+
+from backendcode.artifacts import ArtifactRegistry, node_queue
+from backendcode.celery_config import celery_app
+from backendcode.checkpoint import DownloadCheckpoint, is_partial_file
+from backendcode.data_models import EnvironmentVariablesConfig
+from backendcode.progress import progress_key
+from backendcode.video_store import VideoStore
+
+# Record an access to an artifact and update its eviction score. The score combines recency and
+# frequency: the time of the last access, plus a bonus that grows with the log of the number of hits.
+# Artifacts with the lowest score are evicted first.
+RECORD_ACCESS = """
+local hits = redis.call('HINCRBY', KEYS[1], 'hits', 1)
+redis.call('HSET', KEYS[1], 'last_access', ARGV[2])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[2]) + tonumber(ARGV[3]) * math.log(1 + hits) / math.log(2), ARGV[1])
+return hits
+"""
+
+
+class StorageManager:
+    """Keep the videos and thumbnails stored on disk within a byte quota.
+
+    Every stored file (an "artifact", named videos/<store_key> or thumbnails/<file name>) is indexed
+    in Redis with its size, number of hits and last access. A periodic sweep deletes the artifacts
+    that were not accessed for their persistence duration, and evicts the least valuable ones (by
+    recency and frequency) whenever the quota is exceeded. Downloads reserve their estimated size
+    before starting, so they can be refused or postponed while the storage is full. The index can
+    be rebuilt from the files on disk, so nothing is lost if Redis is flushed.
+    """
+
+    INDEX_KEY = "storage:index"
+    ENTRY_PREFIX = "storage:entry"
+    USAGE_KEY = "storage:usage"
+    RESERVATIONS_KEY = "storage:reservations"
+    SWEEP_LOCK_KEY = "storage:sweep-lock"
+
+    # The share of the quota the sweep keeps free, for the downloads the API admits without evicting anything
+    FREE_SHARE = 0.1
+    # Seconds of recency an artifact gains each time its number of hits doubles
+    FREQUENCY_WEIGHT = 300
+    # How long a reservation is held before it is considered abandoned (e.g., its worker died)
+    RESERVATION_TTL = 6 * 3600
+    # How long the partial files of a download can stay untouched before they are considered abandoned.
+    # It matches the visibility timeout of the broker, after which an unacknowledged download is
+    # delivered again (and resumes from these files).
+    PARTIAL_TTL = 6 * 3600
+
+    def __init__(self, redis_client: redis.Redis, videos_dir: str, thumbnails_dir: str, quota: int,
+                 video_ttl: int, thumbnail_ttl: int):
+        self.redis_client = redis_client
+        self.video_store = VideoStore(redis_client)
+        self.directories = {"videos": videos_dir, "thumbnails": thumbnails_dir}
+        for directory in self.directories.values():
+            os.makedirs(directory, exist_ok=True)
+        self.quota = quota
+        self.ttls = {"videos": video_ttl, "thumbnails": thumbnail_ttl}
+        self._record_access = redis_client.register_script(RECORD_ACCESS)
+
+    def _entry_key(self, artifact: str) -> str:
+        return f"{self.ENTRY_PREFIX}:{artifact}"
+
+    def _path(self, artifact: str) -> str:
+        kind, name = artifact.split("/", 1)
+        return os.path.join(self.directories[kind], os.path.basename(name))
+
+    def add(self, artifact: str, size: int, last_access: float = None):
+        """Index a new (or replaced) artifact."""
+        last_access = last_access or time.time()
+        previous = self.redis_client.hget(self._entry_key(artifact), "size")
+
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self._entry_key(artifact), mapping={"size": size, "hits": 0, "last_access": last_access})
+        pipe.zadd(self.INDEX_KEY, {artifact: last_access})
+        pipe.hincrby(self.USAGE_KEY, "bytes", size - int(previous or 0))
+        pipe.execute()
+
+    def is_indexed(self, artifact: str) -> bool:
+        return bool(self.redis_client.exists(self._entry_key(artifact)))
+
+    def record_access(self, artifact: str):
+        """Record an access to an artifact, making it less likely to be evicted."""
+        if self.redis_client.exists(self._entry_key(artifact)):
+            self._record_access(keys=[self._entry_key(artifact), self.INDEX_KEY],
+                                args=[artifact, time.time(), self.FREQUENCY_WEIGHT])
+
+    def used_bytes(self) -> int:
+        """Return the bytes used by the indexed artifacts and reserved by ongoing downloads."""
+        used = int(self.redis_client.hget(self.USAGE_KEY, "bytes") or 0)
+        now = time.time()
+        for value in self.redis_client.hvals(self.RESERVATIONS_KEY):
+            size, expires_at = value.decode("utf-8").split(":")
+            if float(expires_at) > now:
+                used += int(size)
+        return used
+
+    def has_capacity(self, size: int = 0, evict: bool = True, headroom: int = 0) -> bool:
+        """Check whether `size` more bytes fit, leaving `headroom` bytes of the quota free.
+
+        Unused artifacts are evicted to make room if needed, unless `evict` is False (e.g., while a
+        request waits, or for a speculative download, which must not push out the videos users asked for).
+        """
+        if shutil.disk_usage(self.directories["videos"]).free < size:
+            return False
+        overflow = self.used_bytes() + size + headroom - self.quota
+        if overflow > 0 and evict:
+            self.evict(overflow)
+            overflow = self.used_bytes() + size + headroom - self.quota
+        return overflow <= 0
+
+    def reserve(self, reservation_id: str, size: int, evict: bool = True, headroom: int = 0) -> bool:
+        """Reserve space for a download (see has_capacity). Returns False if the storage is full."""
+        if not self.has_capacity(size, evict, headroom):
+            return False
+        self.redis_client.hset(self.RESERVATIONS_KEY, reservation_id, f"{size}:{time.time() + self.RESERVATION_TTL}")
+        return True
+
+    def release_reservation(self, reservation_id: str):
+        """Release the space reserved for a download, once it finished or failed."""
+        self.redis_client.hdel(self.RESERVATIONS_KEY, reservation_id)
+
+    def evict(self, needed: int) -> int:
+        """Delete unused artifacts, least valuable first, until `needed` bytes are freed.
+
+        Returns:
+            int: The number of bytes freed.
+        """
+        freed = 0
+        for artifact in self.redis_client.zrange(self.INDEX_KEY, 0, -1):
+            if freed >= needed:
+                break
+            freed += self._delete(artifact.decode("utf-8"), idle_window=0)
+        if freed:
+            print(f"Evicted {freed} bytes to stay within the storage quota.")
+        return freed
+
+    def sweep(self):
+        """Delete the artifacts that were not accessed for their persistence duration, then enforce the quota
+        (evicting until FREE_SHARE of it is free).
+
+        Only one API process sweeps at a time.
+        """
+        if not self.redis_client.set(self.SWEEP_LOCK_KEY, 1, nx=True, ex=60):
+            return
+        try:
+            now = time.time()
+            for kind, ttl in self.ttls.items():
+                # Only artifacts whose score is old enough can be idle for longer than their duration
+                for artifact in self.redis_client.zrangebyscore(self.INDEX_KEY, "-inf", now - ttl):
+                    artifact = artifact.decode("utf-8")
+                    if artifact.startswith(f"{kind}/"):
+                        self._delete(artifact, idle_window=ttl)
+
+            # Forget the reservations of downloads that never finished
+            for reservation_id, value in self.redis_client.hgetall(self.RESERVATIONS_KEY).items():
+                if float(value.decode("utf-8").split(":")[1]) <= now:
+                    self.redis_client.hdel(self.RESERVATIONS_KEY, reservation_id)
+
+            self.sweep_partials()
+
+            overflow = self.used_bytes() - int(self.quota * (1 - self.FREE_SHARE))
+            if overflow > 0:
+                self.evict(overflow)
+        finally:
+            self.redis_client.delete(self.SWEEP_LOCK_KEY)
+
+    def sweep_partials(self):
+        """Delete the partial downloads nobody is going to resume.
+
+        The partial files of a download are kept while its worker (or the one it is delivered to
+        next) may still resume them. They are abandoned once they were not written for PARTIAL_TTL,
+        no execution holds the lease of the download, and its video is not being downloaded.
+        """
+        now = time.time()
+        for directory in os.scandir(self.directories["videos"]):
+            if not directory.is_dir():
+                continue
+            files = [f for f in os.scandir(directory.path) if f.is_file()]
+            if not any(is_partial_file(f.name) for f in files):
+                continue
+            if now - max(f.stat().st_mtime for f in files) < self.PARTIAL_TTL:
+                continue
+
+            store_key = directory.name
+            if self.redis_client.exists(DownloadCheckpoint.lease_key(store_key)):
+                continue
+            entry = self.video_store.get(store_key)
+            if entry.get("status") == "downloading":
+                # A download that was claimed again recently is about to resume these files
+                if now - float(entry.get("updated", 0)) < VideoStore.STALE_AFTER:
+                    continue
+                # Nobody is going to finish it, the next requester claims it again
+                self.video_store.fail(store_key)
+            elif entry.get("status") == "completed":
+                continue
+
+            shutil.rmtree(directory.path, ignore_errors=True)
+            self.redis_client.delete(DownloadCheckpoint.key(store_key), progress_key(store_key))
+            print(f"Deleted the abandoned partial download: videos/{store_key}")
+
+    def _delete(self, artifact: str, idle_window: int) -> int:
+        """Delete an artifact if it is unused and idle for the given window, returning the bytes freed."""
+        entry = self.redis_client.hgetall(self._entry_key(artifact))
+        size = int(entry.get(b"size", 0))
+        last_access = float(entry.get(b"last_access", 0))
+        kind, name = artifact.split("/", 1)
+
+        if kind == "videos":
+            # Videos being downloaded or watched are never deleted
+            state = self.video_store.mark_for_deletion(name, idle_window)
+            if state > 0:
+                return 0
+            # Files unknown to the store (e.g., left over from a flushed Redis) only go by their own access time
+            if state < 0 and time.time() - last_access < idle_window:
+                return 0
+            shutil.rmtree(self._path(artifact), ignore_errors=True)
+            # Without a shared volume, every node holding the video deletes its own copy
+            for node in ArtifactRegistry(self.redis_client).forget(artifact):
+                celery_app.send_task("backendcode.tasks.delete_artifact", args=[artifact], queue=node_queue(node))
+            if state == 0:
+                self.video_store.forget(name)
+        else:
+            if time.time() - last_access < idle_window:
+                return 0
+            try:
+                os.remove(self._path(artifact))
+            except FileNotFoundError:
+                pass
+
+        pipe = self.redis_client.pipeline()
+        if kind == "videos":
+            pipe.delete(progress_key(name))
+        pipe.delete(self._entry_key(artifact))
+        pipe.zrem(self.INDEX_KEY, artifact)
+        pipe.hincrby(self.USAGE_KEY, "bytes", -size)
+        pipe.execute()
+        print(f"Deleted: {artifact}")
+        return size
+
+    def rebuild(self):
+        """Rebuild the index from the files on disk, keeping the access statistics Redis still has."""
+        artifacts = {}
+        for kind, directory in self.directories.items():
+            for entry in os.scandir(directory):
+                # Partial thumbnails are still being written
+                if entry.name.endswith(".part"):
+                    continue
+                if entry.is_dir():
+                    files = [f for f in os.scandir(entry.path) if f.is_file()]
+                    # Downloads that did not complete are not stored videos, sweep_partials takes care of them
+                    if any(is_partial_file(f.name) for f in files):
+                        continue
+                    size = sum(f.stat().st_size for f in files)
+                    mtime = max((f.stat().st_mtime for f in files), default=entry.stat().st_mtime)
+                else:
+                    size = entry.stat().st_size
+                    mtime = entry.stat().st_mtime
+                artifacts[f"{kind}/{entry.name}"] = (size, mtime)
+
+        # Videos stored on other nodes are not on this disk, but they are still stored
+        registry = ArtifactRegistry(self.redis_client)
+        pipe = self.redis_client.pipeline()
+        for artifact in self.redis_client.zrange(self.INDEX_KEY, 0, -1):
+            artifact = artifact.decode("utf-8")
+            if artifact in artifacts:
+                continue
+            entry = self.redis_client.hgetall(self._entry_key(artifact))
+            if entry and registry.holders(artifact):
+                artifacts[artifact] = (int(entry.get(b"size", 0)), float(entry.get(b"last_access", 0)))
+            else:
+                pipe.delete(self._entry_key(artifact))
+        pipe.delete(self.INDEX_KEY)
+        for artifact, (size, mtime) in artifacts.items():
+            entry = self.redis_client.hgetall(self._entry_key(artifact))
+            hits = int(entry.get(b"hits", 0))
+            last_access = max(float(entry.get(b"last_access", 0)), mtime)
+            pipe.hset(self._entry_key(artifact), mapping={"size": size, "hits": hits, "last_access": last_access})
+            pipe.zadd(self.INDEX_KEY, {artifact: last_access + self.FREQUENCY_WEIGHT * math.log2(1 + hits)})
+        pipe.hset(self.USAGE_KEY, "bytes", sum(size for size, _ in artifacts.values()))
+        pipe.execute()
+        print(f"Storage index rebuilt: {len(artifacts)} artifacts.")
+
+    def stats(self) -> dict:
+        """Return the usage of the storage."""
+        return {
+            "quota": self.quota,
+            "used": int(self.redis_client.hget(self.USAGE_KEY, "bytes") or 0),
+            "reserved": self.used_bytes() - int(self.redis_client.hget(self.USAGE_KEY, "bytes") or 0),
+            "artifacts": self.redis_client.zcard(self.INDEX_KEY),
+        }
+
+
+def get_storage_manager(redis_client: redis.Redis) -> StorageManager:
+    """Return the storage manager set up from the environment variables."""
+    config = EnvironmentVariablesConfig()
+    return StorageManager(redis_client, config.fullpath_videos, config.fullpath_thumbnails, config.storage_quota_bytes,
+                          config.video_persistence_duration, config.thumbnail_persistence_duration)
@@ -0,0 +1,106 @@
+import subprocess
+import tempfile
+import time
+
+import redis
+
+# A streamed video is remuxed by ffmpeg on a worker and relayed to the API through a Redis stream,
+# chunk by chunk, without ever being written to disk. The API process reading the stream keeps a
+# "reader" key alive, so the worker stops as soon as the client goes away.
+STREAM_PREFIX = "stream"
+
+# Size of the chunks read from ffmpeg and relayed to the API
+CHUNK_SIZE = 256 * 1024
+# Chunks the worker can get ahead of the API before it waits for them to be read (backpressure)
+WINDOW = 32
+# Seconds the reader key lives without being refreshed, and how long a stream lives after its last write
+READER_TTL = 30
+STREAM_TTL = 120
+
+
+def stream_key(stream_id: str) -> str:
+    """Return the key of the Redis stream a video is relayed through."""
+    return f"{STREAM_PREFIX}:{stream_id}"
+
+
+def reader_key(stream_id: str) -> str:
+    """Return the key the API keeps alive while a client is reading a stream."""
+    return f"{STREAM_PREFIX}:{stream_id}:reader"
+
+
+class StreamAbandoned(Exception):
+    """Raised when nobody reads a stream anymore."""
+
+
+def build_remux_command(formats: list[dict]) -> list[str]:
+    """Build the ffmpeg command that remuxes the selected formats into a fragmented MP4 written to stdout.
+
+    Fragmented MP4 (an empty moov atom followed by self-contained fragments) can be played and saved
+    while it is being written, unlike a regular MP4 whose index is only written at the end.
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin"]
+    for fmt in formats:
+        headers = "".join(f"{name}: {value}\r\n" for name, value in (fmt.get("http_headers") or {}).items())
+        if headers:
+            command += ["-headers", headers]
+        command += ["-i", fmt["url"]]
+
+    if len(formats) > 1:
+        # The first format is the video, the second one the audio
+        command += ["-map", "0:v:0", "-map", "1:a:0"]
+    command += [
+        "-c", "copy",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "-f", "mp4", "pipe:1",
+    ]
+    return command
+
+
+def relay_remux(redis_client: redis.Redis, stream_id: str, formats: list[dict]):
+    """Run ffmpeg on the selected formats and relay its output to the API through the stream.
+
+    Raises:
+        StreamAbandoned: If the API stops reading the stream.
+        RuntimeError: If ffmpeg fails.
+    """
+    key = stream_key(stream_id)
+    # The errors go to a file rather than a pipe: nobody reads them before ffmpeg exits, and a full pipe
+    # would block ffmpeg (and so the relay) on a long remux
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen(build_remux_command(formats), stdout=subprocess.PIPE, stderr=errors)
+    try:
+        while True:
+            chunk = process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            # Wait for the API to catch up, giving up if it stopped reading
+            while redis_client.xlen(key) >= WINDOW:
+                if not redis_client.exists(reader_key(stream_id)):
+                    raise StreamAbandoned()
+                time.sleep(0.05)
+            if not redis_client.exists(reader_key(stream_id)):
+                raise StreamAbandoned()
+
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.xadd(key, {"data": chunk})
+            pipe.expire(key, STREAM_TTL)
+            pipe.execute()
+
+        if process.wait() != 0:
+            errors.seek(0)
+            raise RuntimeError(errors.read().decode("utf-8", errors="replace").strip() or "ffmpeg failed")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        errors.close()
+
+
+def end_stream(redis_client: redis.Redis, stream_id: str, error: str = ""):
+    """Tell the API that a stream ended, successfully or with an error."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.xadd(stream_key(stream_id), {"eof": "1", "error": error})
+    pipe.expire(stream_key(stream_id), STREAM_TTL)
+    pipe.execute()
@@ -1,28 +1,259 @@
 from backendcode.celery_config import celery_app
 import yt_dlp
+import httpx
+import json
 import os
 import redis
-import time
 import shutil
+import threading
+import time
+import uuid
 
 from backendcode.data_models import EnvironmentVariablesConfig
+from backendcode.video_store import VideoStore
+from backendcode.progress import ProgressReporter
+from backendcode.video_info import project_info, save_full_info, load_full_info, estimate_download_size, download_selector
+from backendcode.storage import get_storage_manager
+from backendcode.admission import AdmissionController, AdmissionRejected
+from backendcode.batch import BatchTracker
+from backendcode.streaming import StreamAbandoned, relay_remux, end_stream, stream_key
+from backendcode.utils import chunks
+from backendcode.ydl_pool import get_pool
+from backendcode.checkpoint import DownloadCheckpoint, existing_bytes, is_partial_file
+from backendcode.watchers import WatcherRegistry
+from backendcode.prefetch import FormatPicks, PrefetchRegistry
+from backendcode.artifacts import ArtifactRegistry, node_queue
+from backendcode.file_server import serve_files
+from backendcode.parallel_download import register_parallel_downloader
+from backendcode.tracing import get_tracer
+from backendcode.metrics import (QUEUE_WAIT, EXTRACT_DURATION, DOWNLOAD_DURATION, DOWNLOAD_SPEED, MERGE_DURATION,
+                                 DOWNLOADS_CANCELLED, CANCELLED_BYTES, PREFETCHES_STARTED, PREFETCH_OUTCOMES,
+                                 PREFETCH_WASTED_BYTES, serve_metrics, mark_process_dead)
+from celery import chain, group
+from celery.exceptions import Retry
+from celery.signals import (celeryd_init, task_prerun, worker_init, worker_process_init,
+                            worker_process_shutdown)
+from celery.concurrency import get_implementation
+from yt_dlp.utils import DownloadCancelled, download_range_func
+from datetime import datetime
 
 config = EnvironmentVariablesConfig()
 
 print(config)
 
+# How long a download waits for space when the storage is full, and how many times it waits before failing
+STORAGE_RETRY_DELAY = 30
+STORAGE_MAX_RETRIES = 20
+# How many times a download delivered again waits for another execution of it to stop, before leaving the video to it
+LEASE_MAX_RETRIES = 30
+# How often (in seconds) a running download checks whether anybody still waits for it
+WATCH_CHECK_INTERVAL = 5
+# How long a batch item waits for a download someone else is making, before giving up on the video,
+# and how often it checks on it (the item goes back to the queue in between, it holds no worker while waiting)
+BATCH_WAIT_TIMEOUT = 3 * 3600
+BATCH_WAIT_INTERVAL = 15
+# The share of the storage quota speculative downloads leave free, they never evict anything to fit
+PREFETCH_STORAGE_HEADROOM = 0.1
+# Speculative downloads only use the workers nobody else needs (0 is the highest priority, see celery_config.py)
+PREFETCH_PRIORITY = 8
+
+# The options every task of a kind shares, the per-task ones are set on the instance they lease from the pool
+EXTRACT_OPTIONS = {'quiet': True, 'listformats': False}
+# Downloads continue the partial files a previous attempt left behind, and fetch every file (or the fragments
+# of a stream) over several connections, the single files with the parallel downloader
+DOWNLOAD_OPTIONS = {"keepvideo": False, "merge_output_format": "mp4", "continuedl": True,
+                    "concurrent_fragment_downloads": config.download_connections}
+if config.download_connections > 1:
+    DOWNLOAD_OPTIONS["external_downloader"] = {"http": register_parallel_downloader()}
+
+class DownloadAbandoned(DownloadCancelled):
+    """Raised from the progress hook to stop a download nobody is waiting for anymore."""
+    msg = "Nobody is waiting for the download anymore"
+
+    def __init__(self, reason="abandoned"):
+        super().__init__()
+        self.reason = reason
+
 def get_redis_client():
     return redis.Redis(host=config.redis_address, port=config.redis_port, db=1)
 
+def warm_pools(count):
+    """Build the YoutubeDL instances of this process before its first tasks arrive."""
+    get_pool("extract", EXTRACT_OPTIONS).warm(count)
+    get_pool("download", DOWNLOAD_OPTIONS).warm(count)
+
+@worker_init.connect
+def warm_worker(sender=None, **kwargs):
+    # Thread and solo pools run the tasks in the main process, prefork children warm their own instances
+    if "prefork" not in get_implementation(sender.pool_cls).__module__:
+        warm_pools(sender.concurrency)
+
+@worker_process_init.connect
+def warm_worker_process(**kwargs):
+    warm_pools(1)
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    # The metrics of every process of the pool are served by the main process of the worker
+    if config.worker_metrics_port:
+        serve_metrics(config.worker_metrics_port)
+
+@worker_process_shutdown.connect
+def forget_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+@celeryd_init.connect
+def consume_node_queue(sender=None, instance=None, **kwargs):
+    # A node with its own disk also runs the copies and the deletions of the files it holds
+    if config.file_server_port:
+        instance.app.amqp.queues.select_add(node_queue(config.node_name))
+
+@worker_init.connect
+def start_file_server(**kwargs):
+    # The videos are on the local disk of the node, its file server serves them to the API and to the other nodes
+    if not config.file_server_port or serve_files(config.fullpath_videos, config.file_server_port) is None:
+        return
+    registry = ArtifactRegistry(get_redis_client())
+    registry.heartbeat(config.node_name, config.node_url)
+    register_local_videos(registry)
+    threading.Thread(target=announce_node, args=(registry,), name="node-heartbeat", daemon=True).start()
+
+def register_local_videos(registry: ArtifactRegistry):
+    """Register the videos already on the disk of this node (e.g., after a restart)."""
+    storage = get_storage_manager(get_redis_client())
+    count = 0
+    for entry in os.scandir(config.fullpath_videos):
+        if not entry.is_dir():
+            continue
+        files = [f for f in os.scandir(entry.path) if f.is_file()]
+        if not files or any(is_partial_file(f.name) for f in files):
+            continue
+        registry.add(f"videos/{entry.name}", config.node_name)
+        # Videos the storage index lost track of are indexed again, so they are swept eventually
+        if not storage.is_indexed(f"videos/{entry.name}"):
+            storage.add(f"videos/{entry.name}", sum(f.stat().st_size for f in files))
+        count += 1
+    print(f"Registered {count} videos on node {config.node_name}")
+
+@worker_init.connect
+def start_capacity_announcements(sender=None, **kwargs):
+    # The API estimates how fast each queue drains from how many tasks its workers run at once
+    queues = list(sender.app.amqp.queues.consume_from or sender.app.amqp.queues)
+    threading.Thread(target=announce_capacity, args=(sender.hostname, queues, sender.concurrency),
+                     name="capacity-heartbeat", daemon=True).start()
+
+def announce_capacity(hostname: str, queues: list[str], concurrency: int):
+    admission = AdmissionController(get_redis_client())
+    while True:
+        try:
+            admission.announce_capacity(hostname, queues, concurrency)
+        except redis.RedisError as e:
+            print(f"Failed to announce the capacity of {hostname}: {e}")
+        time.sleep(AdmissionController.CAPACITY_INTERVAL)
+
+def announce_node(registry: ArtifactRegistry):
+    while True:
+        time.sleep(ArtifactRegistry.HEARTBEAT_INTERVAL)
+        try:
+            registry.heartbeat(config.node_name, config.node_url)
+        except redis.RedisError as e:
+            print(f"Failed to announce node {config.node_name}: {e}")
+
+@task_prerun.connect
+def record_queue_wait(task_id=None, task=None, **kwargs):
+    published_at = task.request.get("published_at")
+    if published_at is None or task.request.is_eager:
+        return
+    # A retried task waits for its countdown on purpose, only the time after it counts
+    queued_at = float(published_at)
+    if task.request.eta:
+        queued_at = max(queued_at, datetime.fromisoformat(task.request.eta).timestamp())
+    wait = max(0.0, time.time() - queued_at)
+    name = task.name.rsplit(".", 1)[-1]
+    QUEUE_WAIT.labels(name).observe(wait)
+    get_tracer(get_redis_client()).record(task_id, "queue_wait", queued_at, wait, task=name)
+
 @celery_app.task
 def extract_info(url):
-    """Fetch video metadata using yt-dlp."""
-    ydl_opts = {'quiet': True, 'listformats': False}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return ydl.extract_info(url, download=False)
+    """Fetch video metadata using yt-dlp.
 
-@celery_app.task(bind=True)
-def download_video(self,task_id, url, video_format):
+    Only a compact projection of the metadata is returned to the result backend. The full info
+    dict is stored compressed on the side, for the download task and for explicit requests.
+    """
+    started = time.monotonic()
+    tracer = get_tracer(get_redis_client())
+    try:
+        with tracer.span(extract_info.request.id, "extract_info", EXTRACT_DURATION, url=url):
+            with get_pool("extract", EXTRACT_OPTIONS).lease() as ydl:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+        save_full_info(get_redis_client(), info['id'], info, config.metadata_cache_ttl)
+        projected = project_info(info)
+        if config.prefetch_min_picks > 0:
+            prefetch_likeliest_format(projected)
+        return projected
+    finally:
+        # The API estimates how long new extractions will wait from how fast they complete
+        AdmissionController(get_redis_client()).record_completion("metadata", time.monotonic() - started)
+
+def prefetch_likeliest_format(info):
+    """Start downloading the format the user of a video is most likely to pick, while they are still choosing.
+
+    Only when the server has room for it: the download must be admitted and fit in the storage. The
+    prefetch is best effort, it never fails the extraction.
+    """
+    redis_client = get_redis_client()
+    try:
+        entry = FormatPicks(redis_client).likeliest(info["duration"], info["format_index"],
+                                                    config.prefetch_min_picks, config.prefetch_min_share)
+        if entry is None:
+            return
+        admission = AdmissionController(redis_client, max_downloads=config.admission_max_downloads,
+                                        max_bandwidth=config.admission_max_bandwidth)
+        admission.admit_download()
+        storage = get_storage_manager(redis_client)
+        if not storage.has_capacity(entry["size"] or 0, evict=False,
+                                    headroom=int(storage.quota * PREFETCH_STORAGE_HEADROOM)):
+            return
+    except AdmissionRejected:
+        return
+    except Exception as e:
+        print(f"Failed to prefetch a format of {info['id']}: {e}")
+        return
+
+    video_id, video_format = info["id"], entry["format_id"]
+    store_key = VideoStore.key_for(video_id, video_format)
+    video_store = VideoStore(redis_client)
+    download_id = str(uuid.uuid4())
+    try:
+        state, _ = video_store.acquire(store_key, download_id)
+    except Exception as e:
+        print(f"Failed to prefetch {store_key}: {e}")
+        return
+    try:
+        # Nothing to prefetch if the format is already stored, or being downloaded
+        if state != "claimed":
+            return
+        try:
+            PrefetchRegistry(redis_client).start(video_id, store_key, video_format, download_id)
+            admission.register_download(download_id)
+            download_video.apply_async(args=[store_key, info["original_url"], video_format, video_id],
+                                       kwargs={"prefetch": True}, task_id=download_id, priority=PREFETCH_PRIORITY)
+        except Exception as e:
+            print(f"Failed to prefetch {store_key}: {e}")
+            video_store.fail(store_key)
+            return
+        PREFETCHES_STARTED.inc()
+        print(f"Prefetching {video_id} in format {video_format} ({store_key}).")
+    finally:
+        # The prefetch holds no reference, the stored video is kept by whoever picks it
+        video_store.release(store_key)
+
+# The message of a download is only acknowledged once the download ended, and it goes back to the queue
+# if its worker dies, so another worker resumes the download from the files left on the shared volume
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def download_video(self, store_key, url, video_format, video_id=None, batch_id=None, batch_index=None, prefetch=False,
+                   section=None, audio_only=False):
 
     # Test if a connection could be established with redis
     redis_client = get_redis_client()
@@ -32,83 +263,406 @@ def download_video(self,task_id, url, video_format):
         print(f"Redis connection failed: {e}")
         raise
 
-    # Define a progress hook that keep redis updated with the download status
-    def progress_hook(d):
-        if d['status'] == 'downloading':
-            redis_client.set(task_id+":eta",d['_eta_str'])
-            redis_client.set(task_id+":speed",d['_speed_str'])
-            redis_client.set(task_id+":progress",d['_percent_str'])
-            redis_client.set(task_id+":status","downloading")
-        if d['status'] == 'finished':
-            time.sleep(2)
-            redis_client.set(task_id + ":status", "finished")
-
-    # Ensure the video directory exists and create a folder for the task_id
+    # The download might have been reclaimed by another task while this one was waiting in the queue,
+    # or completed already if this task is delivered again
+    video_store = VideoStore(redis_client)
+    admission = AdmissionController(redis_client)
+    if not video_store.resume(store_key, self.request.id):
+        admission.finish_download(self.request.id)
+        return {"status": "skipped", "message": "Video is being downloaded by another task."}
+
+    # Only one execution of the task writes the files at a time. A redelivered task waits for the
+    # lease of the execution it replaces to expire, in case that one is still running.
+    checkpoint = DownloadCheckpoint(redis_client, store_key)
+    if checkpoint.take_lease() is not None:
+        if not self.request.is_eager and self.request.retries < LEASE_MAX_RETRIES:
+            raise self.retry(countdown=DownloadCheckpoint.LEASE_TTL, max_retries=LEASE_MAX_RETRIES)
+        return {"status": "skipped", "message": "Video is being downloaded by another worker."}
+
+    # Downloads that are part of a batch also report their progress on the channel of the batch
+    batch = BatchTracker(redis_client, batch_id, config.video_persistence_duration) if batch_id else None
+
+    def on_progress_write(pipe, event):
+        video_store.heartbeat(store_key, pipe)
+        checkpoint.write(pipe)
+        admission.heartbeat(self.request.id, reporter.speed, pipe)
+        if batch is not None and event["status"] in ("downloading", "finished"):
+            batch.update_item(batch_index, {"video_id": video_id, "status": "downloading",
+                                            "progress": event["progress"]}, pipe)
+
+    # Keep redis updated with the download status, and push it to the API. Progress is tracked
+    # under the store key, so every requester of this video/format sees it.
+    reporter = ProgressReporter(redis_client, store_key, config.progress_update_interval,
+                                config.video_persistence_duration, on_write=on_progress_write)
+
+    # Reuse the metadata extracted by extract_info when it is still stored, to skip a second extraction
+    info = load_full_info(redis_client, video_id) if video_id else None
+
+    # Time the post-processors, the merge of the video and audio streams in particular
+    tracer = get_tracer(redis_client)
+    postprocessors_started = {}
+
+    def on_postprocess(d):
+        name = d.get('postprocessor')
+        if d['status'] == 'started':
+            postprocessors_started[name] = (time.time(), time.monotonic())
+        elif d['status'] == 'finished' and name in postprocessors_started:
+            started, start = postprocessors_started.pop(name)
+            duration = time.monotonic() - start
+            if name == 'Merger':
+                MERGE_DURATION.observe(duration)
+            tracer.record(self.request.id, "merge" if name == 'Merger' else "postprocess", started, duration,
+                          postprocessor=name)
+
+    # A download is cancelled once every client following it left for the grace period. Downloads of
+    # a batch are exempt, the client waits for the whole batch rather than for each of its videos.
+    # A speculative download is not cancelled for having no watchers while its user is choosing a format:
+    # it stops if they pick another one (or none in time), and becomes a regular download otherwise.
+    watchers = WatcherRegistry(redis_client)
+    cancellable = batch_id is None and config.download_cancel_grace > 0
+    prefetches = PrefetchRegistry(redis_client) if prefetch else None
+    last_watch_check = 0.0
+
+    def cancellation_reason():
+        """Return why the download must stop, or None if it goes on."""
+        nonlocal prefetches
+        unwatched = watchers.unwatched_for(store_key)
+        if prefetches is not None:
+            status = prefetches.status(video_id)
+            if status == "pending":
+                return None
+            # Somebody following the video (e.g., who picked it after the prefetch was settled) keeps it
+            if status != "hit" and unwatched is None:
+                return "prefetch_miss" if status == "miss" else "prefetch_expired"
+            prefetches = None
+        if cancellable and unwatched is not None and unwatched > config.download_cancel_grace:
+            return "abandoned"
+        return None
+
+    def check_watchers(d):
+        nonlocal last_watch_check
+        if (not cancellable and prefetches is None) or time.monotonic() - last_watch_check < WATCH_CHECK_INTERVAL:
+            return
+        last_watch_check = time.monotonic()
+        reason = cancellation_reason()
+        if reason is not None:
+            raise DownloadAbandoned(reason)
+
+    def cancel(reason):
+        # Nobody resumes a cancelled download, its partial files and its checkpoint go away
+        shutil.rmtree(os.path.join(config.fullpath_videos, store_key), ignore_errors=True)
+        checkpoint.clear()
+        checkpoint.release_lease()
+        watchers.forget(store_key)
+        video_store.fail(store_key, reason)
+        reporter.fail({"status": "error", "message": "The download was cancelled, nobody was waiting for it.",
+                       "reason": reason})
+        DOWNLOADS_CANCELLED.labels(reason).inc()
+        CANCELLED_BYTES.labels(reason).inc(reporter.transferred_bytes())
+        if reason.startswith("prefetch"):
+            PREFETCH_WASTED_BYTES.inc(reporter.transferred_bytes())
+            # Hits and misses are counted when the user picks, nobody counts a prefetch nobody settled
+            if reason == "prefetch_expired":
+                PREFETCH_OUTCOMES.labels("expired").inc()
+        tracer.record(self.request.id, "cancelled", time.time(), 0.0, reason=reason,
+                      transferred_bytes=reporter.transferred_bytes())
+        print(f"Cancelled the download of {store_key}: {reason}")
+        return {"status": "cancelled", "message": "The download was cancelled, nobody was waiting for it."}
+
+    # Everybody may have left (or picked another format) while the download was waiting in the queue
+    reason = cancellation_reason()
+    if reason is not None:
+        admission.finish_download(self.request.id)
+        return cancel(reason)
+
+    # Reserve the space the video needs. When the storage is full, the download waits in the queue
+    # for the sweep to free some space, unless it runs inline (e.g., as part of a batch).
+    storage = get_storage_manager(redis_client)
+    projected = project_info(info) if info is not None else None
+    expected_size = estimate_download_size(projected["formats"], video_format, audio_only, section,
+                                           projected["duration"]) if projected is not None else 0
+    # A prefetch nobody picked yet only takes space that is free, it never evicts the videos users asked for
+    if prefetches is not None:
+        reserved = storage.reserve(self.request.id, expected_size, evict=False,
+                                   headroom=int(storage.quota * PREFETCH_STORAGE_HEADROOM))
+    else:
+        reserved = storage.reserve(self.request.id, expected_size)
+    if not reserved:
+        checkpoint.release_lease()
+        if not self.request.is_eager and self.request.retries < STORAGE_MAX_RETRIES:
+            video_store.heartbeat(store_key)
+            raise self.retry(countdown=STORAGE_RETRY_DELAY, max_retries=STORAGE_MAX_RETRIES)
+        video_store.fail(store_key)
+        admission.finish_download(self.request.id)
+        reporter.fail({"status": "error", "message": "The storage is full, please try again later."})
+        raise Exception("The storage is full.")
+
+    # Ensure the video directory exists and create a folder for the store key
     output_directory = config.fullpath_videos
-    task_directory = os.path.join(output_directory, task_id)
-    os.makedirs(task_directory, exist_ok=True)
+    store_directory = os.path.join(output_directory, store_key)
+    os.makedirs(store_directory, exist_ok=True)
+
+    # Continue from what a previous attempt left in the directory, yt-dlp resumes its partial files and fragments.
+    # The files are only trusted when the checkpoint tells they were written for the same selection (the formats,
+    # the audio, the time range), the files of another one (or of an attempt nobody recorded) are not mixed in.
+    selection = json.dumps([download_selector(video_format, audio_only), section])
+    if checkpoint.load().get("selection") != selection and os.listdir(store_directory):
+        print(f"Discarding the files left in {store_directory}, they were not written for this download.")
+        shutil.rmtree(store_directory, ignore_errors=True)
+        os.makedirs(store_directory, exist_ok=True)
+    reporter.resumed_bytes = existing_bytes(store_directory)
+    attempt = checkpoint.start_attempt(reporter.resumed_bytes, selection)
+    if reporter.resumed_bytes:
+        print(f"Resuming the download of {store_key} from {reporter.resumed_bytes} bytes (attempt {attempt}).")
+        tracer.record(self.request.id, "resume", time.time(), 0.0, resumed_bytes=reporter.resumed_bytes, attempt=attempt)
 
     # Define the path to store the video at along with its name
-    video_Path = os.path.join(task_directory, 'video.%(ext)s')
+    video_Path = os.path.join(store_directory, 'video.%(ext)s')
 
-    # Define the download options for yt-dlp
+    # Define the download options for yt-dlp (the ones shared by every download are in DOWNLOAD_OPTIONS)
     ydl_opts = {
-        'format': f"{video_format}+ba[ext!=webm]",  # Select the format and best audio
-        'progress_hooks': [progress_hook],  # Hook for live updates
+        'format': download_selector(video_format, audio_only),  # Select the format and best audio (or only the audio)
+        'progress_hooks': [checkpoint.hook, reporter.hook, check_watchers],  # Checkpoint, live updates, cancellation
+        'postprocessor_hooks': [on_postprocess],
         'outtmpl': video_Path,
-        "keepvideo": False,
-        "merge_output_format": "mp4",
     }
+    # A clip is cut by ffmpeg, which only reads the bytes (or the fragments) of the time range from the origin.
+    # The cuts fall on the keyframes before them and the streams are copied, nothing is encoded again.
+    if section is not None:
+        start, end = section
+        ydl_opts['download_ranges'] = download_range_func(None, [(start, end if end is not None else float('inf'))])
 
     # start the download procedure
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+    try:
+        with tracer.span(self.request.id, "download", store_key=store_key, format=video_format) as span:
+            # The lease (and the heartbeat of the video) are kept alive even while ffmpeg merges the streams
+            with checkpoint.keep_alive(heartbeat=lambda: video_store.heartbeat(store_key)):
+                with get_pool("download", DOWNLOAD_OPTIONS).lease(**ydl_opts) as ydl:
+                    if info is not None:
+                        ydl.process_ie_result(info, download=True)
+                    else:
+                        ydl.download([url])
+            span["speed"] = round(reporter.network_speed())
+    except DownloadAbandoned as e:
+        DOWNLOAD_DURATION.labels("cancelled").observe(time.monotonic() - reporter.started)
+        return cancel(e.reason)
+    except Exception:
+        DOWNLOAD_DURATION.labels("failed").observe(time.monotonic() - reporter.started)
+        # Let the next requester claim the download again, it resumes from the files (and the checkpoint) left behind
+        video_store.fail(store_key)
+        checkpoint.release_lease()
+        reporter.fail({"status": "error", "message": "Video download failed, please try again."})
+        raise
+    finally:
+        storage.release_reservation(self.request.id)
+        admission.finish_download(self.request.id, time.monotonic() - reporter.started)
 
     # Since we do not know in advance the extension of the file is, and there will only be one file in the directory, 
     # we can just get the first file
-    file_names = [f for f in os.listdir(task_directory) if os.path.isfile(os.path.join(task_directory, f))]
+    file_names = [f for f in os.listdir(store_directory) if os.path.isfile(os.path.join(store_directory, f))]
+    file_size = os.path.getsize(os.path.join(store_directory, file_names[0]))
 
     # This the URL that the user will navigate to download the video.
-    redis_client.set(f"{task_id}:path",f"/videos/{task_id}/{file_names[0]}")
-
-    # Schedule a video deletion task to be completed later
-    delete_video_folder.apply_async(args=[task_id], countdown=config.video_persistence_duration)
+    video_path = f"/videos/{store_key}/{file_names[0]}"
+    storage.add(f"videos/{store_key}", file_size)
+    # Without a shared volume, the API finds the video through the node that holds it
+    if config.file_server_port:
+        ArtifactRegistry(redis_client).add(f"videos/{store_key}", config.node_name)
+    completed = {"status": "completed", "message": "Video download finished!", "URL": video_path}
+    # Clips and audio tell how much less they took than the full video would have
+    if (section is not None or audio_only) and projected is not None:
+        full_format = video_format or next((entry["format_id"] for entry in projected["format_index"]), None)
+        full_size = estimate_download_size(projected["formats"], full_format)
+        if full_size:
+            completed["bytes_saved"] = max(0, full_size - file_size)
+    video_store.complete(store_key, video_path, file_size, completed.get("bytes_saved"))
+    reporter.complete(completed)
+    checkpoint.clear()
+    checkpoint.release_lease()
+    watchers.forget(store_key)
+    DOWNLOAD_DURATION.labels("completed").observe(time.monotonic() - reporter.started)
+    DOWNLOAD_SPEED.observe(reporter.network_speed())
+    # The file is served under the store key, which the trace continues with
+    tracer.link(self.request.id, store_key, "stored", size=file_size)
 
     return {"status": "completed", "message": "Video download finished!"}
 
 
 @celery_app.task
-def delete_thumbnail(task_id: str):
-    
-    """Delete the thumbnail image that was saved for a video download task.
+def replicate_artifact(artifact, path, source_url):
+
+    """Copy a stored video from another node to this one, which is then registered as holding it too.
 
-    Finds the thumbnail image in the thumbnail directory and delete the one that matches the task_id.
+    Sent to the queue of the node receiving the copy when the video gets a lot of traffic.
+    `path` is the URL path of the video (/videos/<store_key>/<file name>).
     """
-    thumb_directory = config.fullpath_thumbnails
-    for file in os.listdir(thumb_directory):
-        full_path = os.path.join(thumb_directory, file)
-        if os.path.isfile(full_path) and task_id in file:
-            os.remove(full_path)
-            print(f"Deleted thumbnail: {full_path}")
-            return
-    print(f"Thumbnail not found: {full_path}")
+
+    registry = ArtifactRegistry(get_redis_client())
+    _, _, store_key, file_name = path.split("/", 3)
+    directory = os.path.join(config.fullpath_videos, store_key)
+    target = os.path.join(directory, file_name)
+    if os.path.isfile(target):
+        registry.add(artifact, config.node_name)
+        return {"status": "exists"}
+
+    # The copy is written under a partial name, so it is never served (or registered) before it is whole
+    os.makedirs(directory, exist_ok=True)
+    partial = f"{target}.part"
+    started = time.monotonic()
+    try:
+        with httpx.stream("GET", f"{source_url}{path}", timeout=30) as response:
+            response.raise_for_status()
+            with open(partial, "wb") as file:
+                for chunk in response.iter_bytes(1024 * 1024):
+                    file.write(chunk)
+        os.replace(partial, target)
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    # The video might have been deleted while it was copied, in which case the copy goes too
+    if get_storage_manager(get_redis_client()).is_indexed(artifact):
+        registry.add(artifact, config.node_name)
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+        return {"status": "deleted"}
+    print(f"Copied {artifact} from {source_url} in {time.monotonic() - started:.1f}s")
+    return {"status": "copied", "size": os.path.getsize(target)}
+
+
+@celery_app.task
+def delete_artifact(artifact):
+
+    """Delete the copy of a video this node holds, once the storage sweep deleted the video."""
+
+    _, store_key = artifact.split("/", 1)
+    shutil.rmtree(os.path.join(config.fullpath_videos, os.path.basename(store_key)), ignore_errors=True)
+    ArtifactRegistry(get_redis_client()).remove(artifact, config.node_name)
+    print(f"Deleted the copy of {artifact}")
 
 
 @celery_app.task
-def delete_video_folder(task_id: str):
+def stream_video(stream_id, url, video_format, video_id=None):
+
+    """Remux a video into fragmented MP4 and relay it to the API while it is being downloaded.
 
-    """Delete the video folder that was saved for a video download task.
-    
-    Finds the folder in the video directory and delete the one that matches the task_id.
+    Unlike download_video, nothing is written to disk: ffmpeg reads the selected video and audio
+    streams straight from their source and its output is relayed chunk by chunk to the client.
     """
 
-    # Build the path to the video directory of the task_id
-    video_output_directory = config.fullpath_videos
-    video_task_directory = os.path.join(video_output_directory, task_id)
+    redis_client = get_redis_client()
+    # Fall back to the format alone when it cannot be merged with a separate audio stream
+    video_format = f"{video_format}+ba[ext!=webm]/{video_format}"
+
+    try:
+        # Reuse the metadata extracted by extract_info when it is still stored, to skip a second extraction
+        info = load_full_info(redis_client, video_id) if video_id else None
+        with get_pool("extract", EXTRACT_OPTIONS).lease(format=video_format) as ydl:
+            if info is not None:
+                selected = ydl.process_ie_result(info, download=False)
+            else:
+                selected = ydl.extract_info(url, download=False)
+
+        relay_remux(redis_client, stream_id, selected.get('requested_formats') or [selected])
+        end_stream(redis_client, stream_id)
+    except StreamAbandoned:
+        print(f"Stream {stream_id} abandoned by the client.")
+        redis_client.delete(stream_key(stream_id))
+    except Exception as e:
+        end_stream(redis_client, stream_id, str(e))
+        raise
+
+
+@celery_app.task
+def run_batch(batch_id, video_ids, playlist_url, video_format, concurrency):
+
+    """Fan the downloads of a batch out across the workers.
+
+    The videos are split into waves of at most `concurrency` downloads. Each wave is a group that
+    only starts once the previous one finished, which caps how many workers a single batch can hold.
+    """
+
+    redis_client = get_redis_client()
+    tracker = BatchTracker(redis_client, batch_id, config.video_persistence_duration)
+
+    # Playlists are expanded into their videos without extracting each of them
+    if playlist_url is not None:
+        try:
+            ydl_opts = {'quiet': True, 'extract_flat': 'in_playlist', 'playlistend': config.batch_max_size}
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                playlist = ydl.extract_info(playlist_url, download=False)
+            video_ids = [entry['id'] for entry in playlist.get('entries') or [] if entry and entry.get('id')]
+        except Exception as e:
+            tracker.finish("failed", f"Failed to read the playlist: {e}")
+            raise
+        video_ids = video_ids[:config.batch_max_size]
+        tracker.set_videos(video_ids)
+
+    waves = [
+        group(batch_item.si(batch_id, index, video_id, video_format) for index, video_id in wave)
+        for wave in chunks(list(enumerate(video_ids)), concurrency)
+    ]
+    chain(*waves, finish_batch.si(batch_id)).apply_async()
+
+
+@celery_app.task(bind=True)
+def batch_item(self, batch_id, index, video_id, video_format):
+
+    """Download one video of a batch, reusing the stored video when it was already downloaded.
+
+    Failures are recorded on the batch instead of being raised, so one video cannot stop the next waves.
+    """
+
+    redis_client = get_redis_client()
+    tracker = BatchTracker(redis_client, batch_id, config.video_persistence_duration)
+    video_store = VideoStore(redis_client)
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    store_key = VideoStore.key_for(video_id, video_format)
+    item = {"video_id": video_id}
+
+    try:
+        state, _ = video_store.acquire(store_key, self.request.id)
+        # A prefetch of the same format is taken over, a prefetch of another one is left to the user of the video
+        if state == "downloading" and PrefetchRegistry(redis_client).decide(video_id, video_format, settle_miss=False):
+            PREFETCH_OUTCOMES.labels("hit").inc()
+    except Exception as e:
+        print(f"Batch {batch_id}: failed to download {video_id}: {e}")
+        tracker.finish_item(index, {**item, "status": "failed", "error": str(e)})
+        return
+
+    # The reference taken above keeps the video from being deleted until the item is finished
+    try:
+        if state == "claimed":
+            AdmissionController(redis_client).register_download(self.request.id)
+            download_video.apply(args=[store_key, url, video_format, video_id, batch_id, index],
+                                 task_id=self.request.id, throw=True)
+        elif state == "downloading":
+            # Someone else is downloading this video. Rather than holding a worker (which the download may
+            # be waiting for) until they are done, the item checks again later. A download that died in
+            # the meantime is claimed by the next check, and made by this item.
+            if self.request.retries == 0:
+                tracker.update_item(index, {**item, "status": "waiting", "progress": "0%"})
+            if self.request.retries >= BATCH_WAIT_TIMEOUT // BATCH_WAIT_INTERVAL:
+                raise Exception("Timed out waiting for the download of the video.")
+            raise self.retry(countdown=BATCH_WAIT_INTERVAL, max_retries=None)
+
+        entry = video_store.get(store_key)
+        if entry.get("status") != "completed":
+            raise Exception("Video download failed.")
+        tracker.finish_item(index, {**item, "status": "completed", "progress": "100%", "URL": entry["path"]})
+    except Retry:
+        raise
+    except Exception as e:
+        print(f"Batch {batch_id}: failed to download {video_id}: {e}")
+        tracker.finish_item(index, {**item, "status": "failed", "error": str(e)})
+    finally:
+        video_store.release(store_key)
+
+
+@celery_app.task
+def finish_batch(batch_id):
+
+    """Mark a batch as finished once all of its waves ran."""
+
+    BatchTracker(get_redis_client(), batch_id, config.video_persistence_duration).finish()
 
-    # Delete the folder 
-    if os.path.exists(video_task_directory) and os.path.isdir(video_task_directory):
-        shutil.rmtree(video_task_directory)
-        print( f"Deleted: {video_task_directory}")
-    else:
-        print( f"Folder not found: {video_task_directory}")
\ No newline at end of file
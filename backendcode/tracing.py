@@ -0,0 +1,92 @@
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+import redis
+
+from backendcode.data_models import EnvironmentVariablesConfig
+
+
+class Tracer:
+    """Record the stages a request goes through as spans, correlated by task ID.
+
+    The spans of a trace are appended to a Redis list, by whichever process (API or worker) ran the
+    stage, and expire after a while. A trace can link to other traces: the extraction task of a video
+    links to the download it started (or attached to), which links to the stored file it produced, so
+    the whole path of a request, from its submission to the file being served, can be followed from
+    the task ID the client was given.
+    """
+
+    KEY_PREFIX = "trace"
+    # How many links are followed from the requested trace
+    MAX_DEPTH = 3
+
+    def __init__(self, redis_client: redis.Redis, ttl: int):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.process = f"{socket.gethostname()}:{os.getpid()}"
+
+    def _key(self, trace_id: str) -> str:
+        return f"{self.KEY_PREFIX}:{trace_id}"
+
+    def record(self, trace_id: str, name: str, started: float, duration: float, **attributes):
+        """Record a span that started at the given time (seconds since the epoch) and lasted `duration` seconds.
+
+        Tracing is best effort: failing to record a span never fails the stage it measured.
+        """
+        span = {"name": name, "start": round(started, 3), "duration": round(duration, 4),
+                "process": self.process, **attributes}
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.rpush(self._key(trace_id), json.dumps(span, default=str))
+            pipe.expire(self._key(trace_id), self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to record the span {name} of {trace_id}: {e}")
+
+    def link(self, trace_id: str, linked_id: str, name: str, **attributes):
+        """Record that a trace continues in another one (e.g., the download a request attached to)."""
+        self.record(trace_id, name, time.time(), 0.0, link=linked_id, **attributes)
+
+    @contextmanager
+    def span(self, trace_id: str, name: str, histogram=None, **attributes):
+        """Time the enclosed block as a span, and observe its duration in a histogram if given.
+
+        Yields the attributes of the span, so the block can add to them.
+        """
+        started = time.time()
+        start = time.monotonic()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            duration = time.monotonic() - start
+            if histogram is not None:
+                histogram.observe(duration)
+            self.record(trace_id, name, started, duration, **attributes)
+
+    def load(self, trace_id: str) -> list[dict]:
+        """Return the spans of a trace and of the traces it links to, in the order they started."""
+        spans = []
+        visited = set()
+        pending = [(trace_id, 0)]
+        while pending:
+            current, depth = pending.pop()
+            if current in visited:
+                continue
+            visited.add(current)
+            for raw in self.redis_client.lrange(self._key(current), 0, -1):
+                span = {**json.loads(raw), "trace_id": current}
+                spans.append(span)
+                if "link" in span and depth < self.MAX_DEPTH:
+                    pending.append((span["link"], depth + 1))
+        return sorted(spans, key=lambda span: span["start"])
+
+
+def get_tracer(redis_client: redis.Redis) -> Tracer:
+    """Return a tracer keeping the traces for the configured TRACE_TTL."""
+    return Tracer(redis_client, EnvironmentVariablesConfig().trace_ttl)
@@ -2,6 +2,9 @@ from urllib.parse import urlparse, parse_qs
 from fastapi import HTTPException
 import re
 
+# Hosts a YouTube playlist URL can point to
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtu.be")
+
 def extract_video_id(url: str) -> str:
     """
     Extract the YouTube video ID from a given URL.
@@ -44,4 +47,36 @@ def extract_video_id(url: str) -> str:
             detail="URL is not formatted properly. Please ensure you're using a valid YouTube video URL."
         )
     
-    return videoID
\ No newline at end of file
+    return videoID
+
+def extract_playlist_id(url: str) -> str:
+    """
+    Extract the YouTube playlist ID from a given URL.
+
+    The playlist ID is taken from the "list" parameter of the query string, which is present
+    both on playlist pages (youtube.com/playlist?list=<id>) and on videos played from a playlist.
+
+    Args:
+        url (str): The YouTube playlist URL.
+
+    Returns:
+        str: The extracted YouTube playlist ID.
+
+    Raises:
+        HTTPException: If the URL is not a YouTube URL or does not contain a valid playlist ID.
+    """
+
+    parsed_url = urlparse(url)
+    playlist_id = parse_qs(parsed_url.query).get("list")
+    if parsed_url.hostname not in YOUTUBE_HOSTS or not playlist_id or not re.fullmatch(r"[0-9A-Za-z_-]+", playlist_id[0]):
+        raise HTTPException(
+            status_code=400,
+            detail="URL is not formatted properly. Please ensure you're using a valid YouTube playlist URL."
+        )
+
+    return playlist_id[0]
+
+
+def chunks(items: list, size: int) -> list[list]:
+    """Split a list into consecutive chunks of at most `size` items."""
+    return [items[start:start + size] for start in range(0, len(items), size)]
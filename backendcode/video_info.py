@@ -0,0 +1,170 @@
+import zlib
+
+import msgpack
+import redis
+
+# yt-dlp info dicts are large (every format with its fragments, HTTP headers, subtitles...), so only a
+# compact projection is sent to the result backend. The full dict is kept compressed under its own key,
+# for the download task (to skip a second extraction) and for clients that explicitly ask for it.
+FULL_INFO_PREFIX = "info"
+
+
+# Codec families by the prefix of their codec string (e.g., "avc1.64001F")
+CODEC_FAMILIES = {"avc1": "h264", "avc3": "h264", "hev1": "h265", "hvc1": "h265", "vp09": "vp9", "vp9": "vp9",
+                  "vp8": "vp8", "av01": "av1"}
+
+
+def project_info(info: dict) -> dict:
+    """Keep the fields of a yt-dlp info dict that the API endpoints need."""
+    formats = info.get('formats', [])
+    return {
+        "id": info.get('id'),
+        "name": info.get('title', 'Unknown'),
+        "duration": info.get('duration'),
+        "duration_string": info.get('duration_string', 'N/A'),
+        "thumbnail": info.get('thumbnail'),
+        "original_url": info.get('original_url') or info.get('webpage_url'),
+        "formats": [
+            {
+                'format_id': fmt.get('format_id', 'N/A'),
+                'ext': fmt.get('ext', 'N/A'),
+                'vcodec': fmt.get('vcodec', 'N/A'),
+                'acodec': fmt.get('acodec', 'N/A'),
+                'resolution': fmt.get('resolution', 'N/A'),
+                "fps": fmt.get('fps', 'N/A'),
+                "filesize": fmt.get('filesize', 'N/A'),
+                "filesize_approx": fmt.get('filesize_approx'),
+                "width": fmt.get('width'),
+                "height": fmt.get('height'),
+                "tbr": fmt.get('tbr'),
+                "protocol": fmt.get('protocol'),
+            }
+            for fmt in formats
+        ],
+        "format_index": build_format_index(formats),
+    }
+
+
+def download_selector(video_format: str, audio_only: bool = False) -> str:
+    """Return the yt-dlp format selector download_video uses for a video format: the format and the best audio,
+    or only the best audio (m4a if there is one)."""
+    if audio_only:
+        return "ba[ext=m4a]/ba"
+    return f"{video_format}+ba[ext!=webm]"
+
+
+def download_variant(video_format: str | None, section: list | None = None, audio_only: bool = False) -> str:
+    """Name what a download produces from a video, which the stored file is addressed by along with the video ID.
+
+    A plain download is named by its format, e.g., "137", a clip by the format and its time range,
+    e.g., "137@30-60" (an open end is left empty), and the audio by "audio".
+    """
+    variant = "audio" if audio_only else video_format
+    if section is not None:
+        start, end = section
+        variant += f"@{start:g}-{'' if end is None else f'{end:g}'}"
+    return variant
+
+
+def codec_family(vcodec: str | None) -> str:
+    """Return the family of a video codec string, e.g., "h264" for "avc1.64001F"."""
+    prefix = (vcodec or "none").split(".", 1)[0].lower()
+    return CODEC_FAMILIES.get(prefix, prefix)
+
+
+def build_format_index(formats: list[dict]) -> list[dict]:
+    """Index the video formats of a video by the properties clients choose a format by.
+
+    Every format with a video stream gets an entry with its resolution, codec family, container,
+    fps and estimated download size (with the best audio), ordered from the best format to the
+    worst, so the first entry that matches some constraints is the best one that does.
+    """
+    index = []
+    for fmt in formats:
+        if fmt.get('vcodec') in (None, 'none') or not fmt.get('height'):
+            continue
+        fps = fmt.get('fps')
+        index.append({
+            "format_id": fmt.get('format_id'),
+            "height": fmt.get('height'),
+            "width": fmt.get('width'),
+            "fps": fps if isinstance(fps, (int, float)) else None,
+            "vcodec": codec_family(fmt.get('vcodec')),
+            "ext": fmt.get('ext'),
+            "tbr": fmt.get('tbr'),
+            "size": estimate_download_size(formats, fmt.get('format_id')) or None,
+        })
+    index.sort(key=lambda entry: (entry["height"], entry["fps"] or 0, entry["tbr"] or 0), reverse=True)
+    return index
+
+
+def select_format(index: list[dict], max_height: int = None, min_height: int = None, ext: str = None,
+                  vcodec: str = None, max_size: int = None, min_fps: float = None) -> dict | None:
+    """Return the best entry of a format index that satisfies every given constraint, or None.
+
+    Formats whose size is unknown never satisfy a size constraint.
+    """
+    for entry in index:
+        if max_height is not None and entry["height"] > max_height:
+            continue
+        if min_height is not None and entry["height"] < min_height:
+            continue
+        if ext is not None and entry["ext"] != ext:
+            continue
+        if vcodec is not None and entry["vcodec"] != codec_family(vcodec):
+            continue
+        if max_size is not None and (entry["size"] is None or entry["size"] > max_size):
+            continue
+        if min_fps is not None and (entry["fps"] or 0) < min_fps:
+            continue
+        return entry
+    return None
+
+
+def pack_info(info: dict) -> bytes:
+    """Serialize an info dict into compressed msgpack."""
+    return zlib.compress(msgpack.packb(info, use_bin_type=True))
+
+
+def unpack_info(data: bytes) -> dict:
+    """Deserialize an info dict serialized by pack_info."""
+    return msgpack.unpackb(zlib.decompress(data), raw=False)
+
+
+def save_full_info(redis_client: redis.Redis, video_id: str, info: dict, ttl: int):
+    """Store the full (sanitized) info dict of a video for ttl seconds."""
+    redis_client.set(f"{FULL_INFO_PREFIX}:{video_id}", pack_info(info), ex=ttl)
+
+
+def load_full_info(redis_client: redis.Redis, video_id: str) -> dict | None:
+    """Return the full info dict of a video, or None if it is not stored (anymore)."""
+    data = redis_client.get(f"{FULL_INFO_PREFIX}:{video_id}")
+    return unpack_info(data) if data is not None else None
+
+
+def estimate_download_size(formats: list[dict], video_format: str, audio_only: bool = False,
+                           section: list | None = None, duration: float | None = None) -> int:
+    """Estimate the bytes a download of the given format (with the best audio) will take on disk.
+
+    With `audio_only`, only the best audio is counted, and with a `section` (a clip of a video of
+    the given duration), the share of the video it covers.
+
+    Returns 0 when the size is unknown, e.g., for selectors that do not name a single format.
+    """
+    def size_of(fmt):
+        size = fmt.get('filesize')
+        return size if isinstance(size, (int, float)) else fmt.get('filesize_approx') or 0
+
+    audio_sizes = [size_of(fmt) for fmt in formats
+                   if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none') and fmt.get('ext') != 'webm']
+    if audio_only:
+        size = max(audio_sizes, default=0)
+    else:
+        video = next((fmt for fmt in formats if fmt.get('format_id') == video_format), None)
+        if video is None:
+            return 0
+        size = size_of(video) + max(audio_sizes, default=0)
+    if section is not None and duration:
+        start, end = section
+        size *= (min(duration, end if end is not None else duration) - start) / duration
+    return int(max(size, 0))
@@ -0,0 +1,209 @@
+import hashlib
+import time
+
+import redis
+
+# Atomically decide what a new requester of a stored video should do:
+#   - "completed": the file is ready, it only needs a new reference
+#   - "downloading": another download is producing the file, the requester attaches to it
+#   - "claimed": nobody has (or is making) the file, the requester must schedule the download
+#   - "deleting": the file is being removed, the requester should try again shortly
+# A download whose heartbeat is older than the stale window is considered dead and is reclaimed.
+ACQUIRE = """
+local now = tonumber(ARGV[2])
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'deleting' then
+    return {'deleting', ''}
+end
+if status == 'completed' then
+    redis.call('HINCRBY', KEYS[1], 'refs', 1)
+    redis.call('HSET', KEYS[1], 'last_access', now)
+    return {'completed', redis.call('HGET', KEYS[1], 'path')}
+end
+if status == 'downloading' then
+    local updated = tonumber(redis.call('HGET', KEYS[1], 'updated') or '0')
+    if now - updated < tonumber(ARGV[3]) then
+        redis.call('HINCRBY', KEYS[1], 'refs', 1)
+        redis.call('HSET', KEYS[1], 'last_access', now)
+        return {'downloading', redis.call('HGET', KEYS[1], 'owner')}
+    end
+end
+redis.call('HSET', KEYS[1], 'status', 'downloading', 'owner', ARGV[1], 'updated', now, 'last_access', now)
+redis.call('HDEL', KEYS[1], 'path', 'reason')
+redis.call('HINCRBY', KEYS[1], 'refs', 1)
+return {'claimed', ARGV[1]}
+"""
+
+# Mark a stored video for deletion if nobody references it, it is not being downloaded
+# and it has not been accessed for the idle window. Returns the number of seconds to wait
+# before trying again, 0 when the entry was marked for deletion, or -1 if it does not exist.
+# References that were not released for a very long time belong to a requester that died.
+MARK_FOR_DELETION = """
+local now = tonumber(ARGV[1])
+local idle_window = tonumber(ARGV[2])
+local status = redis.call('HGET', KEYS[1], 'status')
+if not status then
+    return -1
+end
+if status == 'downloading' then
+    return math.max(idle_window, 1)
+end
+local idle = now - tonumber(redis.call('HGET', KEYS[1], 'last_access') or '0')
+if tonumber(redis.call('HGET', KEYS[1], 'refs') or '0') > 0 and idle < tonumber(ARGV[3]) then
+    return math.max(idle_window, 1)
+end
+if idle < idle_window then
+    return math.ceil(idle_window - idle)
+end
+redis.call('HSET', KEYS[1], 'status', 'deleting')
+return 0
+"""
+
+# Let the owner of a download (re)start it, e.g., when its task is delivered again after its worker died.
+# Anyone else, or a download that completed or is being deleted in the meantime, is refused.
+RESUME = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+local status = redis.call('HGET', KEYS[1], 'status')
+if status ~= 'downloading' and status ~= 'failed' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'downloading', 'updated', ARGV[2])
+return 1
+"""
+
+# Record an access to, or drop a reference to, an entry that exists. Checking and updating in one
+# step keeps a request from recreating (as a hash holding only that field) an entry deleted in between.
+TOUCH = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'last_access', ARGV[1])
+end
+return 0
+"""
+RELEASE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('HINCRBY', KEYS[1], 'refs', -1)
+"""
+
+# Remove the entry only if it is still the one we marked for deletion
+FORGET_DELETED = """
+if redis.call('HGET', KEYS[1], 'status') == 'deleting' then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class VideoStore:
+    """Shared store of downloaded videos, addressed by (video ID, format selector).
+
+    Every requester of the same video in the same format shares one download and one file on
+    disk under videos/<store_key>/. Each entry is a Redis hash holding the download status,
+    the owning download task, the public path of the file, a reference count and the time it
+    was last accessed, which together decide when the file can be deleted. References are held
+    by the requests that are following the download (websockets, batch items) while they run.
+    """
+
+    KEY_PREFIX = "store"
+
+    # Seconds without a progress heartbeat after which a download is considered dead
+    STALE_AFTER = 600
+    # Seconds without any access after which the references to a video are considered leaked
+    REFS_STALE_AFTER = 24 * 3600
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE)
+        self._mark_for_deletion = redis_client.register_script(MARK_FOR_DELETION)
+        self._forget_deleted = redis_client.register_script(FORGET_DELETED)
+        self._resume = redis_client.register_script(RESUME)
+        self._touch = redis_client.register_script(TOUCH)
+        self._release = redis_client.register_script(RELEASE)
+
+    @staticmethod
+    def key_for(video_id: str, video_format: str) -> str:
+        """Return the content address of a video downloaded in the given format."""
+        return hashlib.sha1(f"{video_id}|{video_format}".encode("utf-8")).hexdigest()[:20]
+
+    def _key(self, store_key: str) -> str:
+        return f"{self.KEY_PREFIX}:{store_key}"
+
+    def acquire(self, store_key: str, requester_id: str, attempts: int = 10) -> tuple[str, str]:
+        """Take a reference to a stored video, claiming its download if nobody is making it.
+
+        Args:
+            store_key (str): The content address of the video.
+            requester_id (str): The ID the download task will use if the requester has to schedule it.
+            attempts (int): How many times to wait for an entry that is being deleted.
+
+        Returns:
+            tuple[str, str]: "completed" and the path of the file, "downloading" and the ID of the
+                download task to attach to, or "claimed" and the requester ID.
+        """
+        for _ in range(attempts):
+            state, value = self._acquire(keys=[self._key(store_key)],
+                                         args=[requester_id, time.time(), self.STALE_AFTER])
+            state, value = state.decode("utf-8"), value.decode("utf-8")
+            if state != "deleting":
+                return state, value
+            time.sleep(0.2)
+        raise RuntimeError("The requested video is being removed, please try again.")
+
+    def get(self, store_key: str) -> dict:
+        """Return the entry of a stored video, or an empty dictionary if there is none."""
+        entry = self.redis_client.hgetall(self._key(store_key))
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in entry.items()}
+
+    @classmethod
+    def is_stale(cls, entry: dict) -> bool:
+        """Tell whether the download of an entry (as returned by get) stopped sending heartbeats, i.e., it died."""
+        return (entry.get("status") == "downloading"
+                and time.time() - float(entry.get("updated", 0)) >= cls.STALE_AFTER)
+
+    def resume(self, store_key: str, download_id: str) -> bool:
+        """Let a download task (re)start producing a video, if it is still the one responsible for it."""
+        return bool(self._resume(keys=[self._key(store_key)], args=[download_id, time.time()]))
+
+    def heartbeat(self, store_key: str, pipe=None):
+        """Record that the download of a video is still making progress, optionally as part of a pipeline."""
+        (pipe or self.redis_client).hset(self._key(store_key), "updated", time.time())
+
+    def complete(self, store_key: str, path: str, size: int, bytes_saved: int = None):
+        """Publish the file of a finished download to every requester, with the bytes a clip (or the audio)
+        saved compared with the full video, if known."""
+        now = time.time()
+        mapping = {"status": "completed", "path": path, "size": size, "updated": now, "last_access": now}
+        if bytes_saved is not None:
+            mapping["bytes_saved"] = bytes_saved
+        self.redis_client.hset(self._key(store_key), mapping=mapping)
+
+    def fail(self, store_key: str, reason: str = None):
+        """Mark a download as failed so the next requester claims it again, recording why it stopped if known."""
+        mapping = {"status": "failed", "updated": time.time()}
+        if reason is not None:
+            mapping["reason"] = reason
+        self.redis_client.hset(self._key(store_key), mapping=mapping)
+
+    def touch(self, store_key: str):
+        """Record an access to a stored video, postponing its deletion."""
+        self._touch(keys=[self._key(store_key)], args=[time.time()])
+
+    def release(self, store_key: str) -> int:
+        """Drop one reference to a stored video and return the remaining count."""
+        return int(self._release(keys=[self._key(store_key)]))
+
+    def mark_for_deletion(self, store_key: str, idle_window: int) -> int:
+        """Mark an unused video for deletion.
+
+        Returns:
+            int: 0 if the video was marked and its files can be removed, -1 if it is unknown,
+                otherwise the number of seconds to wait before checking it again.
+        """
+        return int(self._mark_for_deletion(keys=[self._key(store_key)], args=[time.time(), idle_window, self.REFS_STALE_AFTER]))
+
+    def forget(self, store_key: str):
+        """Remove the entry of a video whose files were deleted."""
+        self._forget_deleted(keys=[self._key(store_key)])
@@ -0,0 +1,58 @@
+import time
+
+import redis
+
+
+class WatcherRegistry:
+    """Track who is still waiting for each download, so the ones nobody waits for can be cancelled.
+
+    The watchers of a download are kept in a sorted set, scored by the time they stop counting:
+    a connected client renews its watch every few seconds, and a client that leaves is scored with
+    the time it left. The highest score is therefore when the download was last watched, which the
+    worker compares with the grace period. A watcher whose API process died simply stops being
+    renewed. A download that was never watched (e.g., a batch) has no set, and is never cancelled.
+    """
+
+    KEY_PREFIX = "watchers"
+
+    # Seconds a watch counts for, it is renewed every third of it
+    WATCH_TTL = 30
+    # How long the watchers of a download are remembered
+    KEY_TTL = 24 * 3600
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+
+    @classmethod
+    def key(cls, store_key: str) -> str:
+        return f"{cls.KEY_PREFIX}:{store_key}"
+
+    def watch(self, store_keys: list[str], watcher_id: str, ttl: float = None):
+        """Register (or renew) a watcher of some downloads, for `ttl` seconds (WATCH_TTL by default)."""
+        until = time.time() + (ttl or self.WATCH_TTL)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for store_key in store_keys:
+            pipe.zadd(self.key(store_key), {watcher_id: until})
+            pipe.expire(self.key(store_key), self.KEY_TTL)
+        pipe.execute()
+
+    def leave(self, store_keys: list[str], watcher_id: str):
+        """Record that a watcher stopped waiting for some downloads."""
+        now = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        for store_key in store_keys:
+            # Only watchers that are still registered, a watch that ran out must not be extended
+            pipe.zadd(self.key(store_key), {watcher_id: now}, xx=True, lt=True)
+        pipe.execute()
+
+    def unwatched_for(self, store_key: str) -> float | None:
+        """Return how many seconds ago the last watcher of a download left (0 while it is watched), or None
+        if the download was never watched."""
+        last = self.redis_client.zrevrange(self.key(store_key), 0, 0, withscores=True)
+        if not last:
+            return None
+        return max(0.0, time.time() - last[0][1])
+
+    def forget(self, store_key: str):
+        """Forget the watchers of a download that stopped, so a later download of the video starts unwatched."""
+        self.redis_client.delete(self.key(store_key))
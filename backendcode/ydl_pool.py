@@ -0,0 +1,113 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import yt_dlp
+
+# What _prepare sets on an instance besides its params: internals of YoutubeDL (the version of yt-dlp is
+# pinned in requirements.txt for them). An instance missing one fails its lease, rather than a renamed
+# attribute being added alongside and the state of a task leaking into the next one.
+PREPARED_ATTRIBUTES = ('format_selector', 'build_format_selector', '_parse_outtmpl', '_progress_hooks',
+                       '_postprocessor_hooks', '_download_retcode', '_num_downloads', '_num_videos',
+                       '_playlist_level', '_playlist_urls', '_printed_messages')
+
+
+class YoutubeDLPool:
+    """Keep warm YoutubeDL instances in a worker process, instead of building one per task.
+
+    Building a YoutubeDL sets up its cookies, cache and extractor registry, and its first request
+    sets up the networking stack; the instance then keeps its initialized extractors and its open
+    connections. An instance is leased by one task at a time, and what a task can set on it (the
+    format, the output template, the time ranges and the hooks) is reset when it is returned.
+    Instances that raised are closed rather than returned, since they may have been left halfway
+    through a download.
+
+    The pool grows to the number of tasks the process runs at once (its thread concurrency), which
+    bounds the number of idle instances too.
+    """
+
+    def __init__(self, params: dict):
+        self.params = params
+        # The most recently used instance is reused first, its connections are the most likely to still be open
+        self._idle = queue.LifoQueue()
+
+    def _create(self) -> yt_dlp.YoutubeDL:
+        ydl = yt_dlp.YoutubeDL(dict(self.params))
+        # Set up the networking stack right away, rather than on the first request of a task
+        ydl._request_director
+        return ydl
+
+    def warm(self, count: int = 1):
+        """Build instances ahead of the first tasks."""
+        for _ in range(count - self._idle.qsize()):
+            self._idle.put(self._create())
+
+    @contextmanager
+    def lease(self, format: str = None, outtmpl: str = None, progress_hooks=(), postprocessor_hooks=(),
+              download_ranges=None):
+        """Lend an instance set up for one task, and take it back once the task is done with it."""
+        try:
+            ydl = self._idle.get_nowait()
+        except queue.Empty:
+            ydl = self._create()
+
+        self._prepare(ydl, format, outtmpl, progress_hooks, postprocessor_hooks, download_ranges)
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        self._prepare(ydl, self.params.get('format'), self.params.get('outtmpl'), (), (),
+                      self.params.get('download_ranges'))
+        self._idle.put(ydl)
+
+    def _prepare(self, ydl: yt_dlp.YoutubeDL, format, outtmpl, progress_hooks, postprocessor_hooks, download_ranges):
+        """Set the options of a task on an instance, mirroring what YoutubeDL.__init__ derives from them."""
+        missing = [name for name in PREPARED_ATTRIBUTES if not hasattr(ydl, name)]
+        if missing:
+            raise RuntimeError(f"yt-dlp {yt_dlp.version.__version__} has no {', '.join(missing)}, "
+                               f"the pooled instances cannot be reset (see the version in requirements.txt)")
+        # yt-dlp only falls back to downloading the whole video when the option is missing, not when it is None
+        if download_ranges is None:
+            ydl.params.pop('download_ranges', None)
+        else:
+            ydl.params['download_ranges'] = download_ranges
+        ydl.params['format'] = format
+        ydl.format_selector = format if format in (None, '-') else ydl.build_format_selector(format)
+        ydl.params['outtmpl'] = outtmpl if outtmpl is not None else {}
+        ydl._parse_outtmpl()
+        ydl._progress_hooks = list(progress_hooks)
+        ydl._postprocessor_hooks = list(postprocessor_hooks)
+
+        # Per-run counters and caches
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl._num_videos = 0
+        ydl._playlist_level = 0
+        ydl._playlist_urls = set()
+        ydl._printed_messages = set()
+
+    def close(self):
+        """Close every idle instance."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# The pools of the current process. They are keyed by process ID, so a pool built before the
+# prefork pool forked its children is never shared with them.
+_pools: dict[tuple[int, str], YoutubeDLPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name: str, params: dict) -> YoutubeDLPool:
+    """Return the pool of the current process for a kind of task, creating it on first use."""
+    key = (os.getpid(), name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = YoutubeDLPool(params)
+        return pool
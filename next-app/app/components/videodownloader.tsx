@@ -66,6 +66,11 @@ interface ThumbnailURLResponse {
   error?: string;
 }
 
+interface QueueEstimateResponse {
+  metadata: {queued: number; estimated_wait: number};
+  downloads: {queued: number; in_flight: number; estimated_wait: number};
+}
+
 interface CompletedTaskResponse {
   task_id: string;
   status: string;
@@ -86,6 +91,19 @@ export default function VideoDownloaderComp({id ,onRemove }: ListItemProps) {
       const [videoFormatsData, setVideoFormatsData] = useState<CompletedTaskResponse>();
 
       const [thumbnailURL, setThumbnailURL] =useState<ThumbnailURLResponse>()
+      const [queueWait, setQueueWait] = useState<number>(0);
+
+      // Fetch how long the server expects new work to wait, to show it while the video is being looked up
+      const fetchQueueEstimate = async () => {
+        try {
+          const response = await fetch(serverURL + "/queue");
+          if (!response.ok) return;
+          const estimate: QueueEstimateResponse = await response.json();
+          setQueueWait(estimate.metadata.estimated_wait);
+        } catch (err) {
+          console.error('Error fetching the queue estimate:', err);
+        }
+      };
 
       const requestTaskID = async () => {
         // No requests should be made while loading
@@ -108,10 +126,17 @@ export default function VideoDownloaderComp({id ,onRemove }: ListItemProps) {
 
         try {
           const response = await fetch(serverURL + "/video?url=" + videoURL);
+          // The server is overloaded, it tells us when to come back
+          if (response.status == 429) {
+            lastRequestedVideoURL.current = "";
+            const retryAfter = response.headers.get("Retry-After");
+            throw new Error(`The server is busy, please try again in ${retryAfter ?? "a few"} seconds.`);
+          }
           if (!response.ok) throw new Error(response.statusText);
 
           const result: TaskIDResponse = await response.json();
           setTaskID(result.task_id);
+          fetchQueueEstimate();
           fetchVideoData(result.task_id)
 
         } catch (err:  unknown) {
@@ -215,6 +240,11 @@ export default function VideoDownloaderComp({id ,onRemove }: ListItemProps) {
             </button>:
             <button className="btn flex-grow" disabled>Find Video</button>}
           </div>
+          {
+            loading && queueWait >= 1?
+            <p className="text-sm opacity-70">Estimated wait: ~{Math.ceil(queueWait)}s</p>
+            :null
+          }
 
           {
             error?
@@ -256,6 +286,7 @@ function ThumbnailComp({task_id,imageURL,formatsResponse}:{task_id:string,imageU
   const [connect, setConnect] = useState(false);
   const [percentage, setPercentage] = useState(0);
   const [videoURL, setVideoURL] = useState("");
+  const [downloadError, setDownloadError] = useState("");
 
 
   useEffect(() => {
@@ -283,6 +314,10 @@ function ThumbnailComp({task_id,imageURL,formatsResponse}:{task_id:string,imageU
           if(parsedMessage.status == "completed"){
             setPercentage(100)
             setVideoURL(parsedMessage.URL)
+          }else if(parsedMessage.status == "error"){
+            // Let the user try again, e.g., once the server is less busy
+            setDownloadError(parsedMessage.message)
+            setConnect(false)
           }
         }
       } catch (error) {
@@ -297,6 +332,7 @@ function ThumbnailComp({task_id,imageURL,formatsResponse}:{task_id:string,imageU
   }, [imageURL]);
 
   const handleButtonClick = () => {
+    setDownloadError("")
     setConnect(true)
     sendJsonMessage({"task_id":task_id,"format":currentOptionID})
   };
@@ -353,6 +389,11 @@ function ThumbnailComp({task_id,imageURL,formatsResponse}:{task_id:string,imageU
           </button>
           :null
         }
+        {
+          downloadError!=""?
+          <p className="text-error text-sm mt-2">{downloadError}</p>
+          :null
+        }
       </div>
       
       <Image
@@ -0,0 +1,270 @@
+# Drive the API like the frontend does, at a configurable concurrency, and report how it performs.
+#
+# Every "flow" submits a video to /video, polls /video/{task_id} until its metadata is ready, fetches
+# /video/thumbnail/{task_id}, downloads a format through the /video/download websocket, and finally
+# fetches the stored file. The benchmark videos come from the local origin (origin.py), so start it
+# first, and start the workers with this directory on their PYTHONPATH so yt-dlp uses its extractor.
+# Every flow comes from the same address, so the API must be started with per-client limits above
+# what the benchmark submits, or it would mostly measure its own rejections:
+#
+#   python -m testcode.benchmark.origin --port 8765
+#   PYTHONPATH=testcode/benchmark BENCHMARK_ORIGIN=http://127.0.0.1:8765 celery -A backendcode.celery_config.celery_app worker ...
+#   ADMISSION_CLIENT_EXTRACTIONS_PER_MINUTE=100000 ADMISSION_CLIENT_DOWNLOADS=1000 uvicorn backendcode.API:app --port 8000
+#   python -m testcode.benchmark.loadgen --users 10 --flows 50 --save baseline
+#   python -m testcode.benchmark.loadgen --users 10 --flows 50 --compare baseline
+#
+# Reported metrics: submit-to-metadata latency, thumbnail latency, websocket update lag (publish to
+# receive), time to the first update and to the end of the download, download throughput (on the
+# worker, and when serving the file), and Redis commands per flow. Flows rejected by the admission
+# control (429, or a WebSocket closed with a retry delay) are reported apart, and fail the run unless
+# --allow-rejections is given.
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import httpx
+import redis
+import websockets
+
+from backendcode.data_models import EnvironmentVariablesConfig
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+# Metrics where a higher value is better; for all the others (latencies), lower is better
+HIGHER_IS_BETTER = ("worker_throughput", "serve_throughput", "flows_per_second")
+
+
+class Rejected(Exception):
+    """Raised when the admission control of the API turned a step of a flow away, with the endpoint of the step."""
+
+
+async def poll(client: httpx.AsyncClient, url: str, done, interval: float, timeout: float) -> dict:
+    """Poll an endpoint until `done` accepts its response, returning the response."""
+    deadline = time.monotonic() + timeout
+    while True:
+        response = await client.get(url)
+        if response.status_code == 429:
+            # The endpoint without the task ID
+            raise Rejected(url.rsplit("/", 1)[0])
+        response.raise_for_status()
+        data = response.json()
+        if done(data):
+            return data
+        if data.get("status") == "retry":
+            raise RuntimeError(f"task failed: {data.get('error')}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(url)
+        await asyncio.sleep(interval)
+
+
+async def run_flow(client: httpx.AsyncClient, args, video_id: str, metrics: dict):
+    """Run the whole flow of a user for one video, recording its metrics."""
+    video_url = f"https://www.youtube.com/watch?v={video_id}"
+
+    started = time.monotonic()
+    response = await client.get("/video", params={"url": video_url})
+    if response.status_code == 429:
+        raise Rejected("/video")
+    response.raise_for_status()
+    task_id = response.json()["task_id"]
+
+    await poll(client, f"/video/{task_id}", lambda data: data.get("status") == "completed",
+               args.poll_interval, args.timeout)
+    metrics["submit_to_metadata"].append(time.monotonic() - started)
+
+    thumbnail_started = time.monotonic()
+    await poll(client, f"/video/thumbnail/{task_id}", lambda data: data.get("status") == "success",
+               args.poll_interval, args.timeout)
+    metrics["thumbnail"].append(time.monotonic() - thumbnail_started)
+
+    websocket_url = args.api.replace("http", "ws", 1) + "/video/download"
+    download_started = time.monotonic()
+    final_event = None
+    async with websockets.connect(websocket_url, open_timeout=args.timeout) as websocket:
+        await websocket.send(json.dumps({"task_id": task_id, "format": args.format}))
+        first_update = True
+        async for message in websocket:
+            received = time.time()
+            event = json.loads(message)
+            if first_update:
+                metrics["first_update"].append(time.monotonic() - download_started)
+                first_update = False
+            if event.get("time"):
+                metrics["update_lag"].append(received - float(event["time"]))
+            if event.get("status") in ("completed", "error"):
+                final_event = event
+                break
+
+    if final_event is not None and "retry_after" in final_event:
+        raise Rejected("/video/download")
+    if final_event is None or final_event["status"] != "completed":
+        raise RuntimeError(f"download failed: {final_event.get('message') if final_event else 'connection closed'}")
+    metrics["download"].append(time.monotonic() - download_started)
+    # Videos that were already stored have no summary of their download
+    if final_event.get("average_speed"):
+        metrics["worker_throughput"].append(float(final_event["average_speed"]))
+
+    serve_started = time.monotonic()
+    size = 0
+    async with client.stream("GET", final_event["URL"]) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+    metrics["serve_throughput"].append(size / max(time.monotonic() - serve_started, 1e-6))
+
+
+def redis_commands_processed(client: redis.Redis) -> int:
+    """Return the number of commands the Redis server processed since it started."""
+    return int(client.info("stats")["total_commands_processed"])
+
+
+def summarize(values: list[float]) -> dict:
+    """Return the percentiles of a metric."""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def percentile(fraction):
+        return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+    return {"count": len(values), "mean": statistics.fmean(values), "p50": percentile(0.5),
+            "p95": percentile(0.95), "p99": percentile(0.99), "max": values[-1]}
+
+
+async def run(args) -> dict:
+    config = EnvironmentVariablesConfig()
+    redis_client = redis.Redis(host=config.redis_address, port=config.redis_port)
+
+    # Videos are picked from a pool, so --reuse of the flows hit videos that were already requested
+    # (fresh IDs on every run, so the first request of each video is never served from a previous run)
+    pool = [f"bench{uuid.uuid4().hex[:6]}" for _ in range(max(1, round(args.flows * (1 - args.reuse))))]
+    video_ids = [pool[index % len(pool)] for index in range(args.flows)]
+
+    metrics = {name: [] for name in ("submit_to_metadata", "thumbnail", "first_update", "update_lag",
+                                     "download", "worker_throughput", "serve_throughput")}
+    errors = {}
+    rejections = {}
+    semaphore = asyncio.Semaphore(args.users)
+
+    async def flow(video_id):
+        async with semaphore:
+            try:
+                await run_flow(client, args, video_id, metrics)
+            except Rejected as e:
+                rejections[str(e)] = rejections.get(str(e), 0) + 1
+            except Exception as e:
+                kind = str(e).split(":")[0] or type(e).__name__
+                errors[kind] = errors.get(kind, 0) + 1
+
+    commands_before = redis_commands_processed(redis_client)
+    started = time.monotonic()
+    async with httpx.AsyncClient(base_url=args.api, timeout=args.timeout,
+                                 limits=httpx.Limits(max_connections=args.users * 2)) as client:
+        await asyncio.gather(*(flow(video_id) for video_id in video_ids))
+    elapsed = time.monotonic() - started
+    # The two INFO commands of the benchmark itself are not part of the load
+    commands = redis_commands_processed(redis_client) - commands_before - 2
+
+    completed = len(metrics["serve_throughput"])
+    results = {name: summarize(values) for name, values in metrics.items()}
+    results["flows_per_second"] = {"mean": completed / elapsed if elapsed else 0.0}
+    results["redis_commands_per_flow"] = {"mean": commands / args.flows}
+    return {
+        "config": {"users": args.users, "flows": args.flows, "reuse": args.reuse, "format": args.format},
+        "completed": completed,
+        "errors": errors,
+        "rejections": rejections,
+        "elapsed": elapsed,
+        "results": results,
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['completed']}/{report['config']['flows']} flows completed in {report['elapsed']:.1f} s "
+          f"with {report['config']['users']} concurrent users")
+    if report["errors"]:
+        print(f"Errors: {report['errors']}")
+    if report["rejections"]:
+        print(f"Rejected by the admission control: {report['rejections']}")
+    for name, summary in report["results"].items():
+        if not summary:
+            print(f"  {name:<24} no data")
+        elif "p50" in summary:
+            print(f"  {name:<24} mean {summary['mean']:>12.3f}  p50 {summary['p50']:>12.3f}  "
+                  f"p95 {summary['p95']:>12.3f}  p99 {summary['p99']:>12.3f}  max {summary['max']:>12.3f}")
+        else:
+            print(f"  {name:<24} {summary['mean']:>12.3f}")
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """Compare a report to a baseline, returning the metrics that regressed by more than the threshold."""
+    regressions = []
+    print(f"Compared to the baseline ({threshold:.0%} tolerance):")
+    for name, summary in report["results"].items():
+        reference = baseline["results"].get(name, {})
+        for statistic in ("p50", "p95", "mean") if "p50" in summary else ("mean",):
+            if statistic not in summary or not reference.get(statistic):
+                continue
+            change = (summary[statistic] - reference[statistic]) / reference[statistic]
+            worse = -change if name in HIGHER_IS_BETTER else change
+            flag = "REGRESSION" if worse > threshold else ""
+            print(f"  {name:<24} {statistic:<4} {reference[statistic]:>12.3f} -> {summary[statistic]:>12.3f} "
+                  f"({change:+.1%}) {flag}")
+            if flag:
+                regressions.append(f"{name} {statistic}")
+            # Latencies are only compared on their median and tail, not on their mean
+            if statistic == "p95":
+                break
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api", default="http://127.0.0.1:8000", help="The address of the FastAPI backend")
+    parser.add_argument("--users", type=int, default=10, help="How many flows run at once")
+    parser.add_argument("--flows", type=int, default=50, help="How many flows to run in total")
+    parser.add_argument("--reuse", type=float, default=0.0,
+                        help="Fraction of the flows that request a video another flow already requested")
+    parser.add_argument("--format", default="bench360", help="The format to download (bench360 or bench720)")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="Seconds between two polls of a task")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for each step of a flow")
+    parser.add_argument("--save", metavar="NAME", help="Save the results as the baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="Compare the results to the baseline NAME")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change tolerated before a regression")
+    parser.add_argument("--allow-rejections", action="store_true",
+                        help="Keep going when the admission control rejects flows (e.g., to measure it)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    # A run the admission control cut short measures the rejections, not the system
+    if report["rejections"] and not args.allow_rejections:
+        print("Flows were rejected, raise the per-client admission limits of the API for benchmark runs "
+              "(see the top of this file), or pass --allow-rejections.")
+        sys.exit(1)
+
+    if args.save:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        path = os.path.join(BASELINES_DIR, f"{args.save}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {path}")
+
+    if args.compare:
+        with open(os.path.join(BASELINES_DIR, f"{args.compare}.json"), encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print(f"Warning: the baseline was run with {baseline['config']}")
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
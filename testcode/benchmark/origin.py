@@ -0,0 +1,198 @@
+# A local stand-in for YouTube, so the whole system can be benchmarked offline.
+#
+# It serves, for any video ID:
+#   - /api/videos/<id>: the metadata of the video, read by the yt-dlp extractor in yt_dlp_plugins/
+#   - /media/<id>/<format_id>.<ext>: synthetic video-only and audio-only streams (with Range support)
+#   - /thumbnails/<id>.jpg: a thumbnail
+# The media is generated once with ffmpeg (which the workers need anyway to merge video and audio) and
+# shared by every video ID. Responses can be throttled and delayed to mimic a real origin.
+#
+# Usage (from the root of the project):
+#   python -m testcode.benchmark.origin --port 8765 --duration 60 --rate 2000000 --extract-delay 0.5
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The formats every video is available in: (format ID, width, height, video bitrate) for the video-only
+# streams, and a single audio-only stream. IDs are what the frontend sends as the selected format.
+VIDEO_FORMATS = [
+    ("bench360", 640, 360, "1500k"),
+    ("bench720", 1280, 720, "5000k"),
+]
+AUDIO_FORMAT = ("bench-audio", "128k")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def generate_media(directory: str, duration: int) -> dict:
+    """Generate the streams and the thumbnail with ffmpeg, reusing the ones already generated.
+
+    Returns:
+        dict: The path of every generated file, by file name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    commands = {}
+    for format_id, width, height, bitrate in VIDEO_FORMATS:
+        commands[f"{format_id}.mp4"] = [
+            "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30:duration={duration}",
+            # Constant bitrate, so the file size (and the download time) is predictable
+            "-c:v", "libx264", "-preset", "ultrafast", "-b:v", bitrate, "-minrate", bitrate, "-maxrate", bitrate,
+            "-bufsize", bitrate, "-x264-params", "nal-hrd=cbr", "-an",
+        ]
+    format_id, bitrate = AUDIO_FORMAT
+    commands[f"{format_id}.m4a"] = [
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}", "-c:a", "aac", "-b:a", bitrate, "-vn",
+    ]
+    commands["thumbnail.jpg"] = ["-f", "lavfi", "-i", "testsrc2=size=480x360:duration=1", "-frames:v", "1"]
+
+    files = {}
+    for name, arguments in commands.items():
+        path = os.path.join(directory, f"{duration}s-{name}")
+        if not os.path.exists(path):
+            print(f"Generating {path}")
+            subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *arguments, path], check=True)
+        files[name] = path
+    return files
+
+
+def video_metadata(video_id: str, files: dict, duration: int) -> dict:
+    """Return the metadata the extractor turns into a yt-dlp info dict."""
+    formats = [
+        {
+            "format_id": format_id, "ext": "mp4", "vcodec": "avc1.64001f", "acodec": "none",
+            "width": width, "height": height, "resolution": f"{width}x{height}", "fps": 30,
+            "tbr": int(bitrate.rstrip("k")), "filesize": os.path.getsize(files[f"{format_id}.mp4"]),
+            "path": f"/media/{video_id}/{format_id}.mp4",
+        }
+        for format_id, width, height, bitrate in VIDEO_FORMATS
+    ]
+    format_id, bitrate = AUDIO_FORMAT
+    formats.append({
+        "format_id": format_id, "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2",
+        "resolution": "audio only", "abr": int(bitrate.rstrip("k")), "filesize": os.path.getsize(files[f"{format_id}.m4a"]),
+        "path": f"/media/{video_id}/{format_id}.m4a",
+    })
+    return {
+        "id": video_id,
+        "title": f"Benchmark video {video_id}",
+        "duration": duration,
+        "thumbnail": f"/thumbnails/{video_id}.jpg",
+        "formats": formats,
+    }
+
+
+def make_handler(files: dict, duration: int, rate: int, extract_delay: float):
+    """Build the request handler serving the generated files."""
+
+    class OriginHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            match = re.fullmatch(r"/api/videos/([0-9A-Za-z_-]+)", self.path)
+            if match:
+                # Extraction is the slow part of talking to a real origin
+                time.sleep(extract_delay)
+                body = json.dumps(video_metadata(match.group(1), files, duration)).encode("utf-8")
+                return self._send(200, "application/json", body)
+
+            match = re.fullmatch(r"/media/[0-9A-Za-z_-]+/([0-9A-Za-z_-]+\.(?:mp4|m4a))", self.path)
+            if match and match.group(1) in files:
+                content_type = "video/mp4" if match.group(1).endswith(".mp4") else "audio/mp4"
+                return self._send_file(files[match.group(1)], content_type)
+
+            if re.fullmatch(r"/thumbnails/[0-9A-Za-z_-]+\.jpg", self.path):
+                return self._send_file(files["thumbnail.jpg"], "image/jpeg")
+
+            self._send(404, "text/plain", b"Not found")
+
+        def _send(self, status: int, content_type: str, body: bytes):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_file(self, path: str, content_type: str):
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+
+            match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    # A suffix range: the last N bytes
+                    start = max(0, size - int(match.group(2)))
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+
+            started = time.monotonic()
+            sent = 0
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    try:
+                        self.wfile.write(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    remaining -= len(chunk)
+                    sent += len(chunk)
+                    # Pace the response to the configured rate (per connection)
+                    if rate:
+                        ahead = sent / rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+    return OriginHandler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--duration", type=int, default=60, help="Duration (seconds) of the generated videos")
+    parser.add_argument("--rate", type=int, default=0, help="Bytes/s each connection is throttled to (0 for no limit)")
+    parser.add_argument("--extract-delay", type=float, default=0.5, help="Seconds the metadata API takes to respond")
+    parser.add_argument("--media-dir", default=os.path.join(tempfile.gettempdir(), "video-downloader-benchmark"),
+                        help="Where the generated media is kept between runs")
+    args = parser.parse_args()
+
+    files = generate_media(args.media_dir, args.duration)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(files, args.duration, args.rate, args.extract_delay))
+    print(f"Benchmark origin listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
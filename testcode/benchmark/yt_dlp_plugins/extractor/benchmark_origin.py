@@ -0,0 +1,39 @@
+# yt-dlp loads this extractor when testcode/benchmark is on the PYTHONPATH of the workers. Plugin
+# extractors are tried before the built-in ones, so the benchmark videos can go through the API
+# unchanged, as regular YouTube URLs.
+
+import os
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchmarkOriginIE(InfoExtractor):
+    """Extract the videos served by the local benchmark origin (testcode/benchmark/origin.py).
+
+    It claims the YouTube URLs whose video ID starts with "bench", and reads their metadata from
+    the origin set by the BENCHMARK_ORIGIN environment variable.
+    """
+
+    IE_NAME = "benchmark-origin"
+    _VALID_URL = r"https?://(?:(?:www\.|m\.)?youtube\.com/watch\?v=|youtu\.be/)(?P<id>bench[0-9A-Za-z_-]{6})"
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        origin = os.getenv("BENCHMARK_ORIGIN", "http://127.0.0.1:8765").rstrip("/")
+        video = self._download_json(f"{origin}/api/videos/{video_id}", video_id)
+
+        formats = []
+        for fmt in video["formats"]:
+            fmt = dict(fmt)
+            fmt["url"] = origin + fmt.pop("path")
+            fmt["protocol"] = "http"
+            formats.append(fmt)
+
+        return {
+            "id": video_id,
+            "title": video["title"],
+            "duration": video["duration"],
+            "thumbnail": origin + video["thumbnail"],
+            "webpage_url": url,
+            "formats": formats,
+        }
@@ -0,0 +1,94 @@
+# Check that the instances of a YoutubeDL pool still extract and download once they were leased and
+# returned, with and without a time range, by serving a video from the file server of a node (which
+# serves byte ranges, so ffmpeg only reads the part of the video a clip needs). The video is generated
+# with ffmpeg, which the clips are cut with (the workers need it anyway).
+#
+# Usage (from the root of the project):
+#   python -m testcode.check_ydl_pool
+
+import os
+import subprocess
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+from yt_dlp.utils import download_range_func
+
+from backendcode.file_server import make_handler
+from backendcode.tasks import DOWNLOAD_OPTIONS, EXTRACT_OPTIONS
+from backendcode.ydl_pool import YoutubeDLPool
+
+STORE_KEY = "check"
+FILE_NAME = "video.mp4"
+# Seconds of video, and the clip cut from it
+DURATION = 20
+SECTION = (5, 10)
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # The extraction reads the start of the file and hangs up
+        pass
+
+
+def serve(directory: str) -> ThreadingHTTPServer:
+    """Serve a videos directory on a free local port, in the background."""
+    server = QuietServer(("127.0.0.1", 0), make_handler(directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "videos", STORE_KEY))
+        path = os.path.join(directory, "videos", STORE_KEY, FILE_NAME)
+        # A keyframe every second, so the clip is cut close to the requested times
+        subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i",
+                        f"testsrc2=size=640x360:rate=30:duration={DURATION}", "-c:v", "libx264", "-g", "30",
+                        "-preset", "ultrafast", "-movflags", "+faststart", path], check=True)
+        size = os.path.getsize(path)
+        server = serve(os.path.join(directory, "videos"))
+        url = f"http://127.0.0.1:{server.server_address[1]}/videos/{STORE_KEY}/{FILE_NAME}"
+
+        # Several leases of the same instance, so the options a lease sets must be reset by the next one
+        extract_pool = YoutubeDLPool(EXTRACT_OPTIONS)
+        for _ in range(2):
+            with extract_pool.lease() as ydl:
+                info = ydl.extract_info(url, download=False)
+            assert info["url"] == url, info["url"]
+        print("Extraction: ok")
+
+        download_pool = YoutubeDLPool({**DOWNLOAD_OPTIONS, "quiet": True, "noprogress": True})
+        for run in range(2):
+            outtmpl = os.path.join(directory, f"download{run}.%(ext)s")
+            with download_pool.lease(format="best", outtmpl=outtmpl) as ydl:
+                ydl.download([url])
+            assert os.path.getsize(os.path.join(directory, f"download{run}.mp4")) == size
+        print("Download: ok")
+
+        # A lease with a time range must not leave it behind for the next one
+        with download_pool.lease(format="best", download_ranges=lambda info, ydl: []) as ydl:
+            assert "download_ranges" in ydl.params
+        with download_pool.lease(format="best") as ydl:
+            assert "download_ranges" not in ydl.params
+        print("Time range reset: ok")
+
+        # A clip, then the whole video again from the same instance
+        outtmpl = os.path.join(directory, "clip.%(ext)s")
+        with download_pool.lease(format="best", outtmpl=outtmpl,
+                                 download_ranges=download_range_func(None, [SECTION])) as ydl:
+            ydl.download([url])
+        clip_size = os.path.getsize(os.path.join(directory, "clip.mp4"))
+        share = (SECTION[1] - SECTION[0]) / DURATION
+        # About the share of the video the clip covers (an empty clip means ffmpeg could not seek)
+        assert size * share / 2 < clip_size < size * min(1.0, 2 * share), (clip_size, size)
+        outtmpl = os.path.join(directory, "after-clip.%(ext)s")
+        with download_pool.lease(format="best", outtmpl=outtmpl) as ydl:
+            ydl.download([url])
+        assert os.path.getsize(os.path.join(directory, "after-clip.mp4")) == size
+        print(f"Clip: ok ({clip_size} of {size} bytes)")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Measure what the API pays to start, and what each task pays to set up yt-dlp, to compare the
+# warm YoutubeDL pools of the workers with building a new instance for every task.
+#
+# Usage (from the root of the project):
+#   python -m testcode.measure_cold_start --runs 10 --tasks 50
+# With the benchmark origin running (python -m testcode.benchmark.origin), --origin also times full
+# extractions of its videos, which include the connection setup the pools save:
+#   python -m testcode.measure_cold_start --origin http://127.0.0.1:8765
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import yt_dlp
+
+from backendcode.tasks import EXTRACT_OPTIONS
+from backendcode.ydl_pool import YoutubeDLPool
+
+# Run in a fresh interpreter for every measurement, so nothing is imported yet
+API_COLD_START = """
+import contextlib, io, resource, sys, time
+started = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    import backendcode.API
+elapsed = time.perf_counter() - started
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "yt_dlp" in sys.modules, len(sys.modules))
+"""
+
+
+def measure_api_cold_start(runs: int):
+    times, memory = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", API_COLD_START], capture_output=True, text=True, check=True,
+                                env={**os.environ, "PYTHONPATH": os.getcwd()}).stdout.split()
+        times.append(float(output[0]))
+        memory.append(int(output[1]) / 1024)
+        imports_yt_dlp, modules = output[2] == "True", int(output[3])
+    print(f"API import: median {statistics.median(times) * 1000:.0f} ms, peak RSS {statistics.median(memory):.0f} MiB, "
+          f"{modules} modules, yt-dlp imported: {imports_yt_dlp}")
+
+
+def time_calls(function, count: int) -> float:
+    """Return the median duration (ms) of calling a function `count` times."""
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations) * 1000
+
+
+def measure_task_overhead(tasks: int, origin: str | None):
+    if origin is not None:
+        # The extractor of the benchmark origin is a yt-dlp plugin, found when the first instance is built
+        os.environ["BENCHMARK_ORIGIN"] = origin
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), "benchmark"))
+
+    pool = YoutubeDLPool(EXTRACT_OPTIONS)
+    pool.warm(1)
+
+    def fresh_setup():
+        with yt_dlp.YoutubeDL(dict(EXTRACT_OPTIONS)) as ydl:
+            ydl._request_director
+
+    def pooled_setup():
+        with pool.lease():
+            pass
+
+    print(f"Per-task setup: new instance {time_calls(fresh_setup, tasks):.2f} ms, "
+          f"pooled instance {time_calls(pooled_setup, tasks):.2f} ms")
+
+    if origin is None:
+        return
+    url = "https://www.youtube.com/watch?v=bench000000"
+
+    def fresh_extraction():
+        with yt_dlp.YoutubeDL(dict(EXTRACT_OPTIONS)) as ydl:
+            ydl.extract_info(url, download=False)
+
+    def pooled_extraction():
+        with pool.lease() as ydl:
+            ydl.extract_info(url, download=False)
+
+    print(f"Extraction: new instance {time_calls(fresh_extraction, tasks):.2f} ms, "
+          f"pooled instance {time_calls(pooled_extraction, tasks):.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10, help="How many times the API is started")
+    parser.add_argument("--tasks", type=int, default=50, help="How many tasks are timed per mode")
+    parser.add_argument("--origin", help="The address of the benchmark origin, to also time full extractions")
+    args = parser.parse_args()
+
+    measure_api_cold_start(args.runs)
+    measure_task_overhead(args.tasks, args.origin)
+
+
+if __name__ == "__main__":
+    main()
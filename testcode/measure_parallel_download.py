@@ -0,0 +1,62 @@
+# Measure how much faster the parallel downloader fetches a file from a throttled origin than the native,
+# single-connection one, and check that both write the same bytes.
+#
+# Usage (from the root of the project), with the benchmark origin throttling every connection:
+#   python -m testcode.benchmark.origin --port 8765 --duration 120 --rate 1000000
+#   python -m testcode.measure_parallel_download --origin http://127.0.0.1:8765 --connections 1 4 8
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import yt_dlp
+
+from backendcode.parallel_download import register_parallel_downloader
+
+
+def download(url: str, video_format: str, connections: int, directory: str) -> tuple[float, str]:
+    """Download a format with some connections, returning the duration and the hash of the file."""
+    options = {
+        'quiet': True,
+        'noprogress': True,
+        'format': video_format,
+        'outtmpl': os.path.join(directory, f'{connections}.%(ext)s'),
+        'concurrent_fragment_downloads': connections,
+        'external_downloader': {'http': register_parallel_downloader()},
+    }
+    with yt_dlp.YoutubeDL(options) as ydl:
+        info = ydl.extract_info(url, download=False)
+        started = time.perf_counter()
+        ydl.process_ie_result(info, download=True)
+        elapsed = time.perf_counter() - started
+        path = ydl.prepare_filename(info)
+    with open(path, 'rb') as file:
+        return elapsed, hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origin", required=True, help="The address of the benchmark origin")
+    parser.add_argument("--format", default="bench720", help="The format downloaded (a single file)")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 4], help="The connection counts compared")
+    args = parser.parse_args()
+
+    # The extractor of the benchmark origin is a yt-dlp plugin, found when the first instance is built
+    os.environ["BENCHMARK_ORIGIN"] = args.origin
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "benchmark"))
+
+    url = "https://www.youtube.com/watch?v=bench000000"
+    with tempfile.TemporaryDirectory() as directory:
+        results = {connections: download(url, args.format, connections, directory) for connections in args.connections}
+
+    baseline, digest = results[args.connections[0]]
+    for connections, (elapsed, file_digest) in results.items():
+        print(f"{connections} connection(s): {elapsed:.2f} s ({baseline / elapsed:.1f}x), "
+              f"same file: {file_digest == digest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Measure how long metadata extractions take end to end (queue wait included) while downloads keep the
+# workers busy, to check that the queue routing keeps extractions fast under load.
+#
+# Usage (from the root of the project, with Redis and the workers running):
+#   python -m testcode.measure_queue_latency "https://www.youtube.com/watch?v=<id>" --format 18 --downloads 8 --extractions 50
+# Run it once with --downloads 0 to get the latency of an idle system to compare with.
+
+import argparse
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from backendcode.data_models import EnvironmentVariablesConfig
+from backendcode.tasks import extract_info, download_video
+from backendcode.video_store import VideoStore
+
+
+def start_downloads(url, video_format, count):
+    """Start `count` downloads of the video, each under its own store key so none of them is shared."""
+    config = EnvironmentVariablesConfig()
+    video_store = VideoStore(redis.Redis(host=config.redis_address, port=config.redis_port, db=1))
+    results = []
+    for index in range(count):
+        store_key = VideoStore.key_for(f"measure-queue-latency-{uuid.uuid4()}", video_format)
+        download_id = str(uuid.uuid4())
+        video_store.acquire(store_key, download_id)
+        results.append(download_video.apply_async(args=[store_key, url, video_format], task_id=download_id))
+    return results
+
+
+def timed_extraction(url, timeout):
+    """Run one extraction, bypassing the metadata cache, and return how long it took in seconds."""
+    start = time.perf_counter()
+    extract_info.apply_async(args=[url]).get(timeout=timeout)
+    return time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of the sorted values falls."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="The video to extract and download")
+    parser.add_argument("--format", default="18", help="The format ID of the downloads")
+    parser.add_argument("--downloads", type=int, default=8, help="How many downloads to start before measuring")
+    parser.add_argument("--extractions", type=int, default=50, help="How many extractions to measure")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between two extractions")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for an extraction")
+    args = parser.parse_args()
+
+    started = time.time()
+    downloads = start_downloads(args.url, args.format, args.downloads)
+    # Let the download workers pick the downloads up
+    time.sleep(5 if downloads else 0)
+
+    with ThreadPoolExecutor(max_workers=args.extractions) as executor:
+        futures = []
+        for _ in range(args.extractions):
+            futures.append(executor.submit(timed_extraction, args.url, args.timeout))
+            time.sleep(args.interval)
+        durations = [future.result() for future in futures]
+
+    busy = sum(1 for download in downloads if not download.ready())
+    print(f"{args.extractions} extractions with {args.downloads} downloads started ({busy} still running at the end)")
+    print(f"p50 {statistics.median(durations):.2f} s  p95 {percentile(durations, 0.95):.2f} s  "
+          f"p99 {percentile(durations, 0.99):.2f} s  max {max(durations):.2f} s")
+
+    # How long the downloads took alongside, to compare the pools of the download workers
+    if downloads:
+        for download in downloads:
+            download.get(propagate=False)
+        failed = sum(1 for download in downloads if download.failed())
+        finished = max(download.date_done.timestamp() for download in downloads)
+        print(f"{args.downloads} downloads done in {finished - started:.1f} s ({failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Measure what storing the metadata of a video costs in the result backend, before and after
+# slimming the extract_info result (full info dict as JSON vs. compact projection as compressed msgpack).
+#
+# Usage (from the root of the project):
+#   python -m testcode.measure_result_payload "https://www.youtube.com/watch?v=<id>"
+#   python -m testcode.measure_result_payload --info-json saved_info.json   (works offline)
+# Offline, on the info extracted from the benchmark origin (started with python -m testcode.benchmark.origin):
+#   PYTHONPATH=testcode/benchmark BENCHMARK_ORIGIN=http://127.0.0.1:8765 python -m testcode.measure_result_payload "https://www.youtube.com/watch?v=bench360abc"
+# Add --redis to also store both payloads in Redis (REDIS_ADDRESS/REDIS_PORT) and report MEMORY USAGE.
+
+import argparse
+import json
+import statistics
+import time
+
+from kombu.compression import compress, decompress
+from kombu.serialization import dumps, loads
+
+from backendcode.video_info import project_info
+
+
+def timed(function, repeat):
+    """Return the result of a function and its median run time in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(durations)
+
+
+def measure(name, payload, serializer, compression, repeat):
+    """Serialize a payload the way the celery result backend does, and time it."""
+
+    def serialize():
+        content_type, encoding, body = dumps(payload, serializer=serializer)
+        compression_type = None
+        if compression:
+            body, compression_type = compress(body, compression)
+        return body, content_type, encoding, compression_type
+
+    (body, content_type, encoding, compression_type), serialize_ms = timed(serialize, repeat)
+
+    def deserialize():
+        data = decompress(body, compression_type) if compression_type else body
+        return loads(data, content_type, encoding, accept=[content_type])
+
+    _, deserialize_ms = timed(deserialize, repeat)
+    return {"name": name, "body": body, "bytes": len(body), "serialize_ms": serialize_ms, "deserialize_ms": deserialize_ms}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs="?", help="The video to extract")
+    parser.add_argument("--info-json", help="Use an info dict saved with yt-dlp --dump-json instead of extracting")
+    parser.add_argument("--repeat", type=int, default=20, help="How many times each step is timed")
+    parser.add_argument("--redis", action="store_true", help="Also report the Redis memory used by each payload")
+    args = parser.parse_args()
+
+    if args.info_json:
+        with open(args.info_json, encoding="utf-8") as f:
+            info = json.load(f)
+    elif args.url:
+        import yt_dlp
+        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(args.url, download=False))
+    else:
+        parser.error("Either a URL or --info-json is required")
+
+    projection, projection_ms = timed(lambda: project_info(info), args.repeat)
+    results = [
+        measure("before: full info, json", info, "json", None, args.repeat),
+        measure("after: projection, msgpack+zlib", projection, "msgpack", "zlib", args.repeat),
+    ]
+
+    if args.redis:
+        import redis
+        from backendcode.data_models import EnvironmentVariablesConfig
+        config = EnvironmentVariablesConfig()
+        client = redis.Redis(host=config.redis_address, port=config.redis_port, db=0)
+        for index, result in enumerate(results):
+            key = f"measure-result-payload:{index}"
+            client.set(key, result["body"])
+            result["redis_bytes"] = client.memory_usage(key)
+            client.delete(key)
+
+    print(f"Projection built in {projection_ms:.3f} ms")
+    for result in results:
+        line = (f"{result['name']:<36} {result['bytes']:>10} bytes  "
+                f"serialize {result['serialize_ms']:8.3f} ms  deserialize {result['deserialize_ms']:8.3f} ms")
+        if "redis_bytes" in result:
+            line += f"  redis {result['redis_bytes']} bytes"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()